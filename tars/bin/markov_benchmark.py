@@ -0,0 +1,89 @@
+"""markov_benchmark.py
+
+Compares MarkovFromList and CompactMarkov, built all at once and in parallel
+by worker processes, on the same messages from the chat log: how long each
+takes to build, how much memory each keeps, how long each takes to make
+sentences and how big each is when saved.
+
+The messages are the most recent from every channel, chosen as .gib chooses
+them. The limit can be raised to see how the parallel build scales.
+
+python3 -m tars.bin.markov_benchmark [config]
+"""
+
+import gc
+import gzip
+import random
+import time
+import tracemalloc
+
+from tars.helpers.database import DB
+from tars.helpers.markov import CompactMarkov, MarkovFromList, build_parallel
+
+LIMIT = 7500
+STATE_SIZE = 3
+# How many times to build each model
+REPEATS = 5
+SENTENCES = 200
+
+
+def build_markovify(messages):
+    return MarkovFromList(messages, well_formed=False, state_size=STATE_SIZE)
+
+
+def build_compact(messages):
+    return CompactMarkov(messages, STATE_SIZE)
+
+
+def build_compact_parallel(messages):
+    return build_parallel(messages, STATE_SIZE, 600)
+
+
+def benchmark(label, build, messages):
+    """Builds a model REPEATS times and makes sentences from it, and prints
+    the timings, memory and saved size."""
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        build(messages)
+        timings.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    model = build(messages)
+    gc.collect()
+    memory, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    random.seed(0)
+    start = time.perf_counter()
+    made = sum(
+        model.make_short_sentence(400) is not None for _ in range(SENTENCES)
+    )
+    making = time.perf_counter() - start
+    saved = len(gzip.compress(model.to_bytes()))
+    print(
+        "{:<9} build: {:7.1f} ms   memory: {:6.1f} MB (peak {:6.1f} MB)   "
+        "sentence: {:6.2f} ms ({}/{} made)   saved: {:5.1f} MB".format(
+            label,
+            min(timings) * 1000,
+            memory / 2 ** 20,
+            peak / 2 ** 20,
+            making * 1000 / SENTENCES,
+            made,
+            SENTENCES,
+            saved / 2 ** 20,
+        )
+    )
+
+
+if __name__ == '__main__':
+    messages = DB.get_messages(
+        DB.get_all_channels(), minlength=40, limit=LIMIT
+    )
+    print(
+        "Building models of {} messages, state size {}".format(
+            len(messages), STATE_SIZE
+        )
+    )
+    benchmark("markovify", build_markovify, messages)
+    benchmark("compact", build_compact, messages)
+    benchmark("parallel", build_compact_parallel, messages)
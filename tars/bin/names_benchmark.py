@@ -0,0 +1,114 @@
+"""names_benchmark.py
+
+Times saving the NAMES list of a big channel, the old way (a nick at a time)
+against DB.sort_names.
+
+python3 -m tars.bin.names_benchmark [config]
+
+The config is only used to start the bot's helpers; the benchmark runs on
+throwaway databases.
+"""
+
+import pathlib
+import random
+import tempfile
+import time
+
+from tars.helpers.config import CONFIG
+
+NICKS = 1000
+CHANNEL = "#benchmark"
+
+# Don't let the driver open the real database when it is imported
+_directory = tempfile.TemporaryDirectory()
+CONFIG['db']['driver.database']['path'] = str(
+    pathlib.Path(_directory.name) / "import.db"
+)
+CONFIG['db']['catalogue'] = False
+
+from tars.helpers import database
+
+
+def legacy_sort_names(self, channel, names):
+    """sort_names as it was before it was set-based."""
+    if not self._check_exists(channel, 'channel'):
+        self.join_channel(channel)
+    for name in names:
+        name['id'] = self.add_user(name['nick'])
+    c = self.conn.cursor()
+    c.execute(
+        '''
+        SELECT id FROM channels WHERE channel_name=?
+        ''',
+        (channel,),
+    )
+    channel = database.norm(c.fetchone())
+    c.execute(
+        '''
+        DELETE FROM channels_users
+        WHERE channel_id=?
+        ''',
+        (channel,),
+    )
+    for name in names:
+        c.execute(
+            '''
+            INSERT OR REPLACE INTO channels_users
+                (channel_id, user_id, user_mode)
+            VALUES( ? , ? , ? )
+            ''',
+            (channel, name['id'], name['mode']),
+        )
+    c.execute(
+        '''
+        UPDATE channels
+        SET date_checked=CURRENT_TIMESTAMP
+        WHERE id=?
+        ''',
+        (channel,),
+    )
+    self.conn.commit()
+
+
+def make_names(count, seed):
+    """Makes a NAMES list of count nicks with random modes."""
+    rng = random.Random(seed)
+    return [
+        {
+            'nick': "user{:05d}".format(number),
+            'mode': rng.choice([None] * 20 + ['+', '+', '%', '@', '&', '~']),
+        }
+        for number in range(count)
+    ]
+
+
+def benchmark(label, sort_names):
+    """Saves a channel's NAMES list into a fresh database, when none of the
+    nicks are known yet, and then again when all of them are."""
+    with tempfile.TemporaryDirectory() as directory:
+        CONFIG['db']['driver.database']['path'] = str(
+            pathlib.Path(directory) / "benchmark.db"
+        )
+        db = database.SqliteDriver()
+        db.join_channel(CHANNEL)
+        timings = []
+        for seed in range(2):
+            names = make_names(NICKS, seed)
+            start = time.perf_counter()
+            sort_names(db, CHANNEL, names)
+            timings.append(time.perf_counter() - start)
+        occupants = sorted(db.get_occupants(CHANNEL, True, levels=True))
+    print(
+        "{:<8} new nicks: {:8.1f} ms   known nicks: {:8.1f} ms".format(
+            label, timings[0] * 1000, timings[1] * 1000
+        )
+    )
+    return occupants
+
+
+if __name__ == '__main__':
+    print("Saving a NAMES list of {} nicks".format(NICKS))
+    legacy = benchmark("legacy", database._writes(legacy_sort_names))
+    current = benchmark("current", database.SqliteDriver.sort_names)
+    assert legacy == current, "The two ways saved different members"
+    _directory.cleanup()
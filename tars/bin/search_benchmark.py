@@ -0,0 +1,151 @@
+"""search_benchmark.py
+
+Times the searches that people have actually made, by replaying the search
+commands in the chat log against the database, with the SQL for each shape of
+search being made afresh every time (as it used to be) and being taken from
+the cache.
+
+python3 -m tars.bin.search_benchmark [config]
+
+The article searches are answered by the database even if the catalogue is
+enabled. The terms and regexes of the searches are also looked for in the
+chat log, as .gib and .grep do.
+"""
+
+import contextlib
+import io
+import time
+from types import SimpleNamespace
+
+from tars import commands
+from tars.helpers import database, query
+from tars.helpers.config import CONFIG
+from tars.helpers.database import DB
+from tars.helpers.parse import ParsedCommand
+
+# How many times to run each search
+REPEATS = 5
+
+
+class _Searched(Exception):
+    """Stops a search command once it has made its search."""
+
+    def __init__(self, searches):
+        super().__init__()
+        self.searches = searches
+
+
+@database._reads
+def get_logged_commands(self):
+    """Gets the text of every command in the chat log."""
+    c = self.conn.cursor()
+    c.execute(
+        '''
+        SELECT message FROM messages
+        WHERE command=1 AND kind='PRIVMSG'
+        '''
+    )
+    return [row['message'] for row in c.fetchall()]
+
+
+def get_logged_searches():
+    """Gets the searches that were made by search commands in the chat log,
+    as taken by DB.get_articles."""
+    searches = []
+    search_aliases = {
+        alias
+        for command in ['Search', 'Regexsearch', 'Tags']
+        for alias in commands.COMMANDS_REGISTRY.get_command_by_name(
+            command
+        ).aliases
+    }
+    sender = SimpleNamespace(
+        sender=CONFIG.nick, raw_channel=None, reply=lambda *args: None
+    )
+    get_articles = DB.get_articles
+
+    def capture(searches):
+        raise _Searched(searches)
+
+    DB.get_articles = capture
+    try:
+        for message in get_logged_commands(DB):
+            for text in message.split("&&"):
+                cmd = ParsedCommand(None, sender, text.strip())
+                if cmd.command not in search_aliases:
+                    continue
+                command_class = (
+                    commands.COMMANDS_REGISTRY.get_command_by_alias(
+                        cmd.command
+                    )
+                )
+                try:
+                    command = command_class(lambda permission: not permission)
+                    command.parse(cmd.message)
+                    command.execute(None, sender, cmd)
+                except _Searched as searched:
+                    searches.append(searched.searches)
+                except Exception:
+                    # Invalid searches and searches of Google
+                    continue
+    finally:
+        DB.get_articles = get_articles
+    return searches
+
+
+def benchmark(label, run, clear):
+    """Runs each of a list of functions REPEATS times, both after clearing
+    the cache and with what was cached from before. Returns what they
+    returned."""
+    cold = warm = 0
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for function in run:
+            for _ in range(REPEATS):
+                clear()
+                start = time.perf_counter()
+                result = function()
+                cold += time.perf_counter() - start
+            for _ in range(REPEATS):
+                start = time.perf_counter()
+                assert function() == result
+                warm += time.perf_counter() - start
+            results.append(result)
+    calls = max(len(run) * REPEATS, 1)
+    print(
+        "{:<9} uncached: {:8.3f} ms   cached: {:8.3f} ms".format(
+            label, cold * 1000 / calls, warm * 1000 / calls
+        )
+    )
+    return results
+
+
+if __name__ == '__main__':
+    searches = get_logged_searches()
+    print("Replaying {} searches from the chat log".format(len(searches)))
+    benchmark(
+        "articles",
+        [lambda s=search: DB._search_articles(s) for search in searches],
+        query._article_template.cache_clear,
+    )
+    channels = DB.get_all_channels()
+    terms = [
+        (
+            ([], [search['term']])
+            if search['type'] is None
+            else ([search['term']], [])
+        )
+        for searches_made in searches
+        for search in searches_made
+        if search['type'] in (None, 'regex')
+    ]
+    benchmark(
+        "messages",
+        [
+            lambda p=patterns, c=contains: DB.get_messages(
+                channels, patterns=p, contains=c, limit=50
+            )
+            for patterns, contains in terms
+        ],
+        query._message_template.cache_clear,
+    )
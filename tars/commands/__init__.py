@@ -25,6 +25,7 @@ COMMANDS_REGISTRY = CommandsRegistry(
         # Database manipulation
         "propagate": ["Propagate",],
         "dbq": ["Query", "Seen",],
+        "grep": ["Grep"],
         "refactor": ["Refactor",],
         "nick": ["Alias",],
         # Staff tools
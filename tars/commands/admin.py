@@ -24,6 +24,7 @@ class Kill(Command):
     def execute(self, irc_c, msg, cmd):
         msg.reply(kill_bye())
         irc_c.RAW("QUIT See you on the other side")
+        DB.flush_messages()
         irc_c.client.die()
 
 
@@ -119,6 +120,9 @@ class Reboot(Command):
     def execute(self, irc_c, msg, cmd):
         msg.reply("Rebooting...")
         irc_c.RAW("QUIT Rebooting, will be back soon!")
+        # execl replaces the process without running exit handlers, so the
+        # message log has to be flushed by hand
+        DB.flush_messages()
         os.execl(sys.executable, sys.executable, *sys.argv)
 
 
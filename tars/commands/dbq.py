@@ -163,26 +163,26 @@ class Seen(Command):
 
     def execute(self, irc_c, msg, cmd):
         nick = self['nick']
-        messages = DB.get_messages_from_user(nick, msg.raw_channel)
-        if len(messages) == 0:
+        activity = DB.get_user_activity(nick, msg.raw_channel)
+        if activity is None:
             raise MyFaultError(
                 "I've never seen {} in this channel.".format(nick)
             )
         if self['count']:
             msg.reply(
                 "I've seen {} {} times in this channel.".format(
-                    nick, len(messages)
+                    nick, activity['count']
                 )
             )
             return
         if self['first']:
-            message = messages[0]
+            message = activity['first']
             response = "I first saw {} {} saying: {}"
         else:
             if nick == msg.sender:
                 msg.reply("I can see you right now, {}.".format(msg.sender))
                 return
-            message = messages[-1]
+            message = activity['last']
             response = "I last saw {} {} saying: {}"
         response = response.format(
             nick
@@ -3,30 +3,20 @@
 Gib gab gibber gob!
 """
 
-import random
+from collections import OrderedDict
 import re
+from weakref import WeakValueDictionary
 
 from emoji import emojize
-import markovify
+from gevent.lock import Semaphore
 
 from tars.helpers.basecommand import Command, matches_regex, regex_type
 from tars.helpers.config import CONFIG
 from tars.helpers.database import DB
 from tars.helpers.defer import is_controller
 from tars.helpers.error import CommandError, MyFaultError
-
-_URL_PATT = (
-    r"https?:\/\/(www\.)?"
-    r"[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,4}"
-    r"\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)"
-)
-_YT_PATT = re.compile(r"^(http(s)?:\/\/)?((w){3}.)?youtu(be|.be)?(\.com)?\/.+")
-_IMG_PATT = re.compile(r"(imgur)|(((jpeg)|(jpg)|(png)|(gif)))$")
-
-
-class MarkovFromList(markovify.Text):
-    def sentence_split(self, text):
-        return [text]
+from tars.helpers.markov import CompactMarkov, ModelCache, build_parallel
+from tars.helpers.workers import WORKERS
 
 
 class Gib(Command):
@@ -124,6 +114,17 @@ class Gib(Command):
             @argument(--no-cache) will ignore both of these constraints.
             """,
         ),
+        dict(
+            flags=['--sample'],
+            type=bool,
+            help="""Gib from random messages instead of the most recent.
+
+            Normally, the gib is made from the most recent messages in the
+            selection, up to @argument(--limit). With @argument(--sample),
+            that many messages are picked at random from the whole selection
+            instead, so older messages can turn up too.
+            """,
+        ),
         dict(
             flags=['--media', '-m'],
             type=str,
@@ -164,13 +165,29 @@ class Gib(Command):
         ),
     ]
 
-    cache = {
-        'model': None,
-        'users': [],
-        'channels': [],
-        'size': 3,
-        'limit': 0,
-    }
+    # How long, in seconds, to spend trying to make a sentence
+    timeout = 60
+
+    # Each gib makes up to gib.attempt_limit sentences in one go, and the
+    # first that hasn't been used is gibbed. Up to reserve_size of the rest
+    # are kept for the next gib from the same model, for the most recent
+    # reserves_limit models
+    reserves = OrderedDict()
+    reserve_size = 5
+    reserves_limit = 32
+
+    # Models of at least this many messages are built in worker processes,
+    # in parts at the same time
+    parallel_limit = 50000
+
+    # {model key: lock}, for the models that are being got right now
+    model_locks = WeakValueDictionary()
+
+    # Markov models for the selections of messages that have been gibbed
+    cache = ModelCache(
+        CONFIG['gib'].get('cache_dir'),
+        CONFIG['gib'].get('cache_size', 200) * 2 ** 20,
+    )
 
     def execute(self, irc_c, msg, cmd):
         self['channel'] = self['channel']
@@ -211,36 +228,20 @@ class Gib(Command):
                     "You can only gib the current channel (or "
                     "any channel from if you do it in PMs with me)."
                 )
-        # Does the model need to be regenerated?
-        if not self['no_cache'] and all(
-            [
-                Gib.cache['model'] is not None,
-                Gib.cache['channels'] == self['channel'],
-                Gib.cache['users'] == self['user'],
-                Gib.cache['size'] == self['size'],
-                Gib.cache['limit'] == limit,
-            ]
-        ):
-            print("Reusing Markov model")
-        else:
-            Gib.cache['model'] = None
-            Gib.cache['channels'] = self['channel']
-            Gib.cache['users'] = self['user']
-            Gib.cache['size'] = self['size']
-            Gib.cache['limit'] = limit
         # are we gibbing or rouletting?
         if 'media' in self:
-            urls = self.media_roulette()
+            url, count = self.media_roulette()
             msg.reply(
                 "{} {} · ({} link{} found)".format(
                     emojize(":game_die:"),
-                    random.choice(urls),
-                    len(urls),
-                    "s" if len(urls) > 1 else "",
+                    url,
+                    count,
+                    "s" if count > 1 else "",
                 )
             )
             return
         # gibbing:
+        self.sentences = 0
         try:
             sentence = self.get_gib_sentence(limit=limit)
             if sentence is None:
@@ -268,11 +269,7 @@ class Gib(Command):
                         if len(self['channel']) == 1
                         else "those channels"
                     ),
-                    " ({} messages)".format(
-                        len(Gib.cache['model'].to_dict()['parsed_sentences'])
-                        if Gib.cache['model'] is not None
-                        else 0
-                    ),
+                    " ({} messages)".format(self.sentences),
                 )
             ) from error
         # first: remove a ping at the beginning of the sentence
@@ -327,74 +324,167 @@ class Gib(Command):
         string += closing_bracket * depths[-1]
         return string
 
-    def get_gib_sentence(self, attempts=0, limit=7500):
+    def get_gib_sentence(self, limit=7500):
         print("Getting a gib sentence")
-        # messages = []
-        # for channel in cls.channels:
-        #     print("Iterating channels")
-        #     for user in cls.users:
-        #         print("Iterating users")
-        #         messages.extend(DB.get_messages(channel, user))
-        messages = DB.get_messages(
+        key = self.model_key(self['size'], limit)
+        # Sentences left over from the last gib from this model, that were
+        # made to be at least as long
+        reserve_key = key + (self['minlength'],)
+        sentence, reserve = self.pick_sentence(
+            [] if self['no_cache'] else Gib.reserves.pop(reserve_key, [])
+        )
+        if sentence is not None:
+            print("Using a reserved sentence")
+        elif self['size'] > 0:
+            model = self.get_model(key, limit)
+            # Automatically decrement the state size if the higher state size
+            # fails, using the same model at the smaller size
+            for size in range(self['size'], 0, -1):
+                print("Making sentences, size {}".format(size))
+                candidates = WORKERS.run(
+                    Gib.timeout,
+                    model.of_state_size(size).make_sentences,
+                    CONFIG['gib']['attempt_limit'],
+                    self['minlength'],
+                    400,
+                )
+                sentence, reserve = self.pick_sentence(candidates)
+                if sentence is not None:
+                    break
+                if len(candidates) > 0:
+                    raise MyFaultError(
+                        "I didn't find any gibs for that selection "
+                        "that haven't already been said."
+                    )
+                print("Sentence is None")
+        if sentence is not None:
+            DB.add_gib(sentence)
+            if not self['no_cache']:
+                Gib.reserves[reserve_key] = reserve[: Gib.reserve_size]
+                while len(Gib.reserves) > Gib.reserves_limit:
+                    Gib.reserves.popitem(last=False)
+        return sentence
+
+    def get_model(self, key, limit):
+        """Gets the Markov model for the messages to gib from, from the cache
+        if it's there, catching it up with any newer messages."""
+        # Only one gib at a time gets the model for a key, so that two gibs
+        # can't both add the same new messages to it
+        lock = Gib.model_locks.setdefault(key, Semaphore())
+        with lock:
+            newest = DB.get_newest_message_id(self['channel'])
+            model, metadata = (
+                (None, None) if self['no_cache'] else Gib.cache.get(key)
+            )
+            if (
+                model is not None
+                and metadata['newest'] != newest
+                and self['sample']
+            ):
+                # A sample has to be taken again to give newer messages a
+                # chance
+                model = None
+            if model is not None and metadata['newest'] != newest:
+                # Catch the model up with the messages since it was made
+                recent = self.get_messages(
+                    limit, after=metadata['newest'], before=newest
+                )
+                if len(recent) < len(model):
+                    print(
+                        "Adding {} messages to Markov model".format(
+                            len(recent)
+                        )
+                    )
+                    model = Gib.update_model(model, recent, limit)
+                    metadata = Gib.cache.update(key, newest, model)
+                else:
+                    # Nearly all of the model would be replaced
+                    model = None
+            if model is not None:
+                print("Reusing Markov model")
+                self.sentences = metadata['sentences']
+                return model
+            # Messages logged since newest was read are left for the next gib
+            # to catch up with, rather than being counted twice
+            messages = self.get_messages(limit, before=newest)
+            print("messages found: {}".format(len(messages)))
+            if len(messages) == 0:
+                raise AttributeError
+            print("Making model from messages, size {}".format(self['size']))
+            model = Gib.make_model(messages, self['size'])
+            self.sentences = len(model)
+            if not self['no_cache']:
+                Gib.cache.put(key, model, newest)
+            return model
+
+    def pick_sentence(self, candidates):
+        """Picks the first of a list of sentences that hasn't been said or
+        gibbed before. Returns it and the sentences after it, or None and an
+        empty list."""
+        said = DB.get_said(candidates)
+        for index, sentence in enumerate(candidates):
+            if sentence in said:
+                continue
+            if not self['no_cache'] and DB.is_gibbed(sentence):
+                continue
+            return sentence, candidates[index + 1 :]
+        return None, []
+
+    def get_messages(self, limit, after=None, before=None):
+        """Gets the messages to gib from, most recent first. after is the ID
+        of a message that they must be newer than, and before is the ID of
+        one that they must be no newer than."""
+        return DB.get_messages(
             self['channel'],
             minlength=40,
             limit=limit,
             senders=None if self['user'] == [] else self['user'],
             patterns=[r.pattern for r in self['regex']],
+            after=after,
+            before=before,
+            sample=self['sample'],
+        )
+
+    def model_key(self, size, limit):
+        """Describes the messages that a model of the given state size is made
+        from, for the model cache."""
+        return (
+            tuple(sorted({channel.lower() for channel in self['channel']})),
+            tuple(sorted({user.lower() for user in self['user']})),
+            tuple(sorted({regex.pattern for regex in self['regex']})),
+            size,
+            limit,
+            self['sample'],
         )
-        print("messages found: {}".format(len(messages)))
-        if len(messages) == 0:
-            raise AttributeError
-        # Automatically decrement the state size if the higher state size fails
-        for decr in range(0, self['size']):
-            print(
-                "Making model from messages, size {}".format(
-                    self['size'] - decr
-                )
-            )
-            # The model cache depends on the state size, so if there is a state
-            # size decrement, discard it anyway
-            if decr != 0:
-                Gib.cache['model'] = None
-            model = (
-                Gib.cache['model']
-                if Gib.cache['model'] is not None
-                else Gib.make_model(messages, self['size'], decrement=decr)
-            )
-            print("Making sentence")
-            sentence = model.make_short_sentence(
-                400, self['minlength'], tries=200, force_result=False
-            )
-            if sentence is not None:
-                break
-            print("Sentence is None")
-        if not self['no_cache'] and sentence in DB.get_gibs():
-            print(
-                "Sentence already sent, {} attempts remaining".format(
-                    CONFIG['gib']['attempt_limit'] - attempts
-                )
-            )
-            try:
-                if attempts < CONFIG['gib']['attempt_limit']:
-                    sentence = self.get_gib_sentence(attempts + 1, limit)
-                else:
-                    raise RecursionError
-            except RecursionError as error:
-                raise MyFaultError(
-                    "I didn't find any gibs for that selection "
-                    "that haven't already been said."
-                ) from error
-        if sentence is not None:
-            DB.add_gib(sentence)
-        return sentence
 
     @staticmethod
-    def make_model(messages, base_size, decrement=0):
+    def make_model(messages, size):
         """Generate the Markov model."""
-        size = base_size - decrement
-        if size == 0:
-            return None
-        return MarkovFromList(messages, well_formed=False, state_size=size)
+        if len(messages) >= Gib.parallel_limit:
+            return build_parallel(messages, size, Gib.timeout)
+        # Sending a small model back from a worker would take longer than
+        # building it here
+        return CompactMarkov(messages, size)
+
+    @staticmethod
+    def update_model(model, messages, limit):
+        """Adds newer messages to a model. Returns the updated model, which
+        is a copy if it was updated in a worker process."""
+        if len(model) >= Gib.parallel_limit:
+            # Even only changing the counts of a model this big holds
+            # everything else up for a while
+            return WORKERS.run(
+                Gib.timeout, Gib.updated_model, model, messages, limit
+            )
+        model.update(messages, limit)
+        return model
+
+    @staticmethod
+    def updated_model(model, messages, limit):
+        """Adds newer messages to a model and returns it, for a worker
+        process to send back."""
+        model.update(messages, limit)
+        return model
 
     @staticmethod
     def obfuscate(sentence, nicks):
@@ -424,29 +514,15 @@ class Gib(Command):
         return "".join(word)
 
     def media_roulette(self):
-        """Get a random image or video link."""
-        # take all the messages in the channel, filtered for links
-        messages = DB.get_messages(
-            self['channel'], senders=self['user'], patterns=[_URL_PATT]
+        """Get a random image or video link, and how many there are to pick
+        from."""
+        picked = DB.get_random_url(
+            self['channel'], self['media'], senders=self['user']
         )
-        if len(messages) == 0:
+        if picked is None:
             raise MyFaultError(
-                "I didn't find any URLs in the selection criteria."
+                "I didn't find any {}.".format(
+                    "images" if self['media'] == 'image' else "video links"
+                )
             )
-        # then reduce strings containing urls to urls
-        urls = [
-            re.search(_URL_PATT, message, re.IGNORECASE).group(0)
-            for message in messages
-        ]
-        # make urls unique
-        urls = list(set(urls))
-        # then filter by either images or videos
-        if self['media'] == 'image':
-            urls = [url for url in urls if _IMG_PATT.search(url)]
-            if len(urls) == 0:
-                raise MyFaultError("I didn't find any images.")
-        if self['media'] == 'youtube':
-            urls = [url for url in urls if _YT_PATT.search(url)]
-            if len(urls) == 0:
-                raise MyFaultError("I didn't find any video links.")
-        return urls
+        return picked
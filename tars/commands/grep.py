@@ -0,0 +1,79 @@
+"""grep.py
+
+Search the chat history of a channel.
+"""
+
+import pendulum as pd
+
+from tars.commands.gib import Gib
+from tars.helpers.basecommand import Command
+from tars.helpers.config import CONFIG
+from tars.helpers.database import DB
+from tars.helpers.error import CommandError, MyFaultError
+
+
+class Grep(Command):
+    """Search this channel's history for messages.
+
+    Finds the most recent messages in the current channel that contain all of
+    the given words. Searching is never case-sensitive. Words do not need to
+    be whole words - they can match part of a longer word.
+
+    For privacy reasons, only the current channel is searched. Commands and my
+    own messages are not searched. Like @command(gib), any pings in the
+    results are censored.
+
+    @example(.grep await research)(shows the most recent messages that
+    contain both "await" and "research".)
+    """
+
+    command_name = "Search chat history"
+    aliases = ["grep"]
+    arguments = [
+        dict(
+            flags=['terms'],
+            type=str,
+            nargs='+',
+            help="""The words to search for.
+
+            Only messages that contain all of these words will be shown. Like
+            all commands, anything wrapped in quotemarks (`"`) will be treated
+            as a single word.
+            """,
+        ),
+        dict(
+            flags=['--limit', '-l'],
+            type=int,
+            nargs=None,
+            default=3,
+            help="""The maximum number of messages to show.
+
+            Must be between 1 and 10. Defaults to 3.
+            """,
+        ),
+    ]
+
+    def execute(self, irc_c, msg, cmd):
+        if msg.raw_channel is None:
+            raise CommandError("I can only search the history of a channel.")
+        if not 1 <= self['limit'] <= 10:
+            raise CommandError("The limit must be between 1 and 10.")
+        messages = DB.search_messages(
+            msg.raw_channel,
+            self['terms'],
+            limit=self['limit'],
+            exclude=[CONFIG.nick],
+        )
+        if len(messages) == 0:
+            raise MyFaultError(
+                "I haven't seen anyone say that in this channel."
+            )
+        members = DB.get_channel_members(msg.raw_channel)
+        for message in messages:
+            msg.reply(
+                "{} · <{}> {}".format(
+                    pd.from_timestamp(message['timestamp']).diff_for_humans(),
+                    Gib.obfuscate(message['sender'], members),
+                    Gib.obfuscate(message['message'], members),
+                )
+            )
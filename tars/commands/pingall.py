@@ -3,11 +3,8 @@
 Pings everyone in the room.
 """
 
-from pyaib.signals import await_signal
-
 from tars.helpers.basecommand import Command, matches_regex, longstr
 from tars.helpers.database import DB
-from tars.helpers.defer import get_users
 from tars.helpers.error import CommandError, MyFaultError
 
 
@@ -39,7 +36,7 @@ class Pingall(Command):
             type=matches_regex("^#", "must be a channel"),
             mode='hidden',
             permission=True,
-            help="""The channel for the NAMES request.""",
+            help="""The channel whose members to ping.""",
         ),
         dict(
             flags=['--target', '-t'],
@@ -71,17 +68,8 @@ class Pingall(Command):
             channel = self['channel']
         else:
             channel = msg.raw_channel
-        # Issue a fresh NAMES request and await the response
-        get_users(irc_c, channel)
-        try:
-            response = await_signal(irc_c, 'NAMES_RESPONSE', timeout=5.0)
-            # returned data is the channel name
-            assert response == channel
-        except (TimeoutError, AssertionError):
-            # response to success/failure is the same, so doesn't matter
-            pass
-        finally:
-            members = DB.get_occupants(channel, True, levels=True)
+        # The names plugin keeps the members of the channel up to date
+        members = DB.get_occupants(channel, True, levels=True)
         modes = "+%@&~"
         members = [
             nick
@@ -95,6 +95,7 @@ class Propagate(Command):
             # Give the API a moment to rest
             gevent.sleep(5)
         DB.commit()
+        DB.refresh_catalogue()
 
     @staticmethod
     def get_wiki_data_for_pages(slugs, **kwargs):
@@ -105,3 +106,4 @@ class Propagate(Command):
             page = SCPWiki.get_one_page_meta(slug)
             DB.add_article(page, commit=False)
         DB.commit()
+        DB.refresh_catalogue()
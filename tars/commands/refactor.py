@@ -7,6 +7,10 @@ TEMPORARY commands for refactoring the database.
 - Issue .refactor
 
 TARS will not allow you to refactor a 2nd time unless you issue .reload again.
+
+Permanent changes to the schema (new tables, columns or indexes) should not be
+made here - add them to MIGRATIONS in helpers/database.py instead, so that
+every database gets them at startup.
 """
 
 from tars.helpers.basecommand import Command, longstr
@@ -21,6 +21,8 @@ from tars.helpers.basecommand import Command
 from tars.helpers.api import GOOGLE_CSE_API_KEY, GOOGLE_CSE_ID
 from tars.helpers.error import CommandError, isint
 from tars.helpers.database import DB
+from tars.helpers.defer import is_controller
+from tars.helpers.workers import WORKERS
 
 try:
     import re2 as re
@@ -247,7 +249,11 @@ class Search(Command):
         dict(
             flags=['--verbose', '-v'],
             type=bool,
-            help="""State the search criteria that TARS thinks you want.""",
+            help="""State the search criteria that TARS thinks you want.
+
+            For controllers, also shows how the database would run the
+            search.
+            """,
         ),
         dict(
             flags=['--ignorepromoted'],
@@ -523,10 +529,25 @@ class Search(Command):
             if verbose.endswith("; "):
                 verbose = verbose[:-2]
             msg.reply(verbose)
+            if is_controller(cmd):
+                msg.reply(
+                    "Query plan: {}".format(
+                        " | ".join(
+                            line.strip()
+                            for line in DB.explain_articles(searches)
+                        )
+                    )
+                )
 
         page_ids = DB.get_articles(searches)
-        pages = [DB.get_article_info(p_id) for p_id in page_ids]
-        pages = Search.order(pages, search_term=strings, **selection)
+        pages = DB.get_articles_info(page_ids)
+        if selection['order'] == 'fuzzy' and len(pages) >= 500:
+            # Comparing the search to every title takes a while
+            pages = WORKERS.run(
+                30, Search.order, pages, search_term=strings, **selection
+            )
+        else:
+            pages = Search.order(pages, search_term=strings, **selection)
 
         if len(pages) >= 50:
             msg.reply(
@@ -9,6 +9,7 @@ from itertools import product, combinations_with_replacement
 from tars.helpers.basecommand import Command, longstr
 from tars.helpers.database import DB
 from tars.helpers.error import CommandError, MyFaultError
+from tars.helpers.workers import WORKERS
 
 
 class Shortest(Command):
@@ -38,9 +39,9 @@ class Shortest(Command):
     @example(.s sol be)(the shortest multi-string search that uniquely matches
     _SCP-1313: Solve For Bear_ as of March 2021.)
 
-    If it takes TARS more than three minutes to calculate the shortest search
-    for something, it will be kicked from IRC. If you find an article this
-    happens for, please let me know.
+    If it takes TARS more than two minutes to calculate the shortest search
+    for something, it will give up. If you find an article this happens for,
+    please let me know.
 
     @command(shortest) only generates searches that use the `title` argument of
     @command(search). Generating searches that use other arguments might be
@@ -86,6 +87,9 @@ class Shortest(Command):
         ),
     ]
 
+    # How long, in seconds, to spend looking for a search
+    timeout = 120
+
     def execute(self, irc_c, msg, cmd):
         if 'title' not in self and 'url' not in self:
             raise CommandError(
@@ -95,7 +99,7 @@ class Shortest(Command):
             title = self['title']
         elif 'url' in self:
             try:
-                title = DB.get_article_info(
+                title = DB.get_articles_info(
                     DB.get_articles(
                         [
                             {
@@ -104,17 +108,22 @@ class Shortest(Command):
                                 'term': self['url'].split("/")[-1],
                             }
                         ]
-                    )[0]
-                )['title']
+                    )[:1],
+                    fields=['title'],
+                )[0]['title']
             except IndexError as error:
                 raise MyFaultError(
                     "I don't see any page at '{}'.".format(self['url'])
                 ) from error
         pages = [
-            DB.get_article_info(p_id)['title'] for p_id in DB.get_articles([])
+            page['title']
+            for page in DB.get_articles_info(
+                DB.get_articles([]), fields=['title']
+            )
         ]
-        single_string = Shortest.get_substring(title, pages)
-        helen_style = Shortest.get_multi_substring(title, pages)
+        single_string, helen_style = WORKERS.run(
+            Shortest.timeout, Shortest.get_searches, title, pages
+        )
         if single_string is None and helen_style is None:
             raise MyFaultError(
                 "There's no unique search for \"{}\".".format(title)
@@ -125,6 +134,15 @@ class Shortest(Command):
             )
         )
 
+    @staticmethod
+    def get_searches(title, pages):
+        """Finds the shortest single-string and multi-string searches for a
+        title, either of which may be None."""
+        return (
+            Shortest.get_substring(title, pages),
+            Shortest.get_multi_substring(title, pages),
+        )
+
     @staticmethod
     def pick_answer(single_string, helen_style):
         if single_string is None and helen_style is None:
@@ -63,7 +63,7 @@ class Showmore(Command):
                     len(page_ids)
                 )
             )
-        pages = [DB.get_article_info(page_id) for page_id in page_ids]
+        pages = DB.get_articles_info(page_ids)
         if self['index'] == 0:
             msg.reply(
                 "{} saved results (use ..sm to choose): {}".format(
@@ -0,0 +1,259 @@
+"""catalogue.py
+
+In-memory copy of the articles table, for answering searches without querying
+the database.
+
+Numeric and categorical columns are held in NumPy arrays with one element per
+article, and each tag and author has a sorted array of the positions of its
+articles. A search turns each of its criteria into a boolean mask over all
+articles and combines them with AND/ANDNOT; only title and regex criteria,
+which can't be answered that way, are checked one by one against the articles
+that are left.
+
+The catalogue never touches the database itself - the database driver reads
+the rows and hands them over with update().
+"""
+
+from collections import defaultdict
+
+import numpy as np
+
+from tars.helpers import regexplan
+
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+# SQLite's NOCASE collation only folds ASCII letters
+_NOCASE = str.maketrans(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz"
+)
+
+
+def nocase(string):
+    """Folds a string the way SQLite's NOCASE collation compares it."""
+    return string.translate(_NOCASE)
+
+
+class ArticleCatalogue:
+    """Columnar copy of the articles, their tags and their authors."""
+
+    def __init__(self):
+        self.size = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.rating = np.empty(0, dtype=np.int64)
+        self.date_posted = np.empty(0, dtype=np.int64)
+        self.category = np.empty(0, dtype=np.int32)
+        self.parent = np.empty(0, dtype=np.int32)
+        self.titles = []
+        self.scp_nums = []
+        # Categories and parents are stored as codes; -1 means NULL
+        self._category_codes = {}
+        self._parent_codes = {}
+        self._positions = {}
+        self._urls = {}
+        self._url_of = []
+        self._tags = {}
+        self._authors = {}
+        self._tags_of = []
+        self._authors_of = []
+
+    def update(self, ids, articles, tags, authors):
+        """Updates the catalogue with the current state of some articles.
+
+        ids is the set of IDs of articles that have changed. articles are the
+        rows of those of them that still exist, and tags and authors are
+        (article_id, tag) and (article_id, author) pairs for them. Articles in
+        ids without a row have been deleted.
+        """
+        articles = list(articles)
+        new_articles = [a for a in articles if a['id'] not in self._positions]
+        if len(new_articles) > 0:
+            self._grow(len(new_articles))
+        for article in new_articles:
+            self._positions[article['id']] = len(self._positions)
+        new_tags = defaultdict(set)
+        for article_id, tag in tags:
+            new_tags[self._positions[article_id]].add(nocase(tag))
+        new_authors = defaultdict(set)
+        for article_id, author in authors:
+            new_authors[self._positions[article_id]].add(nocase(author))
+        removed = {'tags': defaultdict(list), 'authors': defaultdict(list)}
+        added = {'tags': defaultdict(list), 'authors': defaultdict(list)}
+        for article in articles:
+            position = self._positions[article['id']]
+            self._set_row(position, article)
+            for kind, current, wanted in [
+                ('tags', self._tags_of, new_tags[position]),
+                ('authors', self._authors_of, new_authors[position]),
+            ]:
+                for key in current[position] - wanted:
+                    removed[kind][key].append(position)
+                for key in wanted - current[position]:
+                    added[kind][key].append(position)
+                current[position] = wanted
+        present = {article['id'] for article in articles}
+        for article_id in ids:
+            if article_id in present or article_id not in self._positions:
+                continue
+            position = self._positions[article_id]
+            self.alive[position] = False
+            self._forget_url(position)
+            for kind, current in [
+                ('tags', self._tags_of),
+                ('authors', self._authors_of),
+            ]:
+                for key in current[position]:
+                    removed[kind][key].append(position)
+                current[position] = set()
+        for kind, postings in [
+            ('tags', self._tags),
+            ('authors', self._authors),
+        ]:
+            for key in removed[kind].keys() | added[kind].keys():
+                positions = postings.get(key, np.empty(0, dtype=np.int64))
+                positions = np.setdiff1d(positions, removed[kind][key])
+                positions = np.union1d(positions, added[kind][key])
+                if len(positions) > 0:
+                    postings[key] = positions.astype(np.int64)
+                else:
+                    postings.pop(key, None)
+
+    def _grow(self, count):
+        """Makes room at the end of the catalogue for count new articles."""
+        self.size += count
+        for name, dtype in [
+            ('ids', np.int64),
+            ('alive', bool),
+            ('rating', np.int64),
+            ('date_posted', np.int64),
+            ('category', np.int32),
+            ('parent', np.int32),
+        ]:
+            column = getattr(self, name)
+            setattr(
+                self,
+                name,
+                np.concatenate([column, np.zeros(count, dtype=dtype)]),
+            )
+        self.titles.extend([None] * count)
+        self.scp_nums.extend([None] * count)
+        self._url_of.extend([None] * count)
+        self._tags_of.extend(set() for _ in range(count))
+        self._authors_of.extend(set() for _ in range(count))
+
+    def _set_row(self, position, article):
+        """Copies an article's row into the catalogue."""
+        self.ids[position] = article['id']
+        self.alive[position] = True
+        self.rating[position] = article['rating']
+        self.date_posted[position] = article['date_posted']
+        self.category[position] = self._code(
+            self._category_codes, article['category']
+        )
+        self.parent[position] = self._code(
+            self._parent_codes, article['parent']
+        )
+        self.titles[position] = article['title']
+        self.scp_nums[position] = article['scp_num']
+        self._forget_url(position)
+        self._url_of[position] = nocase(article['url'])
+        self._urls[self._url_of[position]] = position
+
+    def _forget_url(self, position):
+        """Removes the URL of an article from the URL lookup, unless another
+        article has since taken it."""
+        if self._urls.get(self._url_of[position]) == position:
+            del self._urls[self._url_of[position]]
+
+    @staticmethod
+    def _code(codes, value):
+        """Gets the code for a categorical value, making one if needed."""
+        if value is None:
+            return -1
+        return codes.setdefault(value, len(codes))
+
+    def _mask(self, positions):
+        """Makes a mask of all articles from a list of their positions."""
+        mask = np.zeros(self.size, dtype=bool)
+        if positions is not None:
+            mask[positions] = True
+        return mask
+
+    def search(self, searches):
+        """Gets the IDs of the articles that match all of the searches.
+        searches is the same list of dicts that DB.get_articles takes."""
+        mask = self.alive.copy()
+        checks = []
+        for search in searches:
+            term = search['term']
+            if search['type'] == 'rating':
+                if term['max'] is not None:
+                    mask &= self.rating <= term['max']
+                if term['min'] is not None:
+                    mask &= self.rating >= term['min']
+            elif search['type'] == 'parent':
+                mask &= self.parent == self._parent_codes.get(term, -2)
+            elif search['type'] == 'category':
+                for categories, wanted in [
+                    (term['exclude'], False),
+                    (term['include'], True),
+                ]:
+                    if len(categories) > 0:
+                        codes = [
+                            self._category_codes.get(category, -2)
+                            for category in categories
+                        ]
+                        mask &= np.isin(self.category, codes) == wanted
+            elif search['type'] == 'date':
+                if term['max'] is not None:
+                    mask &= self.date_posted <= term['max'].int_timestamp
+                if term['min'] is not None:
+                    mask &= self.date_posted >= term['min'].int_timestamp
+            elif search['type'] in ('author', 'tags'):
+                postings = (
+                    self._authors if search['type'] == 'author' else self._tags
+                )
+                for key in term['include']:
+                    mask &= self._mask(postings.get(nocase(key)))
+                for key in term['exclude']:
+                    mask &= ~self._mask(postings.get(nocase(key)))
+            elif search['type'] is None:
+                checks.append(self._title_check(term))
+            elif search['type'] == 'regex':
+                pattern = regexplan.plan(term).compiled
+                checks.append(
+                    lambda pos, pattern=pattern: self.titles[pos] is not None
+                    and pattern.search(self.titles[pos]) is not None
+                )
+            elif search['type'] == 'url':
+                mask &= self._mask(self._urls.get(nocase(term)))
+            else:
+                raise TypeError(
+                    "Unknown search: {}/{}".format(search['type'], term)
+                )
+        positions = np.flatnonzero(mask)
+        if len(checks) > 0:
+            positions = [
+                position
+                for position in positions
+                if all(check(position) for check in checks)
+            ]
+        return np.sort(self.ids[positions]).tolist()
+
+    def _title_check(self, term):
+        """Makes the check for a title search, which matches a substring of
+        the title or the SCP number."""
+        lowered = term.lower()
+        pattern = re.compile(re.escape(term), re.IGNORECASE)
+
+        def check(position):
+            title = self.titles[position]
+            if title is not None and lowered in title.lower():
+                return True
+            scp_num = self.scp_nums[position]
+            return scp_num is not None and pattern.search(scp_num) is not None
+
+        return check
@@ -5,20 +5,41 @@ SQLite3 database driver for TARS.
 Plugin responsible for accessing and modifying the database.
 ALL database queries MUST pass through this file.
 Provides functions for manipulating the database.
+
+Queries run on a pool of threads rather than in the event loop. Every method
+of the driver that touches the database must be decorated with @_reads or
+@_writes, which decide which thread it runs on.
 """
 # reminder: conn.commit() after making changes (i.e. not queries)
 # reminder: 'single quotes' for string literals eg for tables that don't exist
 
+import atexit
+import hashlib
+import json
+import os
+import pathlib
 import sqlite3
 import random
+from functools import wraps
+import gevent
+import gevent.threadpool
+from gevent import monkey
 import pandas
 import pendulum as pd
-from pypika import MySQLQuery, Table, Order
-from pypika.terms import ValueWrapper
-from pypika.functions import Max, Length
 from pyaib.irc import Message
+from tars.helpers.catalogue import ArticleCatalogue, nocase
 from tars.helpers.config import CONFIG
+from tars.helpers.identities import IdentityIndex
+from tars.helpers.membership import ChannelMembership
+from tars.helpers.query import (
+    SearchStatistics,
+    compile_article_search,
+    compile_message_search,
+    fts_query,
+)
+from tars.helpers import regexplan
 from tars.helpers.error import nonelist, MyFaultError
+from tars.helpers.urls import KINDS, find_urls
 
 try:
     import re2 as re
@@ -28,9 +49,36 @@ except ImportError:
 
 DB = {}  # is instantiated as SqliteDriver at the end of this file
 
+# How many rows to fetch at a time when reading a lot of them
+STREAM_CHUNK_SIZE = 1000
+
 sqlite3.enable_callback_tracebacks(True)
 
 
+def _reads(method):
+    """Decorator for driver methods that only read from the database. They
+    are run on one of the reader threads, each of which has its own
+    read-only connection."""
+
+    @wraps(method)
+    def run(self, *args, **kwargs):
+        return self._dispatch(method, False, args, kwargs)
+
+    return run
+
+
+def _writes(method):
+    """Decorator for driver methods that write to the database. They are run
+    one at a time on the writer thread, which holds the only connection that
+    can write."""
+
+    @wraps(method)
+    def run(self, *args, **kwargs):
+        return self._dispatch(method, True, args, kwargs)
+
+    return run
+
+
 def dbprint(text, error=False):
     bit = "[\x1b[38;5;108mDatabase\x1b[0m] "
     if error:
@@ -63,16 +111,435 @@ def norm(thing):
 
 def _regexp(expr, item):
     """For evaluating db strings against a given regex."""
-    if item is None:
-        return False
-    return re.search(expr, item, re.IGNORECASE) is not None
+    return regexplan.search(expr, item)
+
+
+def _stream(cursor):
+    """Yields the rows of a cursor's results, fetching them a chunk at a
+    time so that they don't all have to be in memory at once. Must be used on
+    the database thread that the cursor belongs to."""
+    while True:
+        rows = cursor.fetchmany(STREAM_CHUNK_SIZE)
+        if len(rows) == 0:
+            return
+        yield from rows
+
+
+def _is_transient(error):
+    """Whether an error from writing to the database is likely to go away if
+    the write is tried again later, such as the database being locked."""
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in str(error) or "busy" in str(error)
+    )
+
+
+def _split_senders(senders):
+    """Splits a list of senders to search for into those to include and
+    those to exclude, which start with a hyphen. Secretary_Helen is excluded
+    unless someone else is."""
+    senders_in = []
+    senders_out = []
+    if not nonelist(senders):
+        senders_in = [s.lstrip("+") for s in senders if not s.startswith("-")]
+        senders_out = [s.lstrip("-") for s in senders if s.startswith("-")]
+        if len(senders_out) == 0:
+            senders_out.append("Secretary_Helen")
+        senders_out = [s for s in senders_out if s not in senders_in]
+    return senders_in, senders_out
+
+
+def reservoir_sample(items, count):
+    """Picks count items at random from an iterable of any length, keeping no
+    more than count of them at a time. The items are returned in the order
+    that they came in."""
+    reservoir = []
+    for index, item in enumerate(items):
+        if index < count:
+            reservoir.append((index, item))
+            continue
+        replace = random.randrange(index + 1)
+        if replace < count:
+            reservoir[replace] = (index, item)
+    return [item for _, item in sorted(reservoir, key=lambda pair: pair[0])]
+
+
+def message_hash(message):
+    """Hashes the text of a message or gib to a 64-bit integer, which is
+    what SQLite stores integers as, for finding identical text by index."""
+    return int.from_bytes(
+        hashlib.blake2b(message.encode(), digest_size=8).digest(),
+        'big',
+        signed=True,
+    )
+
+
+def _migration_message_index(conn):
+    """Index the text of chat messages for substring search.
+
+    Requires the FTS5 trigram tokenizer (SQLite 3.34+). If it isn't available
+    the index is skipped, and message searches will scan instead."""
+    c = conn.cursor()
+    try:
+        c.execute(
+            '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                message,
+                content='messages',
+                content_rowid='id',
+                tokenize='trigram'
+            )
+            '''
+        )
+    except sqlite3.OperationalError as error:
+        dbprint("Can't index messages: {}".format(error), True)
+        return
+    # Only chat messages are indexed
+    c.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert
+        AFTER INSERT ON messages WHEN new.kind='PRIVMSG'
+        BEGIN
+            INSERT INTO messages_fts (rowid, message)
+            VALUES (new.id, new.message);
+        END
+        '''
+    )
+    c.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete
+        AFTER DELETE ON messages WHEN old.kind='PRIVMSG'
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message)
+            VALUES ('delete', old.id, old.message);
+        END
+        '''
+    )
+    c.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update_old
+        AFTER UPDATE OF kind, message ON messages WHEN old.kind='PRIVMSG'
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message)
+            VALUES ('delete', old.id, old.message);
+        END
+        '''
+    )
+    c.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update_new
+        AFTER UPDATE OF kind, message ON messages WHEN new.kind='PRIVMSG'
+        BEGIN
+            INSERT INTO messages_fts (rowid, message)
+            VALUES (new.id, new.message);
+        END
+        '''
+    )
+    # Index the existing history
+    c.execute(
+        '''
+        DELETE FROM messages_fts
+        '''
+    )
+    c.execute(
+        '''
+        INSERT INTO messages_fts (rowid, message)
+        SELECT id, message FROM messages
+        WHERE kind='PRIVMSG'
+        '''
+    )
+
+
+def _migration_message_lowercase(conn):
+    """Add message_lc, a lowercased copy of each message for substring
+    search, computed by SQLite when it is read.
+
+    Requires generated columns (SQLite 3.31+). If they aren't available the
+    column is skipped, and searches will call lower() themselves."""
+    try:
+        conn.execute(
+            '''
+            ALTER TABLE messages ADD COLUMN message_lc TEXT
+                GENERATED ALWAYS AS (lower(message)) VIRTUAL
+            '''
+        )
+    except sqlite3.OperationalError as error:
+        dbprint("Lowercased messages are not available: {}".format(error))
+
+
+def _migration_title_index(conn):
+    """Index lowercased article titles and SCP numbers for substring search.
+
+    Requires the FTS5 trigram tokenizer (SQLite 3.34+). If it isn't available
+    the index is skipped, and title searches will scan instead."""
+    c = conn.cursor()
+    c.execute(
+        '''
+        SELECT name FROM pragma_table_info('articles')
+        WHERE name='title_lc'
+        '''
+    )
+    if c.fetchone() is None:
+        c.execute(
+            '''
+            ALTER TABLE articles ADD COLUMN title_lc TEXT
+            '''
+        )
+    # SQLite's lower() only knows ASCII
+    c.execute(
+        '''
+        SELECT id, title FROM articles
+        '''
+    )
+    c.executemany(
+        '''
+        UPDATE articles SET title_lc=? WHERE id=?
+        ''',
+        [
+            (None if title is None else title.lower(), id)
+            for id, title in c.fetchall()
+        ],
+    )
+    try:
+        c.execute(
+            '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING fts5(
+                title_lc,
+                scp_num,
+                content='articles',
+                content_rowid='id',
+                tokenize='trigram'
+            )
+            '''
+        )
+    except sqlite3.OperationalError as error:
+        dbprint("Can't index titles: {}".format(error), True)
+        return
+    c.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS articles_fts_insert
+        AFTER INSERT ON articles
+        BEGIN
+            INSERT INTO articles_fts (rowid, title_lc, scp_num)
+            VALUES (new.id, new.title_lc, new.scp_num);
+        END
+        '''
+    )
+    c.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS articles_fts_delete
+        AFTER DELETE ON articles
+        BEGIN
+            INSERT INTO articles_fts (articles_fts, rowid, title_lc, scp_num)
+            VALUES ('delete', old.id, old.title_lc, old.scp_num);
+        END
+        '''
+    )
+    c.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS articles_fts_update
+        AFTER UPDATE OF title_lc, scp_num ON articles
+        BEGIN
+            INSERT INTO articles_fts (articles_fts, rowid, title_lc, scp_num)
+            VALUES ('delete', old.id, old.title_lc, old.scp_num);
+            INSERT INTO articles_fts (rowid, title_lc, scp_num)
+            VALUES (new.id, new.title_lc, new.scp_num);
+        END
+        '''
+    )
+    c.execute(
+        '''
+        INSERT INTO articles_fts (articles_fts) VALUES ('rebuild')
+        '''
+    )
+
+
+def _migration_message_hashes(conn):
+    """Add a hash of the text of each chat message and each gib, so that
+    whether a gib has been said or gibbed before can be looked up."""
+    conn.create_function("message_hash", 1, message_hash, deterministic=True)
+    c = conn.cursor()
+    for table in ['messages', 'gibs']:
+        c.execute(
+            '''
+            SELECT name FROM pragma_table_info(?)
+            WHERE name='message_hash'
+            ''',
+            (table,),
+        )
+        if c.fetchone() is None:
+            c.execute(
+                "ALTER TABLE {} ADD COLUMN message_hash INTEGER".format(table)
+            )
+    c.execute(
+        '''
+        UPDATE messages SET message_hash=message_hash(message)
+        WHERE kind='PRIVMSG'
+        '''
+    )
+    c.execute(
+        '''
+        CREATE INDEX IF NOT EXISTS messages_message_hash
+            ON messages(message_hash) WHERE message_hash IS NOT NULL
+        '''
+    )
+    c.execute("UPDATE gibs SET message_hash=message_hash(message)")
+    c.execute(
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS gibs_message_hash
+            ON gibs(message_hash)
+        '''
+    )
+
+
+def _migration_message_urls(conn):
+    """Add a table of the links in chat messages, sorted into kinds, and fill
+    it from the messages that have been logged so far."""
+    c = conn.cursor()
+    c.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS message_urls (
+            message_id INTEGER NOT NULL
+                REFERENCES messages(id)
+                ON DELETE CASCADE
+                ON UPDATE CASCADE,
+            channel_id INTEGER
+                REFERENCES channels(id)
+                ON DELETE CASCADE
+                ON UPDATE CASCADE,
+            sender TEXT NOT NULL
+                COLLATE NOCASE,
+            url TEXT NOT NULL,
+            kind TEXT NOT NULL
+                CHECK (kind IN ({})),
+            PRIMARY KEY (message_id, url)
+        )
+        '''.format(
+            ",".join("'{}'".format(kind) for kind in KINDS)
+        )
+    )
+    c.execute(
+        '''
+        CREATE INDEX IF NOT EXISTS message_urls_channel_kind
+            ON message_urls(channel_id, kind, url)
+        '''
+    )
+    # message_lc is missing if SQLite was too old for generated columns
+    c.execute(
+        '''
+        SELECT name FROM pragma_table_info('messages')
+        WHERE name='message_lc'
+        '''
+    )
+    lowered = 'message_lc' if c.fetchone() is not None else 'lower(message)'
+    c.execute(
+        '''
+        SELECT id, channel_id, sender, message FROM messages
+        WHERE kind='PRIVMSG' AND command=0 AND ignore=0
+        AND instr({}, 'http')>0
+        '''.format(
+            lowered
+        )
+    )
+    inserts = conn.cursor()
+    for message in _stream(c):
+        inserts.executemany(
+            '''
+            INSERT OR IGNORE INTO message_urls
+                (message_id, channel_id, sender, url, kind)
+            VALUES ( ? , ? , ? , ? , ? )
+            ''',
+            [
+                (message[0], message[1], message[2], url, kind)
+                for url, kind in find_urls(message[3])
+            ],
+        )
 
 
-def _glob(expr, item):
-    """For evaluating db strings against a given string."""
-    if item is None:
-        return False
-    return expr.lower() in item.lower()
+# Numbered schema migrations, applied in order at startup after the tables have
+# been created. Each migration is applied exactly once and recorded in the
+# schema_version table. A migration is either an SQL script or a function that
+# accepts the connection; either way it must not commit, and should be written
+# so that it is safe to apply to a database that already has the change.
+# Never edit a migration that has been released - add a new one instead.
+MIGRATIONS = [
+    (
+        1,
+        "Add indexes for message, alias and article lookups",
+        '''
+        CREATE INDEX IF NOT EXISTS messages_channel_kind
+            ON messages(channel_id, kind, command, ignore, timestamp);
+        CREATE INDEX IF NOT EXISTS user_aliases_alias
+            ON user_aliases(alias, type);
+        CREATE INDEX IF NOT EXISTS user_aliases_user
+            ON user_aliases(user_id, type, most_recent);
+        CREATE INDEX IF NOT EXISTS articles_tags_tag
+            ON articles_tags(tag, article_id);
+        CREATE INDEX IF NOT EXISTS articles_authors_author
+            ON articles_authors(author, article_id);
+        CREATE INDEX IF NOT EXISTS articles_date_posted
+            ON articles(date_posted);
+        CREATE INDEX IF NOT EXISTS articles_parent
+            ON articles(parent);
+        ANALYZE;
+        ''',
+    ),
+    (2, "Add full-text index of chat messages", _migration_message_index),
+    (3, "Add trigram index of article titles", _migration_title_index),
+    (
+        4,
+        "Add lowercased copy of chat messages",
+        _migration_message_lowercase,
+    ),
+    (
+        5,
+        "Add summary of each sender's activity in each channel",
+        '''
+        CREATE TABLE IF NOT EXISTS user_channel_activity (
+            channel_id INTEGER NOT NULL
+                REFERENCES channels(id)
+                ON DELETE CASCADE
+                ON UPDATE CASCADE,
+            sender TEXT NOT NULL
+                COLLATE NOCASE,
+            first_id INTEGER NOT NULL,
+            first_timestamp INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            last_timestamp INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            PRIMARY KEY (channel_id, sender)
+        );
+        CREATE TRIGGER IF NOT EXISTS user_channel_activity_insert
+        AFTER INSERT ON messages
+        WHEN new.kind='PRIVMSG' AND new.channel_id IS NOT NULL
+        BEGIN
+            INSERT INTO user_channel_activity
+                (channel_id, sender, first_id, first_timestamp,
+                 last_id, last_timestamp, message_count)
+            VALUES (new.channel_id, new.sender, new.id, new.timestamp,
+                    new.id, new.timestamp, 1)
+            ON CONFLICT (channel_id, sender) DO UPDATE
+            SET last_id=excluded.last_id,
+                last_timestamp=excluded.last_timestamp,
+                message_count=message_count+1;
+        END;
+        DELETE FROM user_channel_activity;
+        INSERT INTO user_channel_activity
+            (channel_id, sender, first_id, first_timestamp,
+             last_id, last_timestamp, message_count)
+        SELECT channel_id, sender, MIN(id), 0, MAX(id), 0, COUNT(*)
+        FROM messages
+        WHERE kind='PRIVMSG' AND channel_id IS NOT NULL
+        GROUP BY channel_id, sender;
+        UPDATE user_channel_activity
+        SET first_timestamp=(
+                SELECT timestamp FROM messages WHERE id=first_id),
+            last_timestamp=(
+                SELECT timestamp FROM messages WHERE id=last_id);
+        ''',
+    ),
+    (6, "Add hashes of chat messages and gibs", _migration_message_hashes),
+    (7, "Add table of links in chat messages", _migration_message_urls),
+]
 
 
 # mark this file as the driver instead of pyaib.dbd.sqlite
@@ -80,28 +547,197 @@ def _glob(expr, item):
 class SqliteDriver:
     """SQLite3 database driver"""
 
+    # Logged messages are buffered and written in batches. The buffer is
+    # flushed after log_flush_interval seconds, or immediately once it holds
+    # log_batch_size messages. If the database is locked the messages are kept
+    # for the next attempt, but no more than log_buffer_limit are held in
+    # memory. A message that can't be written at all is dropped on its own.
+    log_flush_interval = 0.25
+    log_batch_size = 200
+    log_buffer_limit = 10000
+
+    # Queries run on threads so that a slow one doesn't hold up the event
+    # loop. Reads are shared between reader_threads threads, and writes are
+    # made in order by a single writer thread. The database is in WAL mode,
+    # so reads carry on while a write is in progress.
+    reader_threads = 4
+
     def __init__(self):
         path = CONFIG['db']['driver.database']['path']
         if not path:
             raise RuntimeError("Missing 'path' config for database driver")
+        self.path = path
+        # The process that the database threads run in
+        self._pid = os.getpid()
+        # The connection in use depends on the thread - see conn
+        self._local = monkey.get_original('threading', 'local')()
         try:
-            self.conn = sqlite3.connect(path)
+            self._writer_conn = sqlite3.connect(path, check_same_thread=False)
         except sqlite3.OperationalError as e:
             dbprint("The database could not be opened", True)
             raise
+        self._writer = gevent.threadpool.ThreadPool(1)
+        self._readers = gevent.threadpool.ThreadPool(self.reader_threads)
+        # Setting up happens on this thread, with the writer's connection
+        self._local.conn = self._writer_conn
+        self._local.writable = True
+        self.conn.execute("PRAGMA journal_mode = WAL")
         self.conn.execute("PRAGMA foreign_keys = 1")
         self._create_database()
         self.conn.row_factory = sqlite3.Row
         self.conn.create_function("REGEXP", 2, _regexp)
-        self.conn.create_function("GLOB", 2, _glob)
+        self._migrate_database()
+        self.messages_indexed = self._check_exists('messages_fts')
+        self.titles_indexed = self._check_exists('articles_fts')
+        self.messages_lowered = self._check_exists(
+            'messages.message_lc', 'column'
+        )
+        self._channel_ids = {}
+        # Who is who is answered from memory
+        self.identities = IdentityIndex()
+        self._load_identities()
+        # The hashes of every gib, to check new ones against
+        self._gib_hashes = set()
+        self._load_gib_hashes()
+        # Who is in each channel is tracked in memory as it changes, and
+        # only the changes are saved
+        self.members = ChannelMembership()
+        # Searches are answered from memory if the catalogue is enabled
+        self.catalogue = None
+        self._catalogue_lock = monkey.get_original('threading', 'Lock')()
+        self._refresh_lock = monkey.get_original('threading', 'Lock')()
+        # Articles that have changed since the catalogue was refreshed, and
+        # articles that have changed in writes that aren't committed yet
+        self._articles_changed = set()
+        self._articles_uncommitted = set()
+        self._search_statistics = None
+        if CONFIG['db'].get('catalogue', False):
+            self.load_catalogue()
+        self._log_buffer = []
+        self._log_flusher = None
+        # Messages still in the buffer at shutdown must not be lost
+        atexit.register(self._flush_at_exit)
         self.set_controller(CONFIG.owner)
+        # From now on, this thread has to hand queries to the others
+        del self._local.conn
 
+    @property
+    def conn(self):
+        """The connection for the database thread that is running."""
+        try:
+            return self._local.conn
+        except AttributeError:
+            raise RuntimeError(
+                "Database methods must be decorated with @_reads or @_writes"
+            ) from None
+
+    def _connect_reader(self):
+        """Opens a read-only connection to the database."""
+        uri = pathlib.Path(self.path).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True)
+        conn.row_factory = sqlite3.Row
+        conn.create_function("REGEXP", 2, _regexp)
+        return conn
+
+    def _dispatch(self, method, writes, args, kwargs):
+        """Runs a method on a reader thread or the writer thread, and waits
+        for the result without blocking other greenlets.
+
+        A method that is called by another method that is already running on
+        a database thread is run there directly, with the same connection, so
+        that it can see uncommitted changes."""
+        if os.getpid() != self._pid:
+            # The database threads aren't copied into a worker process, and
+            # the locks that they held when it was forked are never released
+            raise RuntimeError(
+                "{} cannot use the database from a worker process".format(
+                    method.__name__
+                )
+            )
+        if getattr(self._local, 'conn', None) is not None:
+            if writes and not self._local.writable:
+                raise RuntimeError(
+                    "{} cannot write from a reader thread".format(
+                        method.__name__
+                    )
+                )
+            return method(self, *args, **kwargs)
+        pool = self._writer if writes else self._readers
+        succeeded, result = pool.apply(
+            self._run, (method, writes, args, kwargs)
+        )
+        if not succeeded:
+            raise result
+        return result
+
+    def _run(self, method, writes, args, kwargs):
+        """Runs a method on the current database thread, connecting the
+        thread to the database first if it hasn't been yet.
+
+        Errors are returned rather than raised, so that the thread pool
+        doesn't report them before the caller has had a chance to."""
+        if getattr(self._local, 'conn', None) is None:
+            if writes:
+                self._local.conn = self._writer_conn
+            else:
+                self._local.conn = self._connect_reader()
+            self._local.writable = writes
+        try:
+            return True, method(self, *args, **kwargs)
+        except Exception as error:
+            return False, error
+        finally:
+            if writes:
+                self._note_committed_articles()
+
+    def _note_committed_articles(self):
+        """Passes the articles changed by writes that have now been committed
+        on to the catalogue. Run on the writer thread after each write.
+
+        Propagation adds articles without committing until it has finished,
+        and until then the catalogue and the reader threads must not see
+        them, or searches would find articles that can't be looked up."""
+        if self.conn.in_transaction or len(self._articles_uncommitted) == 0:
+            return
+        with self._catalogue_lock:
+            self._articles_changed.update(self._articles_uncommitted)
+        self._articles_uncommitted.clear()
+        self._search_statistics = None
+
+    @_writes
     def commit(self):
         """Just commits the database.
         For use by external functions after batch operations.
         To be used in conjuction with optional committing."""
         self.conn.commit()
 
+    def _begin_batch(self):
+        """Starts a batch of writes that succeeds or fails as a unit, and
+        returns a cursor for it.
+
+        Other writes on the writer's connection may be waiting to be
+        committed - propagation adds articles without committing until it
+        has finished, for example. A batch is made under a savepoint, so that
+        if it fails only its own changes are rolled back, and if it succeeds
+        only its own changes are committed, or none if others are waiting."""
+        c = self.conn.cursor()
+        c.execute("SAVEPOINT batch")
+        return c
+
+    def _commit_batch(self):
+        """Ends the batch of writes started by _begin_batch. If nothing else
+        was waiting to be committed, the batch is committed; otherwise it is
+        committed along with the rest."""
+        self.conn.execute("RELEASE batch")
+
+    def _roll_back_batch(self):
+        """Undoes the batch of writes started by _begin_batch, and nothing
+        else."""
+        # Some errors roll back the whole transaction by themselves
+        if self.conn.in_transaction:
+            self.conn.execute("ROLLBACK TO batch")
+            self.conn.execute("RELEASE batch")
+
     def _check_exists(self, name, type='table'):
         """Check if something exists in the database"""
         c = self.conn.cursor()
@@ -131,6 +767,15 @@ class SqliteDriver:
                 ''',
                 (type, name),
             )
+        elif type == 'column':
+            # name is table.column
+            c.execute(
+                '''
+                SELECT name FROM pragma_table_xinfo(?)
+                WHERE name=?
+                ''',
+                name.split(".", 1),
+            )
         else:
             raise AttributeError(
                 "Checking existence of {} of unknown type {}".format(
@@ -287,6 +932,82 @@ class SqliteDriver:
         # Will also need a messages table for each channel
         self.conn.commit()
 
+    def _migrate_database(self):
+        """Apply any migrations that the database does not yet have"""
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                date_applied INTEGER NOT NULL
+                    DEFAULT (CAST(STRFTIME('%s','now') AS INT))
+            )
+            '''
+        )
+        c.execute(
+            '''
+            SELECT MAX(version) FROM schema_version
+            '''
+        )
+        current_version = norm(c.fetchone()) or 0
+        for version, description, migration in MIGRATIONS:
+            if version <= current_version:
+                continue
+            dbprint("Applying migration {}: {}".format(version, description))
+            try:
+                if callable(migration):
+                    c.execute("BEGIN")
+                    migration(self.conn)
+                else:
+                    # executescript commits before it starts, so the
+                    # transaction has to be opened by the script itself
+                    c.executescript("BEGIN;\n" + migration)
+                c.execute(
+                    '''
+                    INSERT INTO schema_version (version, description)
+                    VALUES ( ? , ? )
+                    ''',
+                    (version, description),
+                )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                dbprint("Migration {} failed".format(version), True)
+                raise
+            current_version = version
+
+    @_reads
+    def get_schema_version(self):
+        """Gets the version of the most recently applied migration"""
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            SELECT MAX(version) FROM schema_version
+            '''
+        )
+        return norm(c.fetchone()) or 0
+
+    @_writes
+    def _load_identities(self):
+        """Loads the identity index from the database."""
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            SELECT user_id, alias, type, weight, most_recent
+            FROM user_aliases ORDER BY rowid
+            '''
+        )
+        aliases = c.fetchall()
+        c.execute(
+            '''
+            SELECT id FROM users WHERE controller=1
+            '''
+        )
+        controllers = [row['id'] for row in c.fetchall()]
+        self.identities.load(aliases, controllers)
+
+    @_writes
     def issue(self, query, callback=None, **kwargs):
         """For accepting refactoring (commands/refactor.py)
         Pass commit=False for no commit"""
@@ -306,11 +1027,15 @@ class SqliteDriver:
                     ret += str(result[key]) + " "
         elif kwargs.get('commit', True):
             self.conn.commit()
+        if not query.startswith("SELECT"):
+            # Anything could have changed
+            self._load_identities()
         if callback is not None:
             callback(ret)
         else:
             return ret
 
+    @_writes
     def join_channel(self, channel):
         """Populate a new channel in the database"""
         c = self.conn.cursor()
@@ -335,6 +1060,7 @@ class SqliteDriver:
         self.conn.commit()
         dbprint("Joined {}".format(channel))
 
+    @_writes
     def leave_channel(self, channel):
         """Leave a channel"""
         c = self.conn.cursor()
@@ -349,6 +1075,7 @@ class SqliteDriver:
         self.conn.commit()
         dbprint("Left {}".format(channel))
 
+    @_reads
     def get_autojoins(self):
         """Get all channels that the bot was in last time"""
         c = self.conn.cursor()
@@ -360,6 +1087,7 @@ class SqliteDriver:
         )
         return [r['channel_name'] for r in c.fetchall()]
 
+    @_reads
     def get_all_tables(self):
         """Returns a list of all tables"""
         c = self.conn.cursor()
@@ -371,6 +1099,7 @@ class SqliteDriver:
         # convert list of tuples to list of strings
         return [row['name'] for row in c.fetchall()]
 
+    @_reads
     def print_one_table(self, table):
         """Pretty print a single table"""
         try:
@@ -384,6 +1113,7 @@ class SqliteDriver:
             # fail silently so that users can't see what channels exist
             print("The table {} does not exist.".format(table))
 
+    @_reads
     def print_selection(self, query, string=False):
         """Pretty print a selection"""
         try:
@@ -397,6 +1127,7 @@ class SqliteDriver:
             dbprint("There was a problem with the selection statement.", True)
             raise
 
+    @_reads
     def get_all_users(self):
         """Returns a list of all users"""
         # For now, just return aliases
@@ -409,6 +1140,7 @@ class SqliteDriver:
         )
         return [r['alias'] for r in c.fetchall()]
 
+    @_reads
     def get_messages(
         self,
         channels,
@@ -418,9 +1150,103 @@ class SqliteDriver:
         contains=None,
         minlength=None,
         limit=-1,
+        after=None,
+        before=None,
+        sample=False,
     ):
         """Returns all messages from the channel by the user.\
-        user, sender, pattern, contains should be lists (and channel can be)."""
+        user, sender, pattern, contains should be lists (and channel can be).
+        after is the ID of a message that the messages must be newer than, and
+        before is the ID of one that they must be no newer than.
+
+        If sample is True, limit messages are picked at random from all of
+        those that match, rather than the most recent, and are returned most
+        recent first. The messages are read a chunk at a time, so only the
+        ones that are picked are ever kept in memory."""
+        assert isinstance(limit, int)
+        assert isinstance(sample, bool)
+        c = self._search_messages(
+            channels,
+            users,
+            senders,
+            patterns,
+            contains,
+            minlength,
+            -1 if sample else limit,
+            after,
+            before,
+        )
+        messages = (row['message'] for row in _stream(c))
+        if sample and limit >= 0:
+            return reservoir_sample(messages, limit)
+        return list(messages)
+
+    @_reads
+    def get_random_url(self, channels, kind, senders=None):
+        """Picks a link of a kind (see urls.KINDS) at random from the
+        messages in the channels. senders is as for get_messages.
+
+        Returns the link and how many different links of that kind there
+        are, or None if there aren't any."""
+        assert kind in KINDS
+        if not isinstance(channels, list):
+            channels = [channels]
+        channels = [self._get_channel_id(channel) for channel in channels]
+        channels = [channel for channel in channels if channel is not None]
+        senders_in, senders_out = _split_senders(senders)
+        where = "channel_id IN ({}) AND kind=?".format(
+            ",".join("?" * len(channels))
+        )
+        parameters = [*channels, kind]
+        if len(senders_in) > 0:
+            where += " AND sender IN ({})".format(
+                ",".join("?" * len(senders_in))
+            )
+            parameters.extend(senders_in)
+        if len(senders_out) > 0:
+            where += " AND sender NOT IN ({})".format(
+                ",".join("?" * len(senders_out))
+            )
+            parameters.extend(senders_out)
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            SELECT COUNT(DISTINCT url) FROM message_urls WHERE {}
+            '''.format(
+                where
+            ),
+            parameters,
+        )
+        count = norm(c.fetchone())
+        if count == 0:
+            return None
+        # Walks the index to a random link rather than sorting them all
+        c.execute(
+            '''
+            SELECT DISTINCT url FROM message_urls WHERE {}
+            ORDER BY url LIMIT 1 OFFSET ?
+            '''.format(
+                where
+            ),
+            (*parameters, random.randrange(count)),
+        )
+        return norm(c.fetchone()), count
+
+    def _search_messages(
+        self,
+        channels,
+        users=None,
+        senders=None,
+        patterns=None,
+        contains=None,
+        minlength=None,
+        limit=-1,
+        after=None,
+        before=None,
+    ):
+        """Starts a search for messages, as for get_messages, and returns the
+        cursor that they can be fetched from. Must be called from a method
+        that is already running on a database thread."""
         c = self.conn.cursor()
         print("Getting messages")
         # TODO make this lookup all names of a user and do an IN check
@@ -435,56 +1261,107 @@ class SqliteDriver:
         assert isinstance(contains, (list, type(None)))
         assert isinstance(minlength, (int, type(None)))
         assert isinstance(limit, int)
+        assert isinstance(after, (int, type(None)))
+        assert isinstance(before, (int, type(None)))
+        # Channel IDs never change, so they don't need to be looked up
+        channels = [self._get_channel_id(channel) for channel in channels]
+        channels = [channel for channel in channels if channel is not None]
+        # if user is not None: TODO
+        #     q = q.where(messages.sender == user)
+        senders_in, senders_out = _split_senders(senders)
+        q, parameters = compile_message_search(
+            channels,
+            senders_in,
+            senders_out,
+            [] if nonelist(patterns) else patterns,
+            [] if nonelist(contains) else contains,
+            minlength,
+            limit,
+            after,
+            before,
+            indexed=self.messages_indexed,
+            lowered=self.messages_lowered,
+        )
+        print("Getting messages:", q)
+        c.execute(q, parameters)
+        return c
+
+    @_reads
+    def get_newest_message_id(self, channels):
+        """Gets the ID of the most recent message in any of the channels that
+        get_messages would return, or None if there aren't any."""
+        if not isinstance(channels, list):
+            channels = [channels]
+        channels = [self._get_channel_id(channel) for channel in channels]
+        channels = [channel for channel in channels if channel is not None]
+        c = self.conn.cursor()
+        # One lookup of the index per channel, rather than a scan
         c.execute(
             '''
-            SELECT id FROM channels
-            WHERE channel_name IN ({})
+            SELECT MAX((
+                SELECT id FROM messages
+                WHERE channel_id=channels.id
+                AND kind='PRIVMSG' AND command=0 AND ignore=0
+                ORDER BY timestamp DESC, id DESC LIMIT 1
+            )) AS newest
+            FROM channels WHERE id IN ({})
             '''.format(
-                ",".join(["?"] * len(channels))
+                ",".join("?" * len(channels))
             ),
             channels,
         )
-        channels = [row['id'] for row in c.fetchall()]
-        if None in channels:
-            raise ValueError("That channel does not exist")
-        messages = Table('messages')
-        q = MySQLQuery.from_(messages).select(messages.message)
-        q = q.where(messages.channel_id.isin(channels))
-        q = q.where(messages.command == 0)
-        q = q.where(messages.kind == 'PRIVMSG')
-        q = q.where(messages.ignore == 0)
-        # if user is not None: TODO
-        #     q = q.where(messages.sender == user)
-        if not nonelist(senders):
-            senders_in = [
-                s.lstrip("+") for s in senders if not s.startswith("-")
-            ]
-            senders_out = [s.lstrip("-") for s in senders if s.startswith("-")]
-            if len(senders_out) == 0:
-                senders_out.append("Secretary_Helen")
-            senders_out = [s for s in senders_out if s not in senders_in]
-            if len(senders_in):
-                q = q.where(messages.sender.isin(senders_in))
-            if len(senders_out):
-                q = q.where(messages.sender.notin(senders_out))
-        if not nonelist(patterns):
-            for pattern in patterns:
-                q = q.where(messages.message.regex(pattern))
-        if not nonelist(contains):
-            for contain in contains:
-                q = q.where(messages.message.like(contain))
-        if minlength is not None:
-            q = q.where(Length(messages.message) >= minlength)
-        q = q.orderby(messages.timestamp, order=Order.desc)
-        if limit >= 0:
-            q = q[:limit]
-        q = str(q).replace(" LIKE ", " GLOB ").replace(" REGEX ", " REGEXP ")
-        print("Getting messages:", str(q))
-        c.execute(str(q))
-        result = c.fetchall()
-        messages = [m['message'] for m in result]
-        return messages
+        return c.fetchone()['newest']
+
+    @_reads
+    def search_messages(self, channel, terms, limit=3, exclude=None):
+        """Search a channel's chat history for messages that contain all of
+        the terms. Not case-sensitive.
+
+        list exclude: Nicks whose messages should not be searched.
+
+        Returns the matching messages as rows, most recent first."""
+        assert channel.startswith('#')
+        assert isinstance(terms, list) and len(terms) > 0
+        exclude = exclude or []
+        c = self.conn.cursor()
+        query = '''
+            SELECT sender, timestamp, message FROM messages
+            WHERE channel_id=(SELECT id FROM channels
+                              WHERE channel_name=?)
+            AND kind='PRIVMSG' AND command=0 AND ignore=0
+            AND sender NOT IN ({})
+            '''.format(
+            ",".join(["?"] * len(exclude))
+        )
+        params = [channel, *exclude]
+        index_query = fts_query(terms)
+        if self.messages_indexed and index_query is not None:
+            query += '''
+            AND id IN (SELECT rowid FROM messages_fts
+                       WHERE messages_fts MATCH ?)
+            '''
+            params.append(index_query)
+        # The index can't check terms shorter than 3 characters
+        if self.messages_lowered:
+            message_lc = "message_lc"
+        else:
+            message_lc = "lower(message)"
+        for term in terms:
+            if term.isascii():
+                query += "AND instr({}, ?) > 0\n".format(message_lc)
+                params.append(term.lower())
+            else:
+                query += "AND message REGEXP ?\n"
+                params.append(re.escape(term))
+        query += '''
+            ORDER BY id DESC
+            LIMIT ?
+            '''
+        params.append(limit)
+        c.execute(query, params)
+        return c.fetchall()
 
+    @_reads
     def get_most_recent_message(self, channel):
         """Get the ID of the most recent message in a channel."""
         assert channel.startswith('#')
@@ -500,6 +1377,7 @@ class SqliteDriver:
         )
         return int(c.fetchone()['MAX(id)'])
 
+    @_reads
     def get_messages_between(self, channel, start, end):
         """Get all messages between 2 ids in a channel, inclusive."""
         assert channel.startswith('#')
@@ -517,6 +1395,7 @@ class SqliteDriver:
         rows = c.fetchall()
         return rows
 
+    @_reads
     def get_messages_to_command_limit(self, channel, limit):
         """Get all messages from most recent up to the specified number of
         commands"""
@@ -541,18 +1420,53 @@ class SqliteDriver:
         )
         return [m['message'] for m in c.fetchall()]
 
+    @_writes
     def add_gib(self, gib):
         """Add a gib"""
         c = self.conn.cursor()
         c.execute(
             '''
-            INSERT OR REPLACE INTO gibs( message )
-            VALUES( ? )
+            INSERT OR REPLACE INTO gibs( message, message_hash )
+            VALUES( ? , ? )
             ''',
-            (gib,),
+            (gib, message_hash(gib)),
         )
         self.conn.commit()
+        self._gib_hashes.add(message_hash(gib))
+
+    def is_gibbed(self, sentence):
+        """Checks whether a sentence has been gibbed before."""
+        return message_hash(sentence) in self._gib_hashes
+
+    @_reads
+    def get_said(self, sentences):
+        """Gets which of a list of sentences have been said in any channel."""
+        if len(sentences) == 0:
+            return set()
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            SELECT message FROM messages
+            WHERE message_hash IN ({0}) AND message IN ({0})
+            '''.format(
+                ",".join("?" * len(sentences))
+            ),
+            [message_hash(sentence) for sentence in sentences] + sentences,
+        )
+        return {row['message'] for row in c.fetchall()}
+
+    @_reads
+    def _load_gib_hashes(self):
+        """Loads the hashes of every gib."""
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            SELECT message_hash FROM gibs
+            '''
+        )
+        self._gib_hashes = {row['message_hash'] for row in c.fetchall()}
 
+    @_reads
     def get_gibs(self):
         """Return all previous gibs"""
         c = self.conn.cursor()
@@ -566,44 +1480,43 @@ class SqliteDriver:
     def get_aliases(self, nick):
         """Returns all of someone's aliases
         nick can be an alias or an ID"""
-        c = self.conn.cursor()
         if nick is None:
-            c.execute(
-                '''
-                SELECT alias FROM user_aliases
-                '''
-            )
-            return [row['alias'] for row in c.fetchall()]
+            return self.identities.aliases()
         if isinstance(nick, int):
             ids = [nick]
         else:
-            c.execute(
-                '''
-                SELECT user_id FROM user_aliases
-                WHERE alias=?
-                ''',
-                (nick,),
-            )
-            ids = c.fetchall()
+            ids = self.identities.user_ids(nick)
         if len(ids) == 0:
             return None
         else:
             result = []
-            # list of lists
             for id in ids:
-                c.execute(
-                    '''
-                    SELECT alias FROM user_aliases
-                    WHERE user_id=?
-                    ''',
-                    (id,),
-                )
-                result.extend(c.fetchall())
-            return [row['alias'] for row in result]
+                result.extend(self.identities.aliases(id))
+            return result
 
     def get_channel_members(self, channel):
         """Returns a list of all user possible nicks currently in a channel
         Not limited to actual channel nick list - see get_occupants"""
+        members = self.members.members(channel)
+        if members is None:
+            # Not a channel the bot is in - go with what was saved last
+            ids = self._get_stored_member_ids(channel)
+        else:
+            ids = dict.fromkeys(
+                id
+                for nick, _ in members
+                for id in self.identities.user_ids(nick, type='irc')
+            )
+        # then get the aliases of those ids
+        return [
+            alias
+            for id in ids
+            for alias in self.identities.aliases(id, type='irc')
+        ]
+
+    @_reads
+    def _get_stored_member_ids(self, channel):
+        """Gets the IDs of the users saved as being in a channel."""
         # TODO exhaustive most_recent checking
         c = self.conn.cursor()
         # get all ids in channel
@@ -616,19 +1529,9 @@ class SqliteDriver:
             ''',
             (channel,),
         )
-        ids = [row['user_id'] for row in c.fetchall()]
-        # then get the aliases of those ids
-        c.execute(
-            '''
-            SELECT alias FROM user_aliases
-            WHERE user_id IN ({}) AND type='irc'
-            '''.format(
-                ','.join(['?'] * len(ids))
-            ),
-            [str(id) for id in ids],
-        )
-        return [row['alias'] for row in c.fetchall()]
+        return [row['user_id'] for row in c.fetchall()]
 
+    @_reads
     def get_generic_id(self, search):
         """Returns from users, channels, articles"""
         c = self.conn.cursor()
@@ -676,6 +1579,33 @@ class SqliteDriver:
         """
         if channel[0] != '#':
             raise ValueError("Channel name must start with #.")
+        members = self.members.members(channel)
+        if members is None:
+            # Not a channel the bot is in - go with what was saved last
+            users = self._get_stored_occupants(channel)
+            if convert_to_nicks:
+                users = [
+                    (self.get_current_nick(id), mode) for id, mode in users
+                ]
+        elif convert_to_nicks:
+            users = members
+        else:
+            users = [
+                (id, mode)
+                for nick, mode in members
+                for id in self.identities.user_ids(nick, type='irc')
+            ]
+        dbprint("get_occupants: users is {}".format(",".join(map(str, users))))
+        assert len(users) > 0, "There are no users in {}.".format(channel)
+        if levels:
+            return users
+        else:
+            return [u[0] for u in users]
+
+    @_reads
+    def _get_stored_occupants(self, channel):
+        """Gets the (user_id, user_mode) of the users saved as being in a
+        channel."""
         c = self.conn.cursor()
         # find out the channel id
         c.execute(
@@ -693,40 +1623,18 @@ class SqliteDriver:
             ''',
             (id,),
         )
-        users = [(r['user_id'], r['user_mode']) for r in c.fetchall()]
-        dbprint("get_occupants: users is {}".format(",".join(map(str, users))))
-        assert len(users) > 0, "There are no users in {}.".format(channel)
-        if convert_to_nicks:
-            users = [(self.get_current_nick(id), mode) for id, mode in users]
-        if levels:
-            return users
-        else:
-            return [u[0] for u in users]
+        return [(r['user_id'], r['user_mode']) for r in c.fetchall()]
 
     def get_current_nick(self, id):
         """Gets the current nick of a user."""
-        c = self.conn.cursor()
-        c.execute(
-            '''
-            SELECT alias FROM user_aliases
-            WHERE most_recent=1 AND user_id=? AND type='irc'
-            ''',
-            (id,),
-        )
-        name = norm(c.fetchone())
+        name = self.identities.most_recent(id)
         if name:
             return name
         else:
-            c.execute(
-                '''
-                SELECT alias FROM user_aliases
-                WHERE user_id=?
-                ''',
-                (id,),
-            )
-            name = random.choice(norm(c.fetchall()))
+            name = random.choice(self.identities.aliases(id))
             return "??{}".format(name)
 
+    @_reads
     def get_all_channels(self):
         c = self.conn.cursor()
         c.execute(
@@ -739,17 +1647,13 @@ class SqliteDriver:
 
     def get_controllers(self):
         """Gets bot controllers"""
-        c = self.conn.cursor()
-        c.execute(
-            '''
-            SELECT alias FROM user_aliases
-            WHERE user_id IN (SELECT id FROM users
-                              WHERE controller=1)
-                  AND type='irc'
-            '''
-        )
-        return [row['alias'] for row in c.fetchall()]
+        return [
+            alias
+            for id in self.identities.controllers
+            for alias in self.identities.aliases(id, type='irc')
+        ]
 
+    @_writes
     def set_controller(self, user):
         if isinstance(user, str):
             id = self.get_user_id(user)
@@ -763,19 +1667,13 @@ class SqliteDriver:
             (id,),
         )
         self.conn.commit()
+        if id is not None:
+            self.identities.controllers.add(id)
         print("Added {} as controller".format(user))
 
     def get_user_id(self, alias):
         """Get the user id from the alias"""
-        c = self.conn.cursor()
-        c.execute(
-            '''
-            SELECT user_id FROM user_aliases
-            WHERE alias=? AND type='irc'
-            ''',
-            (alias,),
-        )
-        ids = [row['user_id'] for row in c.fetchall()]
+        ids = self.identities.user_ids(alias, type='irc')
         if len(ids) == 0:
             return None
         elif len(ids) == 1:
@@ -783,6 +1681,7 @@ class SqliteDriver:
         else:
             raise Exception("More than one ID for alias {}".format(alias))
 
+    @_writes
     def sort_names(self, channel, names):
         """Sort the results of a NAMES query.
 
@@ -794,51 +1693,176 @@ class SqliteDriver:
             dbprint("{} does not exist, creating".format(channel), True)
             self.join_channel(channel)
         # names is a list of objects {nick, mode}
-        # 1. add new users and user_aliases
-        for name in names:
-            name['id'] = self.add_user(name['nick'])
-        # 2. add NAMES to channels_users
-        c = self.conn.cursor()
-        c.execute(
-            '''
-            SELECT id FROM channels WHERE channel_name=?
-            ''',
-            (channel,),
-        )
-        channel = norm(c.fetchone())
+        # The whole list is handled at once in a single transaction
+        channel = self._get_channel_id(channel)
         assert isinstance(channel, int)
-        # need to delete old NAMES data for this channel
-        # (may want to waive this in the future for single user changes)
-        c.execute(
-            '''
-            DELETE FROM channels_users
-            WHERE channel_id=?
-            AND date_checked < CAST(STRFTIME('%s','now') AS INT) - 60
-            ''',
-            (channel,),
-        )
-        # then add new NAMES data
-        for name in names:
+        c = self._begin_batch()
+        try:
+            # 1. stage the NAMES list
             c.execute(
                 '''
-                INSERT OR REPLACE INTO channels_users
-                    (channel_id, user_id, user_mode)
-                VALUES( ? , ? , ? )
+                CREATE TEMP TABLE IF NOT EXISTS names_staging (
+                    nick TEXT NOT NULL PRIMARY KEY
+                        COLLATE NOCASE,
+                    mode CHARACTER(1),
+                    new_user_id INTEGER
+                )
+                '''
+            )
+            c.execute("DELETE FROM names_staging")
+            c.executemany(
+                '''
+                INSERT OR REPLACE INTO names_staging (nick, mode)
+                VALUES ( ? , ? )
                 ''',
-                (channel, name['id'], name['mode']),
+                [(name['nick'], name['mode']) for name in names],
             )
-        # 3. updates in channels when this channel was last checked
-        c.execute(
-            '''
-            UPDATE channels
-            SET date_checked=CURRENT_TIMESTAMP
-            WHERE id=?
-            ''',
-            (channel,),
-        )
-        # 4. TODO what else needs to be done?
-        self.conn.commit()
+            # 2. add new users and user_aliases for nicks that have none
+            # (IDs are given by replacing the staged rows, as UPDATE ... FROM
+            # needs SQLite 3.33+)
+            c.execute(
+                '''
+                INSERT OR REPLACE INTO names_staging (nick, mode, new_user_id)
+                SELECT nick, mode,
+                    (SELECT IFNULL(MAX(id), 0) FROM users)
+                    + ROW_NUMBER() OVER (ORDER BY nick)
+                FROM names_staging
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM user_aliases
+                    WHERE alias=names_staging.nick AND type='irc'
+                )
+                '''
+            )
+            c.execute(
+                '''
+                INSERT INTO users (id)
+                SELECT new_user_id FROM names_staging
+                WHERE new_user_id IS NOT NULL
+                '''
+            )
+            c.execute(
+                '''
+                INSERT INTO user_aliases (alias, type, user_id)
+                SELECT nick, 'irc', new_user_id FROM names_staging
+                WHERE new_user_id IS NOT NULL
+                '''
+            )
+            c.execute(
+                '''
+                SELECT nick, new_user_id FROM names_staging
+                WHERE new_user_id IS NOT NULL
+                '''
+            )
+            for row in c.fetchall():
+                self.identities.add(row['new_user_id'], row['nick'])
+            # 3. replace the channel's NAMES data
+            # (names is the whole NAMES list, so nothing else is still valid)
+            c.execute(
+                '''
+                DELETE FROM channels_users
+                WHERE channel_id=? AND user_id NOT IN (
+                    SELECT user_aliases.user_id FROM names_staging
+                    JOIN user_aliases
+                        ON user_aliases.alias=names_staging.nick
+                        AND user_aliases.type='irc'
+                )
+                ''',
+                (channel,),
+            )
+            c.execute(
+                '''
+                INSERT INTO channels_users (channel_id, user_id, user_mode)
+                SELECT DISTINCT ?, user_aliases.user_id, names_staging.mode
+                FROM names_staging
+                JOIN user_aliases
+                    ON user_aliases.alias=names_staging.nick
+                    AND user_aliases.type='irc'
+                WHERE true
+                ON CONFLICT (channel_id, user_id) DO UPDATE
+                SET user_mode=excluded.user_mode,
+                    date_checked=excluded.date_checked
+                ''',
+                (channel,),
+            )
+            # 4. updates in channels when this channel was last checked
+            c.execute(
+                '''
+                UPDATE channels
+                SET date_checked=CURRENT_TIMESTAMP
+                WHERE id=?
+                ''',
+                (channel,),
+            )
+            self._commit_batch()
+        except Exception:
+            self._roll_back_batch()
+            # Users may have been added to the index but not the db
+            self._load_identities()
+            raise
 
+    @_writes
+    def save_members(self, changes):
+        """Saves changes to who is in which channel.
+
+        list changes: [(channel, nick)] as returned by ChannelMembership. What
+        is saved for each nick is whatever the membership now says about it.
+        """
+        by_channel = {}
+        for channel, nick in changes:
+            by_channel.setdefault(channel, []).append(nick)
+        c = self._begin_batch()
+        try:
+            for channel, nicks in by_channel.items():
+                channel_id = self._get_channel_id(channel)
+                if channel_id is None:
+                    continue
+                present = {
+                    nocase(nick): mode
+                    for nick, mode in self.members.members(channel) or []
+                }
+                # Someone can be in a channel under more than one nick, and
+                # stays in it until the last one leaves
+                present_ids = {
+                    id
+                    for nick in present
+                    for id in self.identities.user_ids(nick, type='irc')
+                }
+                for nick in nicks:
+                    if nocase(nick) not in present:
+                        for id in self.identities.user_ids(nick, type='irc'):
+                            if id in present_ids:
+                                continue
+                            c.execute(
+                                '''
+                                DELETE FROM channels_users
+                                WHERE channel_id=? AND user_id=?
+                                ''',
+                                (channel_id, id),
+                            )
+                        continue
+                    ids = self.identities.user_ids(nick, type='irc')
+                    if len(ids) == 0:
+                        ids = [self.add_user(nick, commit=False)]
+                    for id in ids:
+                        c.execute(
+                            '''
+                            INSERT INTO channels_users
+                                (channel_id, user_id, user_mode)
+                            VALUES ( ? , ? , ? )
+                            ON CONFLICT (channel_id, user_id) DO UPDATE
+                            SET user_mode=excluded.user_mode,
+                                date_checked=excluded.date_checked
+                            ''',
+                            (channel_id, id, present[nocase(nick)]),
+                        )
+            self._commit_batch()
+        except Exception:
+            self._roll_back_batch()
+            # Users may have been added to the index but not the db
+            self._load_identities()
+            raise
+
+    @_reads
     def get_last_sort(self, channel):
         """Get the time at which the channel's names were last sorted"""
         c = self.conn.cursor()
@@ -851,53 +1875,55 @@ class SqliteDriver:
         )
         return c.fetchone()['date_checked']
 
-    def add_user(self, alias, type='irc'):
+    def add_user(self, alias, type='irc', commit=True):
         """Adds/updates a user and returns their ID"""
-        c = self.conn.cursor()
-        c.execute(
-            '''
-            SELECT user_id FROM user_aliases
-            WHERE alias=? AND type=?
-            ''',
-            (alias, type),
-        )
-        result = c.fetchall()
+        result = self.identities.user_ids(alias, type=type)
         if result:
             # this alias already exists
             if len(result) == 1:
                 # dbprint("User {} already exists as ID {}"
                 #         .format(nickColor(alias), norm(result)[0]))
                 # unambiguous user, yay!
-                # result = [(3,)] - we only want the number
-                return norm(result)[0]
+                return result[0]
             else:
                 # BIG PROBLEM
                 # TODO
                 dbprint("USER {} IS AMBIGUOUS".format(alias), True)
                 return result
         else:
-            # this alias does not already exist
-            # 1. create a new user
-            c.execute(
-                '''
-                INSERT INTO users DEFAULT VALUES
-                '''
-            )
-            new_user_id = c.lastrowid
-            # dbprint("Adding user {} as ID {}"
-            #         .format(nickColor(alias), new_user_id))
-            # 2. add the alias
-            # 2.1 mark the previous alias as not current
-            c.execute(
-                '''
-                INSERT INTO user_aliases (alias, type, user_id)
-                VALUES ( ? , ? , ? )
-                ''',
-                (alias, type, new_user_id),
-            )
+            return self._insert_user(alias, type, commit)
+
+    @_writes
+    def _insert_user(self, alias, type, commit):
+        """Creates a new user with an alias and returns their ID"""
+        # Someone else may have added them while this was waiting its turn
+        result = self.identities.user_ids(alias, type=type)
+        if result:
+            return result[0]
+        c = self.conn.cursor()
+        # 1. create a new user
+        c.execute(
+            '''
+            INSERT INTO users DEFAULT VALUES
+            '''
+        )
+        new_user_id = c.lastrowid
+        # dbprint("Adding user {} as ID {}"
+        #         .format(nickColor(alias), new_user_id))
+        # 2. add the alias
+        c.execute(
+            '''
+            INSERT INTO user_aliases (alias, type, user_id)
+            VALUES ( ? , ? , ? )
+            ''',
+            (alias, type, new_user_id),
+        )
+        self.identities.add(new_user_id, alias, type)
+        if commit:
             self.conn.commit()
-            return new_user_id
+        return new_user_id
 
+    @_writes
     def add_alias(self, user, alias, weight=0, nick_type='irc'):
         """Adds or updates an alias to a user
         Returns bool if the user/alias combo already existed."""
@@ -926,23 +1952,21 @@ class SqliteDriver:
                 ''',
                 (user, nick_type),
             )
+            self.identities.mark_most_recent(user, None, nick_type, weight=0)
+        most_recent = not weight if nick_type == 'irc' else 0
         c.execute(
             '''
             INSERT OR REPLACE INTO user_aliases
                   (user_id, alias, type, weight, most_recent)
             VALUES ( ? , ? , ? , ? , ? )
             ''',
-            (
-                user,
-                alias,
-                nick_type,
-                weight,
-                (not weight if nick_type is 'irc' else 0),
-            ),
+            (user, alias, nick_type, weight, most_recent),
         )
+        self.identities.add(user, alias, nick_type, weight, most_recent)
         self.conn.commit()
         return combo_exists
 
+    @_writes
     def remove_alias(self, user, alias, weight=None, nick_type='irc'):
         """Removes an alias from a user
         Returns bool if the user/alias combo already existed."""
@@ -966,9 +1990,11 @@ class SqliteDriver:
             ''',
             (user, alias, nick_type),
         )
+        self.identities.remove(user, alias, nick_type)
         self.conn.commit()
         return combo_exists
 
+    @_writes
     def set_wikiname(self, user, wikiname):
         """Sets a user's wikiname."""
         assert isinstance(user, int)
@@ -988,8 +2014,11 @@ class SqliteDriver:
             ''',
             (user, wikiname,),
         )
+        self.identities.remove(user, type='wiki')
+        self.identities.add(user, wikiname, 'wiki')
         self.conn.commit()
 
+    @_reads
     def get_wikiname(self, user):
         """Gets a user's wikiname or None."""
         assert isinstance(user, int)
@@ -1006,6 +2035,7 @@ class SqliteDriver:
             return None
         return row['alias']
 
+    @_reads
     def get_wikiname_owner(self, wikiname):
         """Check who owns a wikiname. Returns their ID or None."""
         c = self.conn.cursor()
@@ -1021,6 +2051,7 @@ class SqliteDriver:
             return None
         return row['user_id']
 
+    @_writes
     def __rename_user(self, old, new, force=False):
         """Adds a new alias for a user"""
         # when a user renames, add the new nick at weight 0
@@ -1092,6 +2123,7 @@ class SqliteDriver:
                     (old_result, new, 'irc'),
                 )
                 self.conn.commit()
+                self._load_identities()
             else:
                 # both nicks are associated with different users
                 # what the fuck do we do here??
@@ -1119,10 +2151,12 @@ class SqliteDriver:
                         (new_result, new, 'irc'),
                     )
                     self.conn.commit()
+                    self._load_identities()
                 else:
                     # prompt the user for confirmation?
                     pass
 
+    @_writes
     def rename_user(self, old_nick, new_nick, nick_type='irc'):
         """Handle a user changing their name.
         This process operates at weight 0."""
@@ -1202,7 +2236,10 @@ class SqliteDriver:
 
     def log_message(self, msg):
         """Logs a message in the db.
-        inp should be either a message object or equivalent dict"""
+        inp should be either a message object or equivalent dict
+
+        The message is not written immediately, but added to a buffer that is
+        committed in batches - see flush_messages."""
         if isinstance(msg, Message):
             msg = {
                 'channel': msg.raw_channel,
@@ -1223,59 +2260,174 @@ class SqliteDriver:
             msgiscmd = msg['message'].startswith((".", "!", "?", "^"))
         else:
             msgiscmd = False
-        c = self.conn.cursor()
-        # log this message into the messages table
+        # Resolve the channel now so that a bad message is reported to the
+        # caller rather than failing the whole batch later
+        channel = None
         if chname is not None:
-            c.execute(
-                '''
-                SELECT id FROM channels
-                WHERE channel_name=?
-                ''',
-                (chname,),
-            )
-            channel = norm(c.fetchone())
+            channel = self._get_channel_id(chname)
             assert isinstance(channel, int), "chname {} id {}".format(
                 chname, channel
             )
-        c.execute(
-            '''
-            INSERT INTO messages
-                (channel_id, kind, sender, timestamp, message, command)
-            VALUES ( ? , ? , ? , ? , ? , ? )
-            ''',
-            (
-                channel if msg['kind'] != 'NICK' else None,
-                msg['kind'],
-                msg['nick'],
-                round(msg['timestamp']),
-                (
+        self._log_buffer.append(
+            {
+                'channel_id': channel,
+                'kind': msg['kind'],
+                'sender': msg['nick'],
+                'timestamp': round(msg['timestamp']),
+                'message': (
                     msg['message']
                     if msg['kind'] == 'PRIVMSG'
                     else msg['args']
                     if msg['kind'] == 'NICK'
                     else ""
                 ),
-                msgiscmd,
-            ),
+                'command': msgiscmd,
+                'message_hash': (
+                    message_hash(msg['message'])
+                    if msg['kind'] == 'PRIVMSG'
+                    else None
+                ),
+                # The links in the message, for .gib --media
+                'urls': (
+                    find_urls(msg['message'])
+                    if msg['kind'] == 'PRIVMSG' and not msgiscmd
+                    else []
+                ),
+            }
         )
-        # mark current nick as most recent
-        c.execute(
+        if len(self._log_buffer) >= self.log_batch_size:
+            self.flush_messages()
+        elif self._log_flusher is None:
+            self._log_flusher = gevent.spawn_later(
+                self.log_flush_interval, self.flush_messages
+            )
+
+    def flush_messages(self):
+        """Writes all buffered messages to the db in a single transaction.
+
+        Called automatically by log_message, and should also be called before
+        the bot shuts down or reboots."""
+        flusher = self._log_flusher
+        self._log_flusher = None
+        if flusher is not None and flusher is not gevent.getcurrent():
+            flusher.kill(block=False)
+        if len(self._log_buffer) == 0:
+            return
+        batch = self._log_buffer
+        self._log_buffer = []
+        try:
+            self._write_messages(batch)
+        except Exception as error:
+            if _is_transient(error):
+                self._keep_messages(batch)
+                raise
+            # Something in the batch can't be written - write the messages
+            # one at a time, so that only the bad ones are lost
+            for index, message in enumerate(batch):
+                try:
+                    self._write_messages([message])
+                except Exception as error:
+                    if _is_transient(error):
+                        self._keep_messages(batch[index:])
+                        raise
+                    dbprint(
+                        "Dropped a message from {} that could not be "
+                        "logged: {}".format(message['sender'], error),
+                        True,
+                    )
+
+    def _keep_messages(self, messages):
+        """Puts messages that could not be written back at the start of the
+        buffer for the next flush, but doesn't let a broken database eat all
+        the memory."""
+        self._log_buffer[:0] = messages
+        overflow = len(self._log_buffer) - self.log_buffer_limit
+        if overflow > 0:
+            del self._log_buffer[:overflow]
+            dbprint(
+                "Log buffer full, dropped {} messages".format(overflow),
+                True,
+            )
+
+    def _flush_at_exit(self):
+        """Flushes the message buffer when the interpreter exits, when the
+        database threads may no longer be running."""
+        self._local.conn = self._writer_conn
+        self._local.writable = True
+        self.flush_messages()
+
+    @_writes
+    def _write_messages(self, batch):
+        """Writes a batch of logged messages to the db."""
+        c = self._begin_batch()
+        insert = '''
+            INSERT INTO messages
+                (channel_id, kind, sender, timestamp, message, command,
+                 message_hash)
+            VALUES (:channel_id, :kind, :sender, :timestamp, :message,
+                    :command, :message_hash)
             '''
-            SELECT user_id FROM user_aliases
-            WHERE alias=? AND type='irc'
-            ''',
-            (msg['nick'],),
-        )
-        user = c.fetchall()
+        try:
+            # Messages with links are inserted one at a time, to get the IDs
+            # for their links, and the rest together in between
+            start = 0
+            for index, message in enumerate(batch):
+                if len(message['urls']) == 0:
+                    continue
+                c.executemany(insert, batch[start:index])
+                c.execute(insert, message)
+                c.executemany(
+                    '''
+                    INSERT OR IGNORE INTO message_urls
+                        (message_id, channel_id, sender, url, kind)
+                    VALUES ( ? , ? , ? , ? , ? )
+                    ''',
+                    [
+                        (
+                            c.lastrowid,
+                            message['channel_id'],
+                            message['sender'],
+                            url,
+                            kind,
+                        )
+                        for url, kind in message['urls']
+                    ],
+                )
+                start = index + 1
+            c.executemany(insert, batch[start:])
+            # Only the last nick seen for each user needs to be marked as most
+            # recent, but the order in which nicks were last seen matters
+            nicks = list(
+                reversed(
+                    list(
+                        dict.fromkeys(m['sender'] for m in reversed(batch))
+                    )
+                )
+            )
+            for nick in nicks:
+                self._mark_most_recent(nick)
+            self._commit_batch()
+        except Exception:
+            self._roll_back_batch()
+            # The identity index may have been told about the rolled back
+            # changes
+            self._load_identities()
+            raise
+
+    def _mark_most_recent(self, nick):
+        """Marks a nick as the most recent nick of its user, if it isn't
+        already. Does not commit."""
+        user = self.identities.user_ids(nick, type='irc')
         if len(user) == 0:
-            user = self.add_user(msg['nick'])
+            user = self.add_user(nick, commit=False)
         elif len(user) > 1:
-            raise ValueError(
-                "User {} exists more than once".format(msg['nick'])
-            )
+            raise ValueError("User {} exists more than once".format(nick))
         else:
-            user = user[0]['user_id']
+            user = user[0]
         assert isinstance(user, int)
+        if self.identities.is_most_recent(user, nick):
+            return
+        c = self.conn.cursor()
         c.execute(
             '''
             UPDATE user_aliases
@@ -1290,10 +2442,34 @@ class SqliteDriver:
             SET most_recent=1
             WHERE type='irc' AND user_id=? AND alias=?
             ''',
-            (user, msg['nick']),
+            (user, nick),
         )
-        self.conn.commit()
+        self.identities.mark_most_recent(user, nick)
+
+    def _get_channel_id(self, channel_name):
+        """Gets the ID of a channel from its name. IDs of channels never
+        change, so they are cached."""
+        if channel_name not in self._channel_ids:
+            channel = self._look_up_channel_id(channel_name)
+            if channel is None:
+                return None
+            self._channel_ids[channel_name] = channel
+        return self._channel_ids[channel_name]
+
+    @_reads
+    def _look_up_channel_id(self, channel_name):
+        """Gets the ID of a channel from the db."""
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            SELECT id FROM channels
+            WHERE channel_name=?
+            ''',
+            (channel_name,),
+        )
+        return norm(c.fetchone())
 
+    @_reads
     def get_messages_from_user(self, nick, channel=None):
         c = self.conn.cursor()
         assert channel.startswith('#')
@@ -1315,6 +2491,48 @@ class SqliteDriver:
         )
         return c.fetchall()
 
+    @_reads
+    def get_user_activity(self, nick, channel):
+        """Summarises what someone has said in a channel, under any of their
+        aliases.
+
+        Returns a dict with the number of messages ('count') and the first
+        and last of them ('first', 'last'), or None if they've said nothing.
+        """
+        assert channel.startswith('#')
+        channel_id = self._get_channel_id(channel)
+        aliases = self.get_aliases(nick)
+        if channel_id is None or aliases is None:
+            return None
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            SELECT * FROM user_channel_activity
+            WHERE channel_id=? AND sender IN ({})
+            '''.format(",".join("?" * len(aliases))),
+            (channel_id, *aliases),
+        )
+        senders = c.fetchall()
+        if len(senders) == 0:
+            return None
+        first = min(
+            senders, key=lambda s: (s['first_timestamp'], s['first_id'])
+        )
+        last = max(senders, key=lambda s: (s['last_timestamp'], s['last_id']))
+        c.execute(
+            '''
+            SELECT * FROM messages WHERE id IN (?, ?)
+            ''',
+            (first['first_id'], last['last_id']),
+        )
+        messages = {row['id']: row for row in c.fetchall()}
+        return {
+            'count': sum(s['message_count'] for s in senders),
+            'first': messages[first['first_id']],
+            'last': messages[last['last_id']],
+        }
+
+    @_writes
     def add_article(self, article, commit=True):
         """Adds an article and its data to the db.
         article should be a dict of article info.
@@ -1358,6 +2576,7 @@ class SqliteDriver:
             'url': article['url'],
             'category': article['category'],
             'title': article.get('meta_title' if has_meta else 'title'),
+            'title_lc': None,
             'scp_num': article['title'] if has_meta else None,
             'parent': article['parent_fullname'],
             'rating': article['rating'],
@@ -1365,6 +2584,9 @@ class SqliteDriver:
             'downs': article['downs'],
             'date_posted': pd.parse(article['created_at']).int_timestamp,
         }
+        # The lowercased title is what title searches are checked against
+        if article_data['title'] is not None:
+            article_data['title_lc'] = article_data['title'].lower()
         c.execute(
             '''
             SELECT * FROM articles WHERE url=?
@@ -1378,9 +2600,9 @@ class SqliteDriver:
             c.execute(
                 '''
                 INSERT OR REPLACE INTO articles
-                    (url, category, title, scp_num, parent,
+                    (url, category, title, title_lc, scp_num, parent,
                      rating, ups, downs, date_posted)
-                VALUES (:url, :category, :title, :scp_num, :parent,
+                VALUES (:url, :category, :title, :title_lc, :scp_num, :parent,
                         :rating, :ups, :downs, :date_posted)
                 ''',
                 article_data,
@@ -1395,7 +2617,7 @@ class SqliteDriver:
                 UPDATE articles
                 SET url=:url, category=:category, parent=:parent,
                     rating=:rating, date_posted=:date_posted, title=:title,
-                    scp_num=:scp_num
+                    title_lc=:title_lc, scp_num=:scp_num
                 WHERE id=:id
                 ''',
                 article_data,
@@ -1406,11 +2628,13 @@ class SqliteDriver:
                 c.execute(
                     '''
                     UPDATE articles
-                    SET title=:title, scp_num=:scp_num
+                    SET title=:title, title_lc=:title_lc, scp_num=:scp_num
                     WHERE id=:id
                     ''',
                     article_data,
                 )
+        self._articles_uncommitted.add(article_data['id'])
+        self._search_statistics = None
         # update tags and authors
         c.execute(
             '''
@@ -1448,9 +2672,18 @@ class SqliteDriver:
         if commit:
             self.conn.commit()
 
+    @_writes
     def delete_article(self, url, commit=True):
         """Delete an article by slug"""
         c = self.conn.cursor()
+        c.execute(
+            '''
+            SELECT id FROM articles WHERE url=?
+            ''',
+            (url,),
+        )
+        self._articles_uncommitted.update(row['id'] for row in c.fetchall())
+        self._search_statistics = None
         c.execute(
             '''
             DELETE FROM articles
@@ -1461,6 +2694,7 @@ class SqliteDriver:
         if commit:
             self.conn.commit()
 
+    @_writes
     def set_authors(self, url, authors, commit=True):
         """Set the authors for a given article."""
         c = self.conn.cursor()
@@ -1474,6 +2708,8 @@ class SqliteDriver:
         if page_id is None:
             raise ValueError("page {} doesn't exist".format(url))
         page_id = page_id['id']
+        self._articles_uncommitted.add(page_id)
+        self._search_statistics = None
         c.execute(
             '''
             DELETE FROM articles_authors
@@ -1491,44 +2727,163 @@ class SqliteDriver:
         if commit:
             self.conn.commit()
 
-    def get_article_info(self, id):
-        """Gets info about an article"""
-        page = {'id': id, 'tags': [], 'authors': []}
+    @_writes
+    def load_catalogue(self):
+        """Builds the in-memory article catalogue from scratch."""
         c = self.conn.cursor()
         c.execute(
             '''
-            SELECT category,url,title,scp_num,rating,date_posted
-            FROM articles WHERE id=?
+            SELECT id FROM articles
+            '''
+        )
+        self.catalogue = ArticleCatalogue()
+        self._articles_changed = {row['id'] for row in c.fetchall()}
+        self.refresh_catalogue()
+        dbprint(
+            "Loaded {} articles into the catalogue".format(
+                self.catalogue.size
+            )
+        )
+
+    @_reads
+    def refresh_catalogue(self):
+        """Updates the article catalogue with the articles that have changed
+        since it was last refreshed, as they have been committed."""
+        with self._refresh_lock:
+            self._refresh_catalogue()
+
+    def _refresh_catalogue(self):
+        """Updates the article catalogue. See refresh_catalogue."""
+        if self.catalogue is None:
+            return
+        with self._catalogue_lock:
+            changed = self._articles_changed
+            self._articles_changed = set()
+        if len(changed) == 0:
+            return
+        wanted = json.dumps(list(changed))
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            SELECT id,url,category,title,scp_num,parent,rating,date_posted
+            FROM articles WHERE id IN (SELECT value FROM json_each(?))
             ''',
-            (id,),
+            (wanted,),
         )
-        result = c.fetchone()
-        for column in result.keys():
-            page[column] = result[column]
-        # generate the fullname from category:url
-        if page['category'] == '_default':
-            page['fullname'] = page['url']
-        else:
-            page['fullname'] = ":".join([page['category'], page['url']])
-        # now get authors and tags
+        articles = c.fetchall()
         c.execute(
             '''
-            SELECT tag FROM articles_tags WHERE article_id=?
+            SELECT article_id,tag FROM articles_tags
+            WHERE article_id IN (SELECT value FROM json_each(?))
             ''',
-            (id,),
+            (wanted,),
         )
-        for row in c.fetchall():
-            page['tags'].append(row['tag'])
-        # TODO this does not take metadata into account
+        tags = c.fetchall()
+        # Metadata authors replace the others, as in get_articles
         c.execute(
             '''
-            SELECT author FROM articles_authors WHERE article_id=?
+            SELECT article_id,author FROM articles_authors AS au
+            WHERE article_id IN (SELECT value FROM json_each(?))
+                AND metadata=(SELECT MAX(metadata) FROM articles_authors
+                              WHERE article_id=au.article_id)
             ''',
-            (id,),
+            (wanted,),
+        )
+        authors = c.fetchall()
+        with self._catalogue_lock:
+            self.catalogue.update(changed, articles, tags, authors)
+
+    # Info that get_articles_info can fetch, beyond the columns of articles
+    article_info_extras = ('fullname', 'tags', 'authors')
+    article_info_columns = (
+        'category',
+        'url',
+        'title',
+        'scp_num',
+        'parent',
+        'rating',
+        'ups',
+        'downs',
+        'date_posted',
+        'is_promoted',
+    )
+    article_info_default = (
+        'category',
+        'url',
+        'title',
+        'scp_num',
+        'rating',
+        'date_posted',
+        'is_promoted',
+        'fullname',
+        'tags',
+        'authors',
+    )
+
+    def get_article_info(self, id):
+        """Gets info about an article"""
+        return self.get_articles_info([id])[0]
+
+    @_reads
+    def get_articles_info(self, ids, fields=None):
+        """Gets info about many articles at once, in a single query.
+        ids is a list of article IDs. The returned list of dicts is in the
+        same order; IDs that aren't articles are left out.
+        fields is a list of the info to get for each article - any of
+        article_info_columns and article_info_extras. Defaults to
+        article_info_default. The id is always included."""
+        if fields is None:
+            fields = self.article_info_default
+        for field in fields:
+            if (
+                field not in self.article_info_columns
+                and field not in self.article_info_extras
+            ):
+                raise ValueError("Unknown article field: {}".format(field))
+        columns = [f for f in fields if f in self.article_info_columns]
+        if 'fullname' in fields:
+            columns.extend(
+                c for c in ('category', 'url') if c not in columns
+            )
+        selection = ["articles.id AS id"]
+        selection.extend("articles.{0} AS {0}".format(c) for c in columns)
+        if 'tags' in fields:
+            selection.append(
+                "(SELECT json_group_array(tag) FROM articles_tags"
+                " WHERE article_id=articles.id) AS tags"
+            )
+        # TODO this does not take metadata into account
+        if 'authors' in fields:
+            selection.append(
+                "(SELECT json_group_array(author) FROM articles_authors"
+                " WHERE article_id=articles.id) AS authors"
+            )
+        # json_each numbers the ids, which keeps them in the given order
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            SELECT {} FROM json_each(?) AS wanted
+            INNER JOIN articles ON articles.id=wanted.value
+            ORDER BY wanted.key
+            '''.format(",".join(selection)),
+            (json.dumps(list(ids)),),
         )
+        pages = []
         for row in c.fetchall():
-            page['authors'].append(row['author'])
-        return page
+            page = dict(row)
+            for column in ('tags', 'authors'):
+                if column in page:
+                    page[column] = json.loads(page[column])
+            # generate the fullname from category:url
+            if 'fullname' in fields:
+                if page['category'] == '_default':
+                    page['fullname'] = page['url']
+                else:
+                    page['fullname'] = ":".join(
+                        [page['category'], page['url']]
+                    )
+            pages.append(page)
+        return pages
 
     def get_articles(self, searches):
         """Get a list of articles that match the criteria.
@@ -1544,105 +2899,90 @@ class SqliteDriver:
                 * None, random, recommend, recent
             * 'limit' - a limit on the list returned
             * 'offset' - how many articles to offset
-        Returns a list of article IDs. Use get_article_info for more detail on
-        each."""
-        # loop through searches and query the database, I guess
-        # start with the least intensive process, to most intensive:
-        keyorder = {
-            'url': 0,
-            'rating': 0,
-            'parent': 1,
-            'category': 2,
-            'date': 3,
-            'author': 4,
-            'tags': 5,
-            None: 6,
-            'regex': 7,
-        }
-        searches.sort(key=lambda x: keyorder[x['type']])
-        # begin query
-        art = Table('articles')
-        art_au = Table('articles_authors')
-        art_tags = Table('articles_tags')
-        q = MySQLQuery.from_(art).select(art.id)
-        for search in searches:
-            if search['type'] == 'rating':
-                if search['term']['max'] is not None:
-                    q = q.where(art.rating <= search['term']['max'])
-                if search['term']['min'] is not None:
-                    q = q.where(art.rating >= search['term']['min'])
-            elif search['type'] == 'parent':
-                q = q.where(art.parent == search['term'])
-            elif search['type'] == 'category':
-                if len(search['term']['exclude']) > 0:
-                    q = q.where(art.category.notin(search['term']['exclude']))
-                if len(search['term']['include']) > 0:
-                    q = q.where(art.category.isin(search['term']['include']))
-            elif search['type'] == 'date':
-                if search['term']['max'] is not None:
-                    timestamp = search['term']['max'].int_timestamp
-                    q = q.where(art.date_posted <= timestamp)
-                if search['term']['min'] is not None:
-                    timestamp = search['term']['min'].int_timestamp
-                    q = q.where(art.date_posted >= timestamp)
-            elif search['type'] == 'author':
-                # yay for triple-nested queries!
-                meta_q = (
-                    MySQLQuery.from_(art_au)
-                    .select(Max(art_au.metadata))
-                    .where(art_au.article_id == art.id)
-                )
-                au_q = (
-                    MySQLQuery.from_(art_au)
-                    .select(art_au.author)
-                    .where(art_au.article_id == art.id)
-                    .where(art_au.metadata == meta_q)
-                )
-                for author in search['term']['include']:
-                    q = q.where(ValueWrapper(author).isin(au_q))
-                for author in search['term']['exclude']:
-                    q = q.where(ValueWrapper(author).notin(au_q))
-            elif search['type'] == 'tags':
-                tag_q = (
-                    MySQLQuery.from_(art_tags)
-                    .select(art_tags.tag)
-                    .where(art_tags.article_id == art.id)
-                )
-                for tag in search['term']['include']:
-                    q = q.where(ValueWrapper(tag).isin(tag_q))
-                for tag in search['term']['exclude']:
-                    q = q.where(ValueWrapper(tag).notin(tag_q))
-            elif search['type'] is None:
-                q = q.where(
-                    (art.title.like(search['term']))
-                    | (art.scp_num.regex(re.escape(search['term'])))
-                    | (
-                        art.scp_num.regex(
-                            "scp-{}($|[^0-9])".format(
-                                re.escape(search['term'])
-                            )
-                        )
-                    )
-                )
-            elif search['type'] == 'regex':
-                q = q.where(art.title.regex(search['term']))
-            elif search['type'] == 'url':
-                q = q.where(art.url == search['term'])
-            else:
-                raise TypeError(
-                    "Unknown search: {}/{}".format(
-                        search['type'], search['term']
-                    )
-                )
-        # query complete
-        # insert custom functions
-        q = str(q).replace(" LIKE ", " GLOB ")
-        q = str(q).replace(" REGEX ", " REGEXP ")
+        Returns a list of article IDs. Use get_articles_info for more detail
+        on them.
+        If the catalogue is enabled, the search is done in memory."""
+        if self.catalogue is not None:
+            if len(self._articles_changed) > 0:
+                self.refresh_catalogue()
+            with self._catalogue_lock:
+                return self.catalogue.search(searches)
+        return self._search_articles(searches)
+
+    @_reads
+    def _search_articles(self, searches):
+        """Get a list of the IDs of articles that match the criteria, by
+        querying the database. See get_articles."""
+        q, parameters = compile_article_search(
+            searches, self._get_search_statistics(), self.titles_indexed
+        )
         c = self.conn.cursor()
-        print(str(q))
-        c.execute(str(q))
+        print(q)
+        c.execute(q, parameters)
         return [row['id'] for row in c.fetchall()]
 
+    def explain_articles(self, searches):
+        """Get the plan for a search for articles, as a list of lines indented
+        to show its structure. See get_articles.
+        If the catalogue is enabled, no query is made, so there is no plan."""
+        if self.catalogue is not None:
+            return ["Searched the article catalogue in memory"]
+        return self._explain_article_search(searches)
+
+    @_reads
+    def _explain_article_search(self, searches):
+        """Get SQLite's plan for the query that searches for articles. See
+        explain_articles."""
+        q, parameters = compile_article_search(
+            searches, self._get_search_statistics(), self.titles_indexed
+        )
+        c = self.conn.cursor()
+        c.execute("EXPLAIN QUERY PLAN " + q, parameters)
+        depths = {0: -1}
+        plan = []
+        for row in c.fetchall():
+            depths[row['id']] = depths.get(row['parent'], -1) + 1
+            plan.append("  " * depths[row['id']] + row['detail'])
+        return plan
+
+    @_reads
+    def _get_search_statistics(self):
+        """Gets the statistics about the articles that searches are planned
+        with. They are collected when first needed after articles change."""
+        statistics = self._search_statistics
+        if statistics is not None:
+            return statistics
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            SELECT rating, date_posted, category, parent FROM articles
+            '''
+        )
+        articles = c.fetchall()
+        c.execute(
+            '''
+            SELECT tag FROM articles_tags
+            '''
+        )
+        tags = [row['tag'] for row in c.fetchall()]
+        c.execute(
+            '''
+            SELECT author FROM articles_authors
+            '''
+        )
+        authors = [row['author'] for row in c.fetchall()]
+        statistics = SearchStatistics(
+            ratings=[row['rating'] for row in articles],
+            dates=[row['date_posted'] for row in articles],
+            categories=[row['category'] for row in articles],
+            parents=[row['parent'] for row in articles],
+            tags=tags,
+            authors=authors,
+        )
+        self._search_statistics = statistics
+        return statistics
+
+    @_writes
     def set_showmore_list(self, channel_name, page_ids):
         c = self.conn.cursor()
         assert channel_name.startswith('#')
@@ -1671,6 +3011,7 @@ class SqliteDriver:
         )
         self.conn.commit()
 
+    @_reads
     def get_showmore_list(self, channel_name):
         """Get the showmore list for the channel. Returns list of article
         IDs."""
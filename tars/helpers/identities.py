@@ -0,0 +1,163 @@
+"""identities.py
+
+In-memory copy of the user_aliases table, for looking up who is who without
+querying the database.
+
+The index is loaded from the database when the bot starts, and the database
+driver updates it every time it changes an alias, so it never has to be read
+back. It can be used from any thread.
+"""
+
+from gevent import monkey
+
+from tars.helpers.catalogue import nocase
+
+
+class IdentityIndex:
+    """Two-way index between users and their aliases.
+
+    Each alias is stored as a dict with the same keys as the columns of
+    user_aliases. Aliases are compared the way the NOCASE alias column
+    compares them.
+    """
+
+    def __init__(self):
+        self._lock = monkey.get_original('threading', 'Lock')()
+        self._users = {}
+        self._aliases = {}
+        self.controllers = set()
+
+    def load(self, aliases, controllers):
+        """Replaces the contents of the index.
+
+        aliases are rows of user_aliases, in the order they were added.
+        controllers are the IDs of users who are controllers.
+        """
+        with self._lock:
+            self._users = {}
+            self._aliases = {}
+            for row in aliases:
+                self._add(dict(row))
+            self.controllers = set(controllers)
+
+    def _add(self, record):
+        """Adds an alias. The lock must be held."""
+        self._users.setdefault(record['user_id'], []).append(record)
+        self._aliases.setdefault(nocase(record['alias']), []).append(record)
+
+    def _remove(self, user_id, condition):
+        """Removes a user's aliases that meet a condition. The lock must be
+        held."""
+        records = self._users.get(user_id, [])
+        removed = [r for r in records if condition(r)]
+        if len(removed) == 0:
+            return
+        self._users[user_id] = [r for r in records if not condition(r)]
+        if len(self._users[user_id]) == 0:
+            del self._users[user_id]
+        for record in removed:
+            key = nocase(record['alias'])
+            self._aliases[key] = [
+                r for r in self._aliases[key] if r is not record
+            ]
+            if len(self._aliases[key]) == 0:
+                del self._aliases[key]
+
+    def add(self, user_id, alias, type='irc', weight=0, most_recent=0):
+        """Adds an alias to a user, replacing the same alias at the same
+        weight, like INSERT OR REPLACE."""
+        record = {
+            'user_id': user_id,
+            'alias': alias,
+            'type': type,
+            'weight': weight,
+            'most_recent': int(most_recent),
+        }
+        with self._lock:
+            self._remove(
+                user_id,
+                lambda r: nocase(r['alias']) == nocase(alias)
+                and r['type'] == type
+                and r['weight'] == weight,
+            )
+            self._add(record)
+
+    def remove(self, user_id, alias=None, type='irc'):
+        """Removes an alias from a user, at any weight. If alias is None,
+        removes all of the user's aliases of that type."""
+        with self._lock:
+            self._remove(
+                user_id,
+                lambda r: (
+                    alias is None or nocase(r['alias']) == nocase(alias)
+                )
+                and r['type'] == type,
+            )
+
+    def mark_most_recent(self, user_id, alias, type='irc', weight=None):
+        """Marks an alias as the most recent of the user's aliases of that
+        type, and the others as not. If weight is given, only aliases at that
+        weight are affected.
+
+        Returns False if nothing needed to change."""
+        changed = False
+        with self._lock:
+            for record in self._users.get(user_id, []):
+                if record['type'] != type:
+                    continue
+                if weight is not None and record['weight'] != weight:
+                    continue
+                most_recent = int(
+                    alias is not None
+                    and nocase(record['alias']) == nocase(alias)
+                )
+                if record['most_recent'] != most_recent:
+                    record['most_recent'] = most_recent
+                    changed = True
+        return changed
+
+    def is_most_recent(self, user_id, alias, type='irc'):
+        """Whether an alias is already marked as the user's only most recent
+        alias of that type."""
+        with self._lock:
+            return all(
+                record['most_recent']
+                == (nocase(record['alias']) == nocase(alias))
+                for record in self._users.get(user_id, [])
+                if record['type'] == type
+            )
+
+    def user_ids(self, alias, type=None):
+        """Gets the IDs of the users who have an alias, optionally only of
+        one type."""
+        with self._lock:
+            records = self._aliases.get(nocase(alias), [])
+            return list(
+                dict.fromkeys(
+                    r['user_id']
+                    for r in records
+                    if type is None or r['type'] == type
+                )
+            )
+
+    def aliases(self, user_id=None, type=None):
+        """Gets a user's aliases, optionally only of one type. If user_id is
+        None, gets everyone's."""
+        with self._lock:
+            if user_id is None:
+                records = [r for rs in self._users.values() for r in rs]
+            else:
+                records = self._users.get(user_id, [])
+            return [
+                r['alias']
+                for r in records
+                if type is None or r['type'] == type
+            ]
+
+    def most_recent(self, user_id, type='irc'):
+        """Gets the alias that a user most recently used, or None."""
+        with self._lock:
+            for record in self._users.get(user_id, []):
+                if record['type'] == type and record['most_recent']:
+                    return record['alias']
+        return None
@@ -0,0 +1,876 @@
+"""markov.py
+
+Markov models for gib, and a cache of them.
+
+markovify keeps its chain as dicts of words keyed by tuples of words, and
+keeps every sentence that it was made from as a list of words, which takes up
+a lot of memory for a model of thousands of messages. CompactMarkov makes the
+same sentences from a model that is a few flat arrays of numbers, with each
+word swapped for an ID. It can also make sentences at any smaller state
+size, from a chain that is worked out from its own instead of from the
+messages.
+
+Making a model means reading thousands of messages and building its chain
+from them, so each model is kept for the selection of messages that it
+was made from - the channels, users, regexes, state size and limit. When
+newer messages arrive, they are added to the model and the oldest messages
+are taken out of it, so that it keeps being made from the most recent ones
+without being built again. The least recently used models are evicted once
+they take up more than the cache's budget.
+
+The models are also saved to disk, gzipped, with a small file of metadata
+beside each, so they survive reloads and restarts.
+"""
+
+from array import array
+import bisect
+from collections import OrderedDict
+import copy
+import gzip
+import hashlib
+import io
+import json
+import os
+import pathlib
+import random
+import sys
+import time
+
+import gevent
+import gevent.threadpool
+import markovify
+from markovify.chain import BEGIN, END
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from tars.helpers.workers import WORKERS
+
+# The IDs of BEGIN and END in a CompactMarkov
+BEGIN_ID = 0
+END_ID = 1
+
+
+class _MessagesText(markovify.Text):
+    """A markovify.Text where each message is one sentence."""
+
+    def sentence_split(self, text):
+        return [text]
+
+    def make_sentences(self, count, min_chars=0, max_chars=400, tries=1000):
+        """Makes up to count different sentences, each between min_chars and
+        max_chars characters long, from no more than tries walks of the
+        chain."""
+        sentences = []
+        for _ in range(tries):
+            sentence = self.make_sentence(tries=1)
+            if (
+                sentence is not None
+                and min_chars <= len(sentence) <= max_chars
+                and sentence not in sentences
+            ):
+                sentences.append(sentence)
+                if len(sentences) >= count:
+                    break
+        return sentences
+
+
+class MarkovFromList(_MessagesText):
+    """A Markov model where each message is one sentence."""
+
+    @classmethod
+    def from_dict(cls, obj, **kwargs):
+        return cls(
+            None,
+            state_size=obj['state_size'],
+            chain=markovify.Chain.from_json(obj['chain']),
+            parsed_sentences=obj['parsed_sentences'],
+            well_formed=False,
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls.from_json(data.decode())
+
+    def to_bytes(self):
+        return self.to_json().encode()
+
+    def __len__(self):
+        return len(self.parsed_sentences)
+
+    def update(self, messages, limit):
+        """Adds messages to the model, most recent first, that are all newer
+        than the messages already in it. The oldest messages are then taken
+        out until there are no more than limit, if limit isn't negative."""
+        sentences = list(self.generate_corpus(messages))
+        if len(sentences) == 0:
+            return
+        self.parsed_sentences[:0] = sentences
+        for sentence in sentences:
+            self._count(sentence, 1)
+        if 0 <= limit < len(self.parsed_sentences):
+            for sentence in self.parsed_sentences[limit:]:
+                self._count(sentence, -1)
+            del self.parsed_sentences[limit:]
+        self.rejoined_text = self.sentence_join(
+            map(self.word_join, self.parsed_sentences)
+        )
+        self.chain.precompute_begin_state()
+
+    def _count(self, sentence, change):
+        """Adds to or takes from the counts of the transitions in a
+        sentence, the same way that markovify.Chain.build counts them."""
+        model = self.chain.model
+        size = self.state_size
+        items = [BEGIN] * size + sentence + [END]
+        for index in range(len(sentence) + 1):
+            state = tuple(items[index : index + size])
+            follow = items[index + size]
+            follows = model.setdefault(state, {})
+            follows[follow] = follows.get(follow, 0) + change
+            if follows[follow] <= 0:
+                del follows[follow]
+                if len(follows) == 0:
+                    del model[state]
+
+
+class CompactChain:
+    """A Markov chain like markovify.Chain, with its words swapped for IDs
+    and its transitions kept in flat arrays.
+
+    Each state has a row of transitions, from offsets[row] up to
+    offsets[row + 1]. Each transition has the ID of the word that follows
+    the state, the total weight of the transitions in its row up to and
+    including it, and the row of the state that it leads to, which is -1 for
+    the end of a sentence. The first row is the beginning of a sentence.
+    """
+
+    def __init__(self, words, state_size, offsets, follows, weights, rows):
+        self.words = words
+        self.state_size = state_size
+        self.offsets = offsets
+        self.follows = follows
+        self.weights = weights
+        self.rows = rows
+
+    @classmethod
+    def from_grams(cls, words, grams, counts):
+        """Makes a chain from the distinct grams of word IDs - a state
+        followed by a word - in order, and how many times each happened."""
+        state_size = grams.shape[1] - 1
+        states = grams[:, :state_size]
+        starts_row = np.ones(len(grams), dtype=bool)
+        starts_row[1:] = np.any(states[1:] != states[:-1], axis=1)
+        firsts = np.flatnonzero(starts_row)
+        offsets = np.append(firsts, len(grams))
+        # Running totals that go back to 0 at the start of each row
+        weights = np.cumsum(counts)
+        weights -= np.repeat(
+            weights[firsts] - counts[firsts], np.diff(offsets)
+        )
+        # Each transition leads to the state of its last state_size words
+        bits = _id_bits(len(words))
+        rows = np.searchsorted(
+            _gram_keys(states[firsts], bits),
+            _gram_keys(np.column_stack([states[:, 1:], grams[:, -1]]), bits),
+        )
+        rows[grams[:, -1] == END_ID] = -1
+        return cls(
+            words,
+            state_size,
+            _to_array('i', offsets),
+            _to_array('i', grams[:, -1]),
+            _to_array('I', weights),
+            _to_array('i', rows),
+        )
+
+    def grams(self):
+        """Reads the grams of the chain back out of its arrays, in order,
+        with how many times each happened, as count_grams gives them.
+
+        The state of a row is the state of a row that leads to it without its
+        first word, followed by the word of the transition between them. The
+        states are worked out a word at a time from the end, so it takes
+        state_size steps over every row instead of one step for each row."""
+        offsets = np.frombuffer(self.offsets, dtype=np.int32)
+        follows = np.frombuffer(self.follows, dtype=np.int32)
+        weights = np.frombuffer(self.weights, dtype=np.uint32)
+        rows = np.frombuffer(self.rows, dtype=np.int32)
+        lengths = np.diff(offsets)
+        sources = np.repeat(np.arange(len(lengths)), lengths)
+        # For each row, the last word of its state, and a row that leads to
+        # it. The beginning of a sentence is only BEGINs, and leads to itself
+        leads = rows >= 0
+        last_words = np.full(len(lengths), BEGIN_ID, dtype=np.int32)
+        last_words[rows[leads]] = follows[leads]
+        previous = np.zeros(len(lengths), dtype=np.int64)
+        previous[rows[leads]] = sources[leads]
+        states = np.empty((len(lengths), self.state_size), dtype=np.int32)
+        words = last_words
+        for column in range(self.state_size - 1, -1, -1):
+            states[:, column] = words
+            words = words[previous]
+        grams = np.column_stack([states[sources], follows])
+        counts = np.diff(weights.astype(np.int64), prepend=0)
+        counts[offsets[:-1]] = weights[offsets[:-1]]
+        return grams.reshape(-1, self.state_size + 1), counts
+
+    def walk(self, init_state=None):
+        """Walks the chain from the beginning of a sentence, and returns the
+        words along the way."""
+        if init_state is not None and set(init_state) != {BEGIN}:
+            raise ValueError("CompactChain can only start at the beginning")
+        sentence = []
+        if len(self.follows) == 0:
+            return sentence
+        offsets, weights = self.offsets, self.weights
+        row = 0
+        while True:
+            start, end = offsets[row], offsets[row + 1]
+            index = bisect.bisect(
+                weights, random.random() * weights[end - 1], start, end
+            )
+            row = self.rows[index]
+            if row < 0:
+                return sentence
+            sentence.append(self.words[self.follows[index]])
+
+    @property
+    def nbytes(self):
+        """The memory taken up by the arrays of transitions, in bytes."""
+        return sum(
+            len(values) * values.itemsize
+            for values in [self.offsets, self.follows, self.weights, self.rows]
+        )
+
+
+class CompactMarkov(_MessagesText):
+    """A Markov model where each message is one sentence, that makes the
+    same sentences as MarkovFromList from a CompactChain.
+
+    Instead of a list of words for each sentence, the model keeps the
+    sentences as one array of word IDs, one after the other, with each padded
+    by state_size BEGINs and an END. Sentence i is
+    corpus[starts[i]:starts[i + 1]].
+
+    of_state_size() gives the same model at a smaller state size, for when
+    the full state size can't make a sentence.
+    """
+
+    def __init__(self, messages, state_size):
+        self.state_size = state_size
+        self.well_formed = False
+        self.words = [BEGIN, END]
+        self.corpus = array('i')
+        self.starts = array('q', [0])
+        self.rejoined_text = ""
+        self.chain = None
+        # {state size: chain} for smaller state sizes
+        self._smaller_chains = {}
+        self.update(messages, -1)
+
+    @classmethod
+    def from_bytes(cls, data):
+        arrays = np.load(io.BytesIO(data), allow_pickle=False)
+        model = cls.__new__(cls)
+        model.state_size = int(arrays['state_size'])
+        model.well_formed = False
+        model.words = arrays['words'].tobytes().decode().split("\n")
+        model.corpus = _to_array('i', arrays['corpus'])
+        model.starts = _to_array('q', arrays['starts'])
+        model.rejoined_text = arrays['rejoined_text'].tobytes().decode()
+        model._smaller_chains = {}
+        model.chain = CompactChain(
+            model.words,
+            model.state_size,
+            *[
+                _to_array(typecode, arrays[name])
+                for typecode, name in [
+                    ('i', 'offsets'),
+                    ('i', 'follows'),
+                    ('I', 'weights'),
+                    ('i', 'rows'),
+                ]
+            ],
+        )
+        return model
+
+    def to_bytes(self):
+        data = io.BytesIO()
+        np.savez(
+            data,
+            state_size=self.state_size,
+            words=_text_array("\n".join(self.words)),
+            corpus=self.corpus,
+            starts=self.starts,
+            rejoined_text=_text_array(self.rejoined_text),
+            offsets=self.chain.offsets,
+            follows=self.chain.follows,
+            weights=self.chain.weights,
+            rows=self.chain.rows,
+        )
+        return data.getvalue()
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    @property
+    def nbytes(self):
+        """Roughly the memory taken up by the model, in bytes."""
+        return (
+            len(self.corpus) * self.corpus.itemsize
+            + len(self.starts) * self.starts.itemsize
+            + sys.getsizeof(self.rejoined_text)
+            + sum(sys.getsizeof(word) + 8 for word in self.words)
+            + self.chain.nbytes
+        )
+
+    def update(self, messages, limit):
+        """Adds messages to the model, most recent first, that are all newer
+        than the messages already in it. The oldest messages are then taken
+        out until there are no more than limit, if limit isn't negative.
+
+        Only the sentences that are added and taken out are counted, and
+        their counts are added to and taken from the chain's, so an update
+        of a large model with a few messages doesn't count it all again."""
+        corpus, starts = self._read(messages)
+        if len(starts) == 1 and self.chain is not None:
+            return
+        if 0 <= limit < len(starts) - 1:
+            del starts[limit + 1 :]
+            del corpus[starts[-1] :]
+        keep = len(self)
+        if limit >= 0:
+            keep = min(keep, limit - len(starts) + 1)
+        # The sentences that are taken out, laid out on their own
+        old_corpus = self.corpus[self.starts[keep] :]
+        old_starts = (
+            np.frombuffer(self.starts, dtype=np.int64)[keep:]
+            - self.starts[keep]
+        )
+        added, added_counts = count_grams(corpus, starts, self.state_size)
+        removed, removed_counts = count_grams(
+            old_corpus, old_starts, self.state_size
+        )
+        if self.chain is None:
+            grams, counts = added, added_counts
+        else:
+            changes = _sum_grams(
+                np.concatenate([added, removed]),
+                np.concatenate([added_counts, -removed_counts]),
+            )
+            grams, counts = _add_grams(
+                *self.chain.grams(), *changes, _id_bits(len(self.words))
+            )
+        # The text of the kept sentences is the start of the old text
+        new_text = self._rejoin(corpus, starts)
+        if keep == 0:
+            self.rejoined_text = new_text
+        else:
+            old_text = self.rejoined_text
+            if keep < len(self):
+                cut = len(self._rejoin(old_corpus, old_starts)) + 1
+                old_text = old_text[: len(old_text) - cut]
+            self.rejoined_text = self.sentence_join([new_text, old_text])
+        offset = starts[-1]
+        corpus.extend(self.corpus[: self.starts[keep]])
+        starts.frombytes(
+            (
+                np.frombuffer(self.starts, dtype=np.int64)[1 : keep + 1]
+                + offset
+            ).tobytes()
+        )
+        self.corpus, self.starts = corpus, starts
+        ids = self._forget_unused_words()
+        if ids is not None:
+            grams = ids[grams].astype(np.int32)
+        self.chain = CompactChain.from_grams(self.words, grams, counts)
+        self._smaller_chains.clear()
+
+    def of_state_size(self, state_size):
+        """Gets this model at a smaller state size, to make sentences from.
+
+        Every gram of the smaller state size is the end of a gram of this
+        one, so its chain is counted by marginalising this one's - adding up
+        the grams that end the same way - which are read back from this
+        one's chain rather than counted from the sentences again. It is kept
+        until this model is updated. The model that is returned shares
+        everything else with this one, and mustn't be updated itself."""
+        if state_size == self.state_size:
+            return self
+        chain = self._smaller_chains.get(state_size)
+        if chain is None:
+            grams, counts = self.chain.grams()
+            chain = CompactChain.from_grams(
+                self.words, *marginalise(grams, counts, state_size)
+            )
+            self._smaller_chains[state_size] = chain
+        model = copy.copy(self)
+        model.state_size = state_size
+        model.chain = chain
+        return model
+
+    @classmethod
+    def from_parts(cls, state_size, parts):
+        """Makes a model from parts made by _count_part, in order, which is
+        the same as the model of all of their messages at once. Each part's
+        word IDs are swapped for the IDs that the model would have given them,
+        and the counts of the same grams are added together."""
+        model = cls([], state_size)
+        ids = {BEGIN: BEGIN_ID, END: END_ID}
+        corpora = [np.zeros(0, dtype=np.int32)]
+        starts = [np.zeros(1, dtype=np.int64)]
+        texts = []
+        grams = [np.zeros((0, state_size + 1), dtype=np.int32)]
+        counts = [np.zeros(0, dtype=np.int64)]
+        offset = 0
+        for words, corpus, part_starts, text, part_grams, part_counts in parts:
+            new_ids = np.array(
+                [ids.setdefault(word, len(ids)) for word in words],
+                dtype=np.int32,
+            )
+            corpora.append(new_ids[np.frombuffer(corpus, dtype=np.int32)])
+            starts.append(
+                np.frombuffer(part_starts, dtype=np.int64)[1:] + offset
+            )
+            offset += len(corpus)
+            if len(text) > 0:
+                texts.append(text)
+            grams.append(new_ids[part_grams])
+            counts.append(part_counts)
+        model.words = list(ids)
+        model.corpus = _to_array('i', np.concatenate(corpora))
+        model.starts = _to_array('q', np.concatenate(starts))
+        model.rejoined_text = model.sentence_join(texts)
+        model.chain = CompactChain.from_grams(
+            model.words,
+            *_sum_grams(np.concatenate(grams), np.concatenate(counts)),
+        )
+        return model
+
+    def _read(self, messages):
+        """Swaps the words of messages for IDs, giving new words new IDs.
+        Returns the sentences, laid out as they are in the model."""
+        ids = {word: index for index, word in enumerate(self.words)}
+        corpus = array('i')
+        starts = array('q', [0])
+        for sentence in self.generate_corpus(messages):
+            corpus.extend([BEGIN_ID] * self.state_size)
+            corpus.extend(ids.setdefault(word, len(ids)) for word in sentence)
+            corpus.append(END_ID)
+            starts.append(len(corpus))
+        self.words = list(ids)
+        return corpus, starts
+
+    def _rejoin(self, corpus=None, starts=None):
+        """Joins the model's sentences back into text, for checking that a
+        new sentence isn't too much like them. corpus and starts are the
+        model's own, unless other sentences are given."""
+        return self.sentence_join(
+            self.word_join(self.words[index] for index in sentence)
+            for sentence in self._sentences(corpus, starts)
+        )
+
+    def _sentences(self, corpus=None, starts=None):
+        """Yields the word IDs of each sentence, without the padding."""
+        if corpus is None:
+            corpus, starts = self.corpus, self.starts
+        for start, end in zip(starts, starts[1:]):
+            yield corpus[start + self.state_size : end - 1]
+
+    def _forget_unused_words(self):
+        """Drops the words that aren't in any sentence any more, and gives
+        the rest new IDs, in the same order. BEGIN and END keep theirs.
+        Returns the new ID of each old ID, or None if none have changed."""
+        corpus = np.frombuffer(self.corpus, dtype=np.int32)
+        used = np.zeros(len(self.words), dtype=bool)
+        used[corpus] = True
+        used[[BEGIN_ID, END_ID]] = True
+        if used.all():
+            return None
+        ids = np.cumsum(used) - 1
+        self.corpus = _to_array('i', ids[corpus])
+        self.words = [word for word, kept in zip(self.words, used) if kept]
+        return ids
+
+
+def count_grams(corpus, starts, state_size):
+    """Counts the grams - a state followed by a word - in sentences of word
+    IDs, laid out as in CompactMarkov. Returns the distinct grams in order, as
+    the rows of an array, and how many times each happened."""
+    corpus = np.frombuffer(corpus, dtype=np.int32)
+    width = state_size + 1
+    if len(corpus) < width:
+        return np.zeros((0, width), dtype=np.int32), np.zeros(0, np.int64)
+    windows = sliding_window_view(corpus, width)
+    # Only the windows that end inside the sentence that they start in
+    starts = np.frombuffer(starts, dtype=np.int64)
+    ends = np.repeat(starts[1:], np.diff(starts))[: len(windows)]
+    grams = windows[np.arange(len(windows)) + width <= ends]
+    bits = _id_bits(corpus.max() + 1)
+    keys, counts = np.unique(_gram_keys(grams, bits), return_counts=True)
+    return _from_gram_keys(keys, width, bits), counts
+
+
+def marginalise(grams, counts, state_size):
+    """Counts the grams of a smaller state size in the same sentences, given
+    distinct grams and their counts, by dropping the start of each state.
+    Returns the distinct grams in order and their counts, as count_grams
+    does."""
+    return _sum_grams(grams[:, -state_size - 1 :], counts)
+
+
+def build_parallel(messages, state_size, timeout, parts=None):
+    """Builds a CompactMarkov from messages by reading and counting them in
+    parts, each in its own worker process, at the same time. The model is the
+    same as CompactMarkov(messages, state_size).
+
+    There are as many parts as there are worker processes, unless parts is
+    given. timeout is in seconds, as for Workers.run."""
+    if parts is None:
+        parts = WORKERS.processes
+    size = max(-(-len(messages) // parts), 1)
+    tasks = [
+        gevent.spawn(
+            WORKERS.run,
+            timeout,
+            _count_part,
+            messages[start : start + size],
+            state_size,
+        )
+        for start in range(0, len(messages), size)
+    ]
+    try:
+        gevent.joinall(tasks, raise_error=True)
+    finally:
+        # Stops the other parts if one of them failed
+        gevent.killall(tasks)
+    return CompactMarkov.from_parts(state_size, [task.value for task in tasks])
+
+
+def _count_part(messages, state_size):
+    """Reads and counts one part of the messages for build_parallel. Returns
+    the words, sentences and text of a model of the part, as they would be
+    in CompactMarkov, and the distinct grams in it with their counts."""
+    part = CompactMarkov([], state_size)
+    part.corpus, part.starts = part._read(messages)
+    grams, counts = count_grams(part.corpus, part.starts, state_size)
+    return part.words, part.corpus, part.starts, part._rejoin(), grams, counts
+
+
+def _sum_grams(grams, counts):
+    """Adds together the counts of the same grams. Returns the distinct grams
+    in order and their counts."""
+    bits = _id_bits(grams.max() + 1 if grams.size > 0 else 1)
+    keys, inverse = np.unique(_gram_keys(grams, bits), return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(keys))
+    return (
+        _from_gram_keys(keys, grams.shape[1], bits),
+        counts.astype(np.int64),
+    )
+
+
+def _add_grams(grams, counts, changes, changed_counts, bits):
+    """Adds changes to the counts of distinct grams, both in order. Grams
+    that weren't there are put in their places, and grams whose counts come
+    to 0 are dropped. The word IDs must be less than 2 ** bits. Returns the
+    distinct grams in order and their counts.
+
+    Only the changes are sorted, so this takes much less time than adding
+    up the counts again when there are few of them."""
+    width = grams.shape[1]
+    keys = _gram_keys(grams, bits)
+    changed_keys = _gram_keys(changes, bits)
+    places = np.searchsorted(keys, changed_keys)
+    found = places < len(keys)
+    found[found] = keys[places[found]] == changed_keys[found]
+    counts = counts.copy()
+    counts[places[found]] += changed_counts[found]
+    new = ~found
+    keys = np.insert(keys, places[new], changed_keys[new])
+    counts = np.insert(counts, places[new], changed_counts[new])
+    kept = counts > 0
+    return _from_gram_keys(keys[kept], width, bits), counts[kept]
+
+
+def _gram_keys(grams, bits):
+    """Turns each row of an array of grams into a single value, which sort
+    in the same order as the rows. The word IDs must be less than 2 ** bits.
+
+    If they all fit, the IDs of a gram are packed into one integer, which
+    sorts much more quickly than the bytes of the row do."""
+    width = grams.shape[1]
+    if bits * width < 64:
+        keys = np.zeros(len(grams), dtype=np.int64)
+        for column in range(width):
+            keys <<= bits
+            keys |= grams[:, column]
+        return keys
+    grams = np.ascontiguousarray(grams, dtype='>i4')
+    return grams.view(np.dtype((np.void, width * 4))).ravel()
+
+
+def _from_gram_keys(keys, width, bits):
+    """Turns the values made by _gram_keys back into rows."""
+    if keys.dtype == np.int64:
+        mask = (1 << bits) - 1
+        return np.column_stack(
+            [
+                (keys >> (bits * (width - 1 - column))) & mask
+                for column in range(width)
+            ]
+        ).astype(np.int32)
+    grams = np.frombuffer(keys.tobytes(), dtype='>i4').reshape(-1, width)
+    return grams.astype(np.int32)
+
+
+def _id_bits(word_count):
+    """How many bits it takes to hold any of word_count word IDs."""
+    return max(int(word_count - 1).bit_length(), 1)
+
+
+def _to_array(typecode, values):
+    """Copies a sequence of numbers into an array.array, which is quicker to
+    read one number at a time than a NumPy array."""
+    values = np.asarray(values, dtype=np.dtype(typecode))
+    result = array(typecode)
+    result.frombytes(values.tobytes())
+    return result
+
+
+def _text_array(text):
+    """Stores text as a NumPy array of bytes, to be saved with np.savez."""
+    return np.frombuffer(text.encode(), dtype=np.uint8)
+
+
+class ModelCache:
+    """Markov models, each kept with the newest message that it knows about.
+
+    Models are keyed by a tuple that describes the messages that they were
+    made from. The size of a model is the size of it when saved, which is
+    roughly in proportion to the memory that it takes up. budget is in bytes,
+    and is kept to both in memory and on disk. If directory is None, models are
+    only kept in memory.
+
+    A model that has been updated is saved again once save_interval seconds
+    have passed since it was last saved.
+
+    Models are serialised, compressed, written and read on a thread of the
+    cache's own, so that other greenlets can run meanwhile.
+    """
+
+    def __init__(self, directory, budget, save_interval=600):
+        self.directory = None if directory is None else pathlib.Path(directory)
+        self.budget = budget
+        self.save_interval = save_interval
+        # {key: (model, metadata)}, least recently used first
+        self._models = OrderedDict()
+        self._size = 0
+        # {key: when it was last saved}
+        self._saved = {}
+        # The keys of models that have changed since they were saved
+        self._changed = set()
+        # One thread, so that the files are written in order
+        self._disk = gevent.threadpool.ThreadPool(1)
+
+    def get(self, key):
+        """Gets the model for a key and its metadata, or (None, None). The
+        model may be older than the newest message."""
+        entry = self._models.get(key)
+        if entry is None:
+            entry = self._disk.apply(self._load, (key,))
+            if entry is None:
+                return None, None
+            self._remember(key, *entry)
+            self._saved[key] = time.monotonic()
+        self._models.move_to_end(key)
+        if self.directory is not None:
+            # Marks it as recently used on disk as well
+            try:
+                os.utime(self._path(key, ".meta.json"))
+            except FileNotFoundError:
+                pass
+        return entry
+
+    def put(self, key, model, newest):
+        """Stores the model for a key, replacing any older one. Returns its
+        metadata."""
+        data = self._disk.apply(model.to_bytes)
+        metadata = {
+            'key': repr(key),
+            'model': type(model).__name__,
+            'newest': newest,
+            'sentences': len(model),
+            'state_size': model.state_size,
+            'size': len(data),
+        }
+        self._forget(key, save=False)
+        self._remember(key, model, metadata)
+        self._save(key, data, metadata)
+        return metadata
+
+    def update(self, key, newest, model=None):
+        """Records that the model for a key has been updated in place, up to
+        the newest message, or replaced by an updated copy of it, model.
+        Returns its metadata.
+
+        If the model was evicted while it was being updated, it is stored
+        again as with put, so model must be given if that could happen."""
+        if key not in self._models:
+            return self.put(key, model, newest)
+        if model is None:
+            model, metadata = self._models[key]
+        else:
+            metadata = self._models[key][1]
+            self._models[key] = model, metadata
+        metadata['newest'] = newest
+        metadata['sentences'] = len(model)
+        self._changed.add(key)
+        if (
+            time.monotonic() - self._saved.get(key, 0) >= self.save_interval
+            and self.directory is not None
+        ):
+            data = self._disk.apply(model.to_bytes)
+            self._size += len(data) - metadata['size']
+            metadata['size'] = len(data)
+            self._save(key, data, metadata)
+        return metadata
+
+    def clear(self):
+        """Forgets every model, in memory and on disk."""
+        self._models.clear()
+        self._size = 0
+        self._saved.clear()
+        self._changed.clear()
+        if self.directory is not None and self.directory.exists():
+            for path in self.directory.glob("*.meta.json"):
+                _unlink(path.with_name(path.name[: -len(".meta.json")]))
+
+    def _remember(self, key, model, metadata):
+        """Keeps a model in memory, evicting others to stay in budget."""
+        self._models[key] = model, metadata
+        self._size += metadata['size']
+        while self._size > self.budget and len(self._models) > 1:
+            evicted = next(iter(self._models))
+            self._forget(evicted)
+
+    def _forget(self, key, save=True):
+        """Drops a model from memory. If it has changed since it was saved,
+        it is saved first, unless save is False."""
+        entry = self._models.pop(key, None)
+        if entry is None:
+            return
+        model, metadata = entry
+        self._size -= metadata['size']
+        if save and key in self._changed:
+            # Serialised here, as whoever is using the model could change it
+            # once it's evicted
+            self._save(key, model.to_bytes(), metadata)
+        self._saved.pop(key, None)
+        self._changed.discard(key)
+
+    def _save(self, key, data, metadata):
+        """Saves a model to disk."""
+        self._saved[key] = time.monotonic()
+        self._changed.discard(key)
+        if self.directory is None:
+            return
+        # Models that are in memory were used more recently than any that
+        # aren't, and are in order already
+        recent = {
+            self._path(key, ".meta.json").name: order
+            for order, key in enumerate(self._models)
+        }
+        self._disk.apply(
+            self._write_files,
+            (key, data, json.dumps(metadata).encode(), recent),
+        )
+
+    def _write_files(self, key, data, metadata, recent):
+        """Writes the files of a model to disk, then prunes the models there.
+        Runs on the cache's thread."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # The metadata goes last so that a model is never found half written
+        _write(self._path(key, ".model.gz"), gzip.compress(data))
+        _write(self._path(key, ".meta.json"), metadata)
+        self._prune(recent)
+
+    def _read_metadata(self, key):
+        """Reads the metadata of the model for a key from disk."""
+        try:
+            with open(self._path(key, ".meta.json")) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _load(self, key):
+        """Loads the model for a key from disk. Runs on the cache's thread."""
+        if self.directory is None:
+            return None
+        metadata = self._read_metadata(key)
+        if metadata is None:
+            return None
+        model_class = _MODEL_CLASSES.get(metadata.get('model'))
+        if model_class is None:
+            return None
+        try:
+            with gzip.open(self._path(key, ".model.gz")) as file:
+                model = model_class.from_bytes(file.read())
+        except (OSError, ValueError, KeyError):
+            return None
+        return model, metadata
+
+    def _prune(self, recent):
+        """Deletes the least recently used models on disk until they are in
+        budget. recent is the order in which the models in memory were used,
+        by the name of their metadata file."""
+        entries = []
+        for path in self.directory.glob("*.meta.json"):
+            try:
+                with open(path) as file:
+                    size = json.load(file)['size']
+                entries.append(
+                    (
+                        recent.get(path.name, -1),
+                        path.stat().st_mtime,
+                        size,
+                        path,
+                    )
+                )
+            except (OSError, ValueError, KeyError):
+                continue
+        total = sum(entry[2] for entry in entries)
+        entries.sort()
+        for _, _, size, path in entries[:-1]:
+            if total <= self.budget:
+                break
+            _unlink(path.with_name(path.name[: -len(".meta.json")]))
+            total -= size
+
+    def _path(self, key, suffix):
+        """Gets the path of one of the files for a key."""
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return self.directory / (name + suffix)
+
+
+# The classes of models that can be loaded from disk
+_MODEL_CLASSES = {
+    model_class.__name__: model_class
+    for model_class in [MarkovFromList, CompactMarkov]
+}
+
+
+def _write(path, data):
+    """Replaces a file in one go, so that it is never seen half written."""
+    temporary = path.with_name(path.name + ".tmp")
+    with open(temporary, 'wb') as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+def _unlink(stem):
+    """Deletes a model and its metadata, given the path without suffixes."""
+    for suffix in [".meta.json", ".model.gz"]:
+        try:
+            stem.with_name(stem.name + suffix).unlink()
+        except FileNotFoundError:
+            pass
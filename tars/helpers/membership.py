@@ -0,0 +1,214 @@
+"""membership.py
+
+Keeps track of who is in each channel that the bot is in, and their modes.
+
+The members of a channel are read from the NAMES list that the server sends
+when the bot joins it. After that, JOIN, PART, QUIT, KICK, NICK and MODE
+messages keep them up to date, and a NAMES list is only needed now and again
+to catch anything that was missed.
+
+Every change returns the (channel, nick) pairs that it affected, so that the
+database only needs to save those.
+"""
+
+from gevent import monkey
+
+from tars.helpers.catalogue import nocase
+
+# Channel member prefixes, from highest to lowest
+PREFIXES = "~&@%+"
+
+# The channel modes that give each prefix
+MODE_PREFIXES = {'q': '~', 'a': '&', 'o': '@', 'h': '%', 'v': '+'}
+
+# Other channel modes that take a parameter, either always or only when set
+_PARAMETER_MODES = set("beIkfjL")
+_SET_PARAMETER_MODES = set("l")
+
+
+def parse_modes(modes, params):
+    """Reads a channel MODE change into changes to members' prefixes.
+
+    modes is the mode string, e.g. "+o-v", and params are the parameters
+    after it. Returns a list of (nick, prefix, added) tuples. Modes that don't
+    give a prefix are skipped, along with their parameters.
+    """
+    params = list(params)
+    changes = []
+    adding = True
+    for mode in modes:
+        if mode in "+-":
+            adding = mode == "+"
+        elif mode in MODE_PREFIXES:
+            if len(params) > 0:
+                changes.append((params.pop(0), MODE_PREFIXES[mode], adding))
+        elif mode in _PARAMETER_MODES or (
+            adding and mode in _SET_PARAMETER_MODES
+        ):
+            if len(params) > 0:
+                params.pop(0)
+    return changes
+
+
+class ChannelMembership:
+    """The members of each channel and the prefixes that they have.
+
+    A channel is tracked from when start() is called for it, and its members
+    are known once its first NAMES list has arrived; until then, members()
+    returns None for it. NAMES lists for other channels are ignored.
+    """
+
+    def __init__(self):
+        self._lock = monkey.get_original('threading', 'Lock')()
+        # {channel: {nick: [nick, {prefix}]}}, keyed by nocase
+        self._channels = {}
+        # The channels being tracked, by nocase
+        self._channel_names = {}
+        # NAMES lists that are still arriving
+        self._names = {}
+
+    def channels(self):
+        """Gets the names of the channels that are being tracked."""
+        with self._lock:
+            return list(self._channel_names.values())
+
+    def members(self, channel):
+        """Gets a list of (nick, prefix) for everyone in a channel, where
+        prefix is their highest prefix or None. Returns None if who is in the
+        channel isn't known."""
+        if channel is None:
+            return None
+        with self._lock:
+            members = self._channels.get(nocase(channel))
+            if members is None:
+                return None
+            return [
+                (nick, _highest(prefixes))
+                for nick, prefixes in members.values()
+            ]
+
+    def start(self, channel):
+        """Starts tracking a channel, e.g. when the bot joins it. Its members
+        are forgotten until the next NAMES list."""
+        key = nocase(channel)
+        with self._lock:
+            self._channels.pop(key, None)
+            self._channel_names[key] = channel
+            self._names.pop(key, None)
+
+    def add_names(self, channel, names):
+        """Collects part of a NAMES list. names is a list of (nick, prefix)."""
+        with self._lock:
+            self._names.setdefault(nocase(channel), []).extend(names)
+
+    def end_names(self, channel):
+        """Replaces the members of a channel with the NAMES list that has
+        been collected for it.
+
+        Returns (changes, first) where first is whether the channel was not
+        being tracked before. If it was, changes only contains the members
+        that were different in the NAMES list.
+        """
+        key = nocase(channel)
+        with self._lock:
+            names = self._names.pop(key, [])
+            if key not in self._channel_names:
+                return [], False
+            channel = self._channel_names[key]
+            old = self._channels.get(key)
+            new = {}
+            for nick, prefix in names:
+                new[nocase(nick)] = [
+                    nick,
+                    set() if prefix is None else {prefix},
+                ]
+            self._channels[key] = new
+            if old is None:
+                return [(channel, nick) for nick, _ in new.values()], True
+            changes = []
+            for nick in old.keys() | new.keys():
+                if nick not in old or nick not in new:
+                    changes.append((channel, (old.get(nick) or new[nick])[0]))
+                elif _highest(old[nick][1]) != _highest(new[nick][1]):
+                    changes.append((channel, new[nick][0]))
+            return changes, False
+
+    def forget(self, channel):
+        """Stops tracking a channel, e.g. when the bot leaves it."""
+        key = nocase(channel)
+        with self._lock:
+            self._channels.pop(key, None)
+            self._channel_names.pop(key, None)
+            self._names.pop(key, None)
+
+    def join(self, channel, nick):
+        """Someone joined a channel."""
+        with self._lock:
+            members = self._channels.get(nocase(channel))
+            if members is None or nocase(nick) in members:
+                return []
+            members[nocase(nick)] = [nick, set()]
+            return [(self._channel_names[nocase(channel)], nick)]
+
+    def part(self, channel, nick):
+        """Someone left or was kicked from a channel."""
+        with self._lock:
+            members = self._channels.get(nocase(channel))
+            if members is None or nocase(nick) not in members:
+                return []
+            nick, _ = members.pop(nocase(nick))
+            return [(self._channel_names[nocase(channel)], nick)]
+
+    def quit(self, nick):
+        """Someone left every channel."""
+        with self._lock:
+            changes = []
+            for key, members in self._channels.items():
+                member = members.pop(nocase(nick), None)
+                if member is not None:
+                    changes.append((self._channel_names[key], member[0]))
+            return changes
+
+    def rename(self, old, new):
+        """Someone changed their nick."""
+        with self._lock:
+            changes = []
+            for key, members in self._channels.items():
+                member = members.pop(nocase(old), None)
+                if member is None:
+                    continue
+                members[nocase(new)] = [new, member[1]]
+                changes.append((self._channel_names[key], member[0]))
+                changes.append((self._channel_names[key], new))
+            return changes
+
+    def set_modes(self, channel, modes):
+        """Someone's prefixes changed. modes is a list of (nick, prefix,
+        added), as returned by parse_modes()."""
+        with self._lock:
+            members = self._channels.get(nocase(channel))
+            if members is None:
+                return []
+            changes = []
+            for nick, prefix, added in modes:
+                member = members.get(nocase(nick))
+                if member is None:
+                    continue
+                before = _highest(member[1])
+                if added:
+                    member[1].add(prefix)
+                else:
+                    member[1].discard(prefix)
+                if _highest(member[1]) != before:
+                    changes.append(
+                        (self._channel_names[nocase(channel)], member[0])
+                    )
+            return changes
+
+
+def _highest(prefixes):
+    """Gets the highest of a set of prefixes, or None."""
+    for prefix in PREFIXES:
+        if prefix in prefixes:
+            return prefix
+    return None
@@ -0,0 +1,339 @@
+"""query.py
+
+Compiles searches for articles and chat messages into SQL.
+
+An article search is a list of criteria, as taken by DB.get_articles. Tag,
+author and title criteria are answered from indexes as sets of article IDs,
+which are combined with INTERSECT and EXCEPT. Every other criterion is a
+condition that is checked against the articles in that set, cheapest and most
+selective first, going by statistics about the articles that the database
+driver collects.
+
+The values in a search are always bound as parameters rather than being
+written into the SQL, so the SQL only depends on the shape of the search -
+which criteria it has and how many terms each has. The SQL for each shape is
+made once and cached, and as the SQL is the same each time, so is SQLite's
+compiled statement."""
+
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from functools import lru_cache
+
+from tars.helpers import regexplan
+from tars.helpers.catalogue import nocase
+
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+# How expensive each kind of condition is to check for an article
+_CHEAP = 0
+_SUBSTRING = 1
+_REGEX = 2
+
+# The articles that each tag or author is attached to. For authors, only the
+# most authoritative attributions count - those from metadata, if there are any
+_TAGGED = "SELECT article_id FROM articles_tags WHERE tag=?"
+_AUTHORED = (
+    "SELECT article_id FROM articles_authors AS au "
+    "WHERE author=? AND metadata=("
+    "SELECT MAX(metadata) FROM articles_authors "
+    "WHERE article_id=au.article_id)"
+)
+_TITLED = "SELECT rowid FROM articles_fts WHERE articles_fts MATCH ?"
+
+
+def fts_query(terms):
+    """Makes an FTS5 query for text that contains all of the given terms.
+    The trigram tokenizer can only look up terms of at least 3 characters, so
+    shorter terms are left out. Returns None if no terms are left."""
+    terms = [term for term in terms if len(term) >= 3]
+    if len(terms) == 0:
+        return None
+    return " AND ".join(
+        '"{}"'.format(term.replace('"', '""')) for term in terms
+    )
+
+
+class SearchStatistics:
+    """How the articles are spread over the values that can be searched for,
+    for estimating how many articles a criterion will match."""
+
+    def __init__(self, ratings, dates, categories, parents, tags, authors):
+        self.total = max(len(ratings), 1)
+        self.ratings = sorted(ratings)
+        self.dates = sorted(dates)
+        self.categories = Counter(categories)
+        self.parents = Counter(parents)
+        self.tags = Counter(nocase(tag) for tag in tags)
+        self.authors = Counter(nocase(author) for author in authors)
+
+    def between(self, values, low, high):
+        """The share of articles with a value between low and high."""
+        start = 0 if low is None else bisect_left(values, low)
+        end = len(values) if high is None else bisect_right(values, high)
+        return max(end - start, 0) / self.total
+
+    def share(self, counts, keys):
+        """The share of articles with any of the given values."""
+        return sum(counts[key] for key in keys) / self.total
+
+
+def compile_article_search(searches, statistics, titles_indexed=True):
+    """Compiles a search into SQL that selects the IDs of the articles that
+    match it. Returns the SQL and its parameters."""
+    # Sets of articles that all have to contain a match
+    members = []
+    # Sets of articles that can't contain a match
+    exclusions = []
+    # (cost, share, sql, parameters) for each condition on an article
+    conditions = []
+    for search in searches:
+        kind, term = search['type'], search['term']
+        if kind == 'rating':
+            share = statistics.between(
+                statistics.ratings, term['min'], term['max']
+            )
+            if term['max'] is not None:
+                conditions.append((_CHEAP, share, "rating<=?", [term['max']]))
+            if term['min'] is not None:
+                conditions.append((_CHEAP, share, "rating>=?", [term['min']]))
+        elif kind == 'date':
+            low, high = [
+                None if term[end] is None else term[end].int_timestamp
+                for end in ('min', 'max')
+            ]
+            share = statistics.between(statistics.dates, low, high)
+            if high is not None:
+                conditions.append((_CHEAP, share, "date_posted<=?", [high]))
+            if low is not None:
+                conditions.append((_CHEAP, share, "date_posted>=?", [low]))
+        elif kind == 'parent':
+            share = statistics.share(statistics.parents, [term])
+            conditions.append((_CHEAP, share, "parent=?", [term]))
+        elif kind == 'category':
+            for categories, operator in [
+                (term['include'], "IN"),
+                (term['exclude'], "NOT IN"),
+            ]:
+                if len(categories) == 0:
+                    continue
+                share = statistics.share(statistics.categories, categories)
+                if operator == "NOT IN":
+                    share = 1 - share
+                conditions.append(
+                    (
+                        _CHEAP,
+                        share,
+                        "category {} ({})".format(
+                            operator, ",".join("?" * len(categories))
+                        ),
+                        list(categories),
+                    )
+                )
+        elif kind in ('tags', 'author'):
+            sql, counts = (
+                (_TAGGED, statistics.tags)
+                if kind == 'tags'
+                else (_AUTHORED, statistics.authors)
+            )
+            for key in term['include']:
+                share = statistics.share(counts, [nocase(key)])
+                members.append((share, sql, [key]))
+            for key in term['exclude']:
+                exclusions.append((sql, [key]))
+        elif kind is None:
+            index_query = fts_query([term])
+            if titles_indexed and index_query is not None:
+                # The index doesn't say how many titles a term is in, but
+                # anything long enough to be looked up is usually rare
+                members.append((0, _TITLED, [index_query]))
+            # title_lc was lowercased by Python, so it knows more than ASCII
+            sql, parameters = _contains("scp_num", term)
+            conditions.append(
+                (
+                    _SUBSTRING,
+                    1,
+                    "(instr(title_lc, ?)>0 OR {})".format(sql),
+                    [term.lower()] + parameters,
+                )
+            )
+        elif kind == 'regex':
+            plan = regexplan.plan(term)
+            for literal in plan.required:
+                conditions.append(
+                    (_SUBSTRING, 1, "instr(title_lc, ?)>0", [literal])
+                )
+            if plan.forbidden is not None:
+                conditions.append(
+                    (_SUBSTRING, 1, "instr(title_lc, ?)=0", [plan.forbidden])
+                )
+            conditions.append((_REGEX, 1, "title REGEXP ?", [term]))
+        elif kind == 'url':
+            conditions.append((_CHEAP, 1 / statistics.total, "url=?", [term]))
+        else:
+            raise TypeError("Unknown search: {}/{}".format(kind, term))
+    # The smallest sets go first, to keep the intermediate results small
+    members.sort(key=lambda member: member[0])
+    if len(members) > 0 or len(exclusions) > 0:
+        conditions.append(
+            (
+                _CHEAP,
+                members[0][0] if len(members) > 0 else 1,
+                (
+                    tuple(sql for _, sql, _ in members),
+                    tuple(sql for sql, _ in exclusions),
+                ),
+                [p for _, _, parameters in members for p in parameters]
+                + [p for _, parameters in exclusions for p in parameters],
+            )
+        )
+    # SQLite checks the conditions in the order they are written
+    conditions.sort(key=lambda condition: condition[:2])
+    return (
+        _article_template(tuple(sql for _, _, sql, _ in conditions)),
+        [p for _, _, _, parameters in conditions for p in parameters],
+    )
+
+
+@lru_cache(maxsize=256)
+def _article_template(conditions):
+    """Makes the SQL for an article search from its conditions, in order.
+    Sets of articles are given as (members, exclusions) of SQL for each."""
+    where = []
+    for condition in conditions:
+        if isinstance(condition, str):
+            where.append(condition)
+        elif len(condition[0]) > 0:
+            members, exclusions = condition
+            where.append(
+                "id IN ({})".format(
+                    " EXCEPT ".join([" INTERSECT ".join(members), *exclusions])
+                )
+            )
+        else:
+            where.append("id NOT IN ({})".format(" UNION ".join(condition[1])))
+    sql = "SELECT id FROM articles"
+    if len(where) > 0:
+        sql += " WHERE " + " AND ".join(where)
+    return sql
+
+
+def compile_message_search(
+    channel_ids,
+    senders_in=(),
+    senders_out=(),
+    patterns=(),
+    contains=(),
+    minlength=None,
+    limit=-1,
+    after=None,
+    before=None,
+    indexed=True,
+    lowered=True,
+):
+    """Compiles a search for chat messages into SQL that selects their text,
+    most recent first. Returns the SQL and its parameters.
+
+    after is the ID of a message that the messages must be newer than, and
+    before is the ID of one that they must be no newer than.
+    indexed and lowered say whether messages_fts and messages.message_lc
+    exist."""
+    # The shape is the number of channels and senders, whether the index is
+    # used, (required, forbidden) for each pattern, whether each substring is
+    # ASCII, and whether there is a minimum length, messages to be newer and
+    # no newer than, and a limit
+    shape = [len(channel_ids), len(senders_in), len(senders_out)]
+    parameters = [*channel_ids, *senders_in, *senders_out]
+    # Use the message index to narrow down the messages that need to be
+    # checked against regexes and substrings
+    plans = [regexplan.plan(pattern) for pattern in patterns]
+    index_query = fts_query(
+        [literal for plan in plans for literal in plan.required]
+        + list(contains)
+    )
+    if not indexed or index_query is None:
+        shape.append(False)
+    else:
+        shape.append(True)
+        parameters.append(index_query)
+    for pattern, plan in zip(patterns, plans):
+        shape.append((len(plan.required), plan.forbidden is not None))
+        parameters.extend(plan.required)
+        if plan.forbidden is not None:
+            parameters.append(plan.forbidden)
+        parameters.append(pattern)
+    for term in contains:
+        shape.append(term.isascii())
+        parameters.append(term.lower() if term.isascii() else re.escape(term))
+    shape.append(minlength is not None)
+    if minlength is not None:
+        parameters.append(minlength)
+    shape.append(after is not None)
+    if after is not None:
+        parameters.append(after)
+    shape.append(before is not None)
+    if before is not None:
+        parameters.append(before)
+    shape.append(limit >= 0)
+    if limit >= 0:
+        parameters.append(limit)
+    shape.append(lowered)
+    return _message_template(tuple(shape)), parameters
+
+
+@lru_cache(maxsize=256)
+def _message_template(shape):
+    """Makes the SQL for a message search of the given shape. See
+    compile_message_search for what the shape holds."""
+    shape = list(shape)
+    channels, senders_in, senders_out, indexed = shape[:4]
+    patterns = shape[4:-5]
+    minlength, newer, older, limited, lowered = shape[-5:]
+    message_lc = "message_lc" if lowered else "lower(message)"
+    where = [
+        "channel_id IN ({})".format(",".join("?" * channels)),
+        "command=0",
+        "kind='PRIVMSG'",
+        "ignore=0",
+    ]
+    if senders_in > 0:
+        where.append("sender IN ({})".format(",".join("?" * senders_in)))
+    if senders_out > 0:
+        where.append("sender NOT IN ({})".format(",".join("?" * senders_out)))
+    if indexed:
+        where.append(
+            "id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)"
+        )
+    for pattern in patterns:
+        if isinstance(pattern, tuple):
+            required, forbidden = pattern
+            where.extend(["instr({}, ?)>0".format(message_lc)] * required)
+            if forbidden:
+                where.append("instr({}, ?)=0".format(message_lc))
+            where.append("message REGEXP ?")
+        elif pattern:
+            where.append("instr({}, ?)>0".format(message_lc))
+        else:
+            where.append("message REGEXP ?")
+    if minlength:
+        where.append("length(message)>=?")
+    if newer:
+        where.append("id>?")
+    if older:
+        where.append("id<=?")
+    sql = "SELECT message FROM messages WHERE " + " AND ".join(where)
+    sql += " ORDER BY timestamp DESC"
+    if limited:
+        sql += " LIMIT ?"
+    return sql
+
+
+def _contains(column, term):
+    """Makes the condition for a column to contain a string, ignoring case.
+    SQLite's lower() only knows ASCII, so other strings are checked by regex
+    instead."""
+    if term.isascii():
+        return "instr(lower({}), ?)>0".format(column), [term.lower()]
+    return "{} REGEXP ?".format(column), [re.escape(term)]
@@ -0,0 +1,142 @@
+"""regexplan.py
+
+Plans how to check a regex against the rows of a table.
+
+Running a regex over every row of a table is slow. Most regexes can only match
+text that contains some fixed substrings, though - /the (red|blue) door/ can't
+match anything without "the " and " door" in it - and SQLite can look for
+those natively, or with an index, before the regex itself is run on whatever
+is left.
+
+All regexes used to search the database are case-insensitive, and the
+substrings are lowercased to be compared against lower(column).
+"""
+
+from collections import namedtuple
+from functools import lru_cache
+
+# The standard library's parser is used to analyse the regex even if re2 is
+# what runs it
+import re as sre
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+RegexPlan = namedtuple('RegexPlan', ['compiled', 'required', 'forbidden'])
+RegexPlan.__doc__ = """How to check a regex.
+
+compiled: The compiled regex, which has the final say.
+required: Lowercase substrings that all matching text contains.
+forbidden: A lowercase substring that no matching text contains, or None.
+"""
+
+_REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT}
+if hasattr(sre_parse, 'POSSESSIVE_REPEAT'):
+    _REPEATS.add(sre_parse.POSSESSIVE_REPEAT)
+
+
+def _is_safe(char):
+    """Whether a lowercase character in a regex can be looked for with SQLite.
+
+    SQLite's lower() only folds ASCII, and ignoring case, i, k and s also
+    match non-ASCII letters (İ, ı, K, ſ) that it doesn't fold."""
+    return char.isascii() and char not in "iks"
+
+
+def _literals(subpattern):
+    """Finds the substrings that must appear in any text that a parsed regex
+    matches."""
+    found = []
+    run = []
+    for op, av in subpattern:
+        if op is sre_parse.LITERAL and _is_safe(chr(av).lower()):
+            run.append(chr(av).lower())
+            continue
+        # Anything else interrupts the current run of literal characters
+        if len(run) > 0:
+            found.append("".join(run))
+            run = []
+        if op is sre_parse.SUBPATTERN:
+            found.extend(_literals(av[-1]))
+        elif op in _REPEATS:
+            min_repeats, _, item = av
+            if min_repeats > 0:
+                found.extend(_literals(item))
+        elif op is sre_parse.ASSERT:
+            found.extend(_literals(av[1]))
+        elif op is getattr(sre_parse, 'ATOMIC_GROUP', None):
+            found.extend(_literals(av))
+    if len(run) > 0:
+        found.append("".join(run))
+    return found
+
+
+def _forbidden(parsed):
+    """Recognises the idiom /^((?!abc).)*$/, which matches text that does not
+    contain "abc", and returns the substring it forbids."""
+    if parsed.state.flags & sre.MULTILINE:
+        # Then it would only be forbidden on one line
+        return None
+    items = list(parsed)
+    if (
+        len(items) != 3
+        or items[0] != (sre_parse.AT, sre_parse.AT_BEGINNING)
+        or items[2] != (sre_parse.AT, sre_parse.AT_END)
+        or items[1][0] not in _REPEATS
+        or items[1][1][0] != 0
+    ):
+        return None
+    body = list(items[1][1][2])
+    if len(body) == 1 and body[0][0] is sre_parse.SUBPATTERN:
+        body = list(body[0][1][-1])
+    if (
+        len(body) != 2
+        or body[0][0] is not sre_parse.ASSERT_NOT
+        or body[1][0] is not sre_parse.ANY
+    ):
+        return None
+    direction, assertion = body[0][1]
+    assertion = list(assertion)
+    if direction != 1 or len(assertion) == 0:
+        return None
+    if not all(op is sre_parse.LITERAL for op, _ in assertion):
+        return None
+    text = "".join(chr(av) for _, av in assertion)
+    if not text.isascii():
+        return None
+    return text.lower()
+
+
+@lru_cache(maxsize=256)
+def plan(pattern):
+    """Makes the plan for checking a regex. Plans are cached, so that a
+    regex is compiled once no matter how many rows it is checked against.
+
+    Raises re.error if the regex is invalid."""
+    compiled = re.compile(pattern, re.IGNORECASE)
+    try:
+        parsed = sre_parse.parse(pattern, sre.IGNORECASE)
+    except (sre.error, RecursionError):
+        # Valid for re2 but not for re, so nothing can be planned
+        return RegexPlan(compiled, (), None)
+    required = []
+    # Longest first, as they are the most selective
+    literals = sorted(set(_literals(parsed)), key=lambda l: (-len(l), l))
+    for literal in literals:
+        if not any(literal in other for other in required):
+            required.append(literal)
+    return RegexPlan(compiled, tuple(required), _forbidden(parsed))
+
+
+def search(pattern, text):
+    """Checks whether a regex matches some text. For use as SQL REGEXP."""
+    if text is None:
+        return False
+    return plan(pattern).compiled.search(text) is not None
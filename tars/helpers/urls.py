@@ -0,0 +1,44 @@
+"""urls.py
+
+Finds the links in chat messages, and sorts them into images, YouTube videos
+and everything else.
+
+The links in each message are found when it is logged and saved in the
+message_urls table, so that .gib --media can pick one without searching every
+message in the channel.
+"""
+
+import re
+
+URL_PATT = re.compile(
+    r"https?:\/\/(www\.)?"
+    r"[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,4}"
+    r"\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)",
+    re.IGNORECASE,
+)
+YT_PATT = re.compile(r"^(http(s)?:\/\/)?((w){3}.)?youtu(be|.be)?(\.com)?\/.+")
+IMG_PATT = re.compile(r"(imgur)|(((jpeg)|(jpg)|(png)|(gif)))$")
+
+# The kinds of link
+KINDS = ['image', 'youtube', 'other']
+
+
+def link_kind(url):
+    """Works out whether a link is to a YouTube video, an image or something
+    else."""
+    if YT_PATT.search(url):
+        return 'youtube'
+    if IMG_PATT.search(url):
+        return 'image'
+    return 'other'
+
+
+def find_urls(message):
+    """Finds the different links in a message, in order. Returns a list of
+    (url, kind) tuples."""
+    if "http" not in message.lower():
+        return []
+    urls = dict.fromkeys(
+        match.group(0) for match in URL_PATT.finditer(message)
+    )
+    return [(url, link_kind(url)) for url in urls]
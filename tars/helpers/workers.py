@@ -0,0 +1,168 @@
+"""workers.py
+
+Runs CPU-heavy work in other processes, so that the bot stays responsive
+while it happens.
+
+Everything the bot does happens in one thread, taking turns with gevent. A
+command that spends seconds calculating blocks everything else - including
+answering pings from the IRC server, which gets the bot disconnected.
+WORKERS.run() forks a worker process to do the work and waits for its result
+without blocking anything else.
+
+Because the worker is a fork of the bot, it starts off with everything that
+the bot has in memory, so the function and its arguments don't need to be
+pickled; only its result does. The function must not use the database, IRC or
+anything else that the bot is in the middle of using, and anything it changes
+is lost when the worker exits.
+
+The bot also runs the database's threads, and forking a process with threads
+is only safe if the fork doesn't touch anything that those threads might have
+been holding a lock on when it was made, because only the forking thread is
+copied into the worker, and the locks stay locked there forever. That is why
+the function has to be pure calculation:
+
+* The database threads hold SQLite's locks and the thread pools' locks. The
+  driver refuses to be used from a worker, rather than waiting forever.
+* The output streams may be locked, so a worker's output is thrown away.
+* Python itself resets the GIL, the import lock and the threading module in
+  the worker, and the C library resets malloc's locks.
+
+Forking a pool of workers before the database threads start, or starting
+fresh interpreters, would avoid this, but then every model that a task uses
+would have to be pickled and sent to a worker each time.
+"""
+
+import os
+import pickle
+import signal
+import sys
+import warnings
+
+import gevent
+from gevent import monkey
+from gevent.lock import BoundedSemaphore
+from gevent.socket import wait_read
+
+from tars.helpers.error import MyFaultError
+
+# The functions that gevent hasn't replaced, if it has
+_fork = monkey.get_original('os', 'fork')
+_waitpid = monkey.get_original('os', 'waitpid')
+
+
+class WorkersBusyError(MyFaultError):
+    """Used when too many tasks are already waiting for a worker"""
+
+
+class WorkerTimeoutError(MyFaultError):
+    """Used when a task takes too long"""
+
+
+class WorkerDiedError(Exception):
+    """Used when a worker process exits without sending a result"""
+
+
+class Workers:
+    """Runs functions in worker processes, no more than processes at a time.
+    Up to queue more tasks can wait for a worker; any more than that are
+    turned away."""
+
+    def __init__(self, processes, queue):
+        self.processes = processes
+        self.queue = queue
+        self._running = BoundedSemaphore(processes)
+        # Tasks that are running or waiting to run
+        self._tasks = 0
+
+    def run(self, timeout, function, *args, **kwargs):
+        """Calls a function in a worker process and returns its result,
+        which must be picklable. Exceptions are raised here.
+
+        If the task isn't done after timeout seconds, including any time spent
+        waiting for a worker, WorkerTimeoutError is raised. If that happens,
+        or the greenlet that is waiting is killed, the worker is killed too.
+        """
+        if self._tasks >= self.processes + self.queue:
+            raise WorkersBusyError(
+                "I'm busy with other things right now. Try again in a bit."
+            )
+        self._tasks += 1
+        try:
+            with gevent.Timeout(
+                timeout,
+                WorkerTimeoutError(
+                    "That's taking too long, so I've given up on it."
+                ),
+            ):
+                with self._running:
+                    return self._fork(function, args, kwargs)
+        finally:
+            self._tasks -= 1
+
+    @staticmethod
+    def _fork(function, args, kwargs):
+        """Forks a worker to call a function and waits for its result."""
+        read, write = os.pipe()
+        with warnings.catch_warnings():
+            # Python 3.12+ warns about forking with threads running - see the
+            # top of this file for why it's safe here
+            warnings.simplefilter('ignore', DeprecationWarning)
+            pid = _fork()
+        if pid == 0:
+            os.close(read)
+            _work(write, function, args, kwargs)
+        os.close(write)
+        chunks = []
+        try:
+            while True:
+                wait_read(read)
+                chunk = os.read(read, 2 ** 16)
+                if len(chunk) == 0:
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(read)
+            # The worker has exited already, unless the wait was cut short
+            try:
+                os.kill(pid, signal.SIGKILL)
+                _waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        if len(chunks) == 0:
+            raise WorkerDiedError(
+                "Worker {} died without a result".format(pid)
+            )
+        succeeded, result = pickle.loads(b"".join(chunks))
+        if not succeeded:
+            raise result
+        return result
+
+
+def _work(write, function, args, kwargs):
+    """Calls a function and sends its result or exception down a pipe. This
+    is the whole life of a worker process, and never returns."""
+    try:
+        # The bot's output streams might have been locked by another thread
+        # when this process was forked
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+        try:
+            result = True, function(*args, **kwargs)
+        except Exception as error:
+            result = False, error
+        try:
+            data = pickle.dumps(result)
+        except Exception as error:
+            data = pickle.dumps(
+                (False, TypeError("Unpicklable result: {}".format(error)))
+            )
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(write, view) :]
+    finally:
+        os._exit(0)
+
+
+# Shared by every command, so that the limits apply to all of them together.
+# There is a process for each core, but at least two, so that one long task
+# doesn't hold up everything else
+WORKERS = Workers(processes=max(os.cpu_count() or 1, 2), queue=4)
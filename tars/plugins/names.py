@@ -1,6 +1,11 @@
 '''Names Plugin
 
-Whenever we gets a NAMES response from the server, save that info to the db.
+Keeps track of who is in each channel, and saves it to the db.
+
+The NAMES list that the server sends when we join a channel says who is in it,
+and after that JOIN, PART, QUIT, KICK, NICK and MODE messages say how that
+changes. Every so often we ask for the NAMES lists again, in case anything was
+missed.
 '''
 
 # Hey there deadname, I haven't seen you go by this name before.
@@ -13,6 +18,7 @@ from pyaib.signals import emit_signal
 from tars.helpers.parse import nickColor
 from tars.helpers.database import DB
 from tars.helpers.defer import get_users
+from tars.helpers.membership import parse_modes
 
 
 def nameprint(text, error=False):
@@ -24,38 +30,85 @@ def nameprint(text, error=False):
 
 @plugin_class('names')
 class Names:
+    # How often, in seconds, to check the NAMES lists for missed changes
+    reconcile_interval = 1800
+
     def __init__(self, irc_c, config):
         print('Names Plugin Loaded!')
 
+    @observe('IRC_ONCONNECT')
+    def start_reconciling(self, irc_c):
+        irc_c.timers.clear("names", self.reconcile)
+        irc_c.timers.set(
+            "names", self.reconcile, every=self.reconcile_interval
+        )
+
+    def reconcile(self, irc_c, timertext):
+        for channel in DB.members.channels():
+            get_users(irc_c, channel)
+
+    def save(self, irc_c, changes):
+        """Saves changes to the members of channels to the db."""
+        if len(changes) == 0:
+            return
+        try:
+            DB.save_members(changes)
+        except Exception as e:
+            irc_c.RAW("PRIVMSG #tars NAMES error: " + str(e))
+            raise
+
     @observe('IRC_MSG_353')  # 353 is a NAMES response
     def record_names(self, irc_c, msg):
         # msg.args is a string
         # "TARS = #channel :name1 name2 name3 name4"
+        # Long lists are split over several responses
         nicks = re.split(r"\s:?", msg.args.strip())
         nicks = nicks[2:]
         channel = nicks.pop(0)
-        names = [{'nick': name} for name in nicks]
+        names = []
         # chatstaff names start with a punctuation
-        for key, name in enumerate(names):
-            if name['nick'][0] in '+%@&~':
-                names[key] = {
-                    'nick': name['nick'][1:],
-                    'mode': name['nick'][0],
-                }
+        for nick in nicks:
+            if nick[0] in '+%@&~':
+                names.append((nick[1:], nick[0]))
             else:
-                names[key] = {'nick': name['nick'], 'mode': None}
-        # just need to log these names to the db now
-        nameprint(
-            "Updating NAMES for {}: {}".format(
-                nickColor(channel),
-                ", ".join(nickColor(nick) for nick in sorted(nicks)),
+                names.append((nick, None))
+        DB.members.add_names(channel, names)
+
+    @observe('IRC_MSG_366')  # 366 is the end of a NAMES response
+    def end_names(self, irc_c, msg):
+        # "TARS #channel :End of /NAMES list."
+        channel = msg.args.split()[1]
+        changes, first = DB.members.end_names(channel)
+        members = DB.members.members(channel)
+        if members is None:
+            # Not a channel that we're in
+            return
+        if first:
+            nameprint(
+                "Updating NAMES for {}: {}".format(
+                    nickColor(channel),
+                    ", ".join(
+                        nickColor(nick) for nick, _ in sorted(members)
+                    ),
+                )
             )
-        )
-        try:
-            DB.sort_names(channel, names)
-        except Exception as e:
-            irc_c.RAW("PRIVMSG #tars NAMES error: " + str(e))
-            raise
+            try:
+                DB.sort_names(
+                    channel,
+                    [{'nick': nick, 'mode': mode} for nick, mode in members],
+                )
+            except Exception as e:
+                irc_c.RAW("PRIVMSG #tars NAMES error: " + str(e))
+                raise
+        elif len(changes) > 0:
+            nameprint(
+                "NAMES for {} had missed changes to: {}".format(
+                    nickColor(channel),
+                    ", ".join(nickColor(nick) for _, nick in changes),
+                ),
+                True,
+            )
+            self.save(irc_c, changes)
         # broadcast this info to whatever needs it
         emit_signal(irc_c, 'NAMES_RESPONSE', data=channel)
 
@@ -68,14 +121,42 @@ class Names:
         except Exception as e:
             irc_c.RAW("PRIVMSG #tars NAMES error: " + str(e))
             raise
+        self.save(irc_c, DB.members.rename(msg.nick, msg.args))
 
     @observe('IRC_MSG_JOIN')
     def join_names(self, irc_c, msg):
-        # make sure the names are always up to date
-        get_users(irc_c, msg.raw_channel)
+        if msg.nick.lower() == irc_c.botnick.lower():
+            # The server is about to send the NAMES list
+            DB.members.start(msg.raw_channel)
+        else:
+            self.save(irc_c, DB.members.join(msg.raw_channel, msg.nick))
 
     @observe('IRC_MSG_PART')
     def part_names(self, irc_c, msg):
-        # make sure the names are always up to date
-        for channel in DB.get_all_channels():
-            get_users(irc_c, channel)
+        if msg.nick.lower() == irc_c.botnick.lower():
+            DB.members.forget(msg.raw_channel)
+        else:
+            self.save(irc_c, DB.members.part(msg.raw_channel, msg.nick))
+
+    @observe('IRC_MSG_KICK')
+    def kick_names(self, irc_c, msg):
+        # "#channel victim :reason"
+        channel, victim = msg.args.split()[:2]
+        if victim.lower() == irc_c.botnick.lower():
+            DB.members.forget(channel)
+        else:
+            self.save(irc_c, DB.members.part(channel, victim))
+
+    @observe('IRC_MSG_QUIT')
+    def quit_names(self, irc_c, msg):
+        self.save(irc_c, DB.members.quit(msg.nick))
+
+    @observe('IRC_MSG_MODE')
+    def mode_names(self, irc_c, msg):
+        # "#channel +o-v nick1 nick2"
+        params = [param.lstrip(':') for param in msg.args.split()]
+        if len(params) < 2 or not params[0].startswith('#'):
+            # Modes of users rather than channels
+            return
+        modes = parse_modes(params[1], params[2:])
+        self.save(irc_c, DB.members.set_modes(params[0], modes))
@@ -0,0 +1,111 @@
+import copy
+import random
+
+import pendulum
+import pytest
+
+from tars.helpers.config import CONFIG
+from tars.helpers.database import SqliteDriver, reservoir_sample
+
+
+def test_reservoir_sample():
+    random.seed(0)
+    sample = reservoir_sample(iter(range(1000)), 10)
+    assert len(set(sample)) == len(sample) == 10
+    assert set(sample) <= set(range(1000))
+    # The items are kept in the order that they came in
+    assert sample == sorted(sample)
+    # Fewer items than asked for are all kept
+    assert reservoir_sample(iter(range(5)), 10) == [0, 1, 2, 3, 4]
+    assert reservoir_sample(iter([]), 10) == []
+    assert reservoir_sample(iter(range(5)), 0) == []
+    # Every item has a chance of being picked, not only the first ones
+    picked = set()
+    for _ in range(200):
+        picked.update(reservoir_sample(iter(range(20)), 2))
+    assert picked == set(range(20))
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A database of its own, with a few hundred articles in it."""
+    monkeypatch.setitem(
+        CONFIG['db']['driver.database'], 'path', str(tmp_path / "tars.db")
+    )
+    db = SqliteDriver()
+    rng = random.Random(1)
+    tags = ['scp', 'tale', 'joke', 'euclid', 'keter', 'goi-format']
+    authors = ['Alice', 'bob', 'Carol']
+    words = ['bear', 'cone', 'sculpture', 'über', 'red', 'SCP']
+    for index in range(300):
+        article = {
+            'fullname': rng.choice(['', '', 'theme:', 'fragment:'])
+            + "page-{}".format(index),
+            'title': " ".join(rng.sample(words, 2)),
+            'rating': rng.randint(-20, 200),
+            'created_at': "20{}-01-01".format(rng.randint(10, 22)),
+            'parent_fullname': rng.choice([None, 'page-1', 'page-2']),
+            'tags': rng.sample(tags, rng.randint(0, 3)),
+            'created_by': rng.choice(authors),
+        }
+        if index % 2 == 0:
+            article['meta_title'] = article['title']
+            article['title'] = "SCP-{}".format(index)
+        db.add_article(article, commit=False)
+    db.commit()
+    db.delete_article('page-5')
+    return db
+
+
+SEARCHES = [
+    [],
+    [
+        {'type': 'tags', 'term': {'include': ['scp'], 'exclude': ['tale']}},
+        {'type': 'rating', 'term': {'min': 50, 'max': None}},
+    ],
+    [{'type': 'author', 'term': {'include': ['alice'], 'exclude': ['BOB']}}],
+    [{'type': None, 'term': 'bear'}],
+    [{'type': None, 'term': '12'}],
+    [{'type': 'regex', 'term': '^Red'}],
+    [{'type': 'category', 'term': {'include': ['theme'], 'exclude': []}}],
+    [{'type': 'parent', 'term': 'page-1'}],
+    [{'type': 'url', 'term': 'PAGE-7'}],
+    [
+        {
+            'type': 'date',
+            'term': {
+                'min': pendulum.datetime(2015, 1, 1),
+                'max': pendulum.datetime(2018, 1, 1),
+            },
+        }
+    ],
+]
+
+
+def test_catalogue_search(db):
+    db.load_catalogue()
+    for search in SEARCHES:
+        assert sorted(db._search_articles(copy.deepcopy(search))) == sorted(
+            db.catalogue.search(copy.deepcopy(search))
+        )
+
+
+def test_catalogue_uncommitted(db):
+    db.load_catalogue()
+    search = [{'type': 'tags', 'term': {'include': ['new'], 'exclude': []}}]
+    article = {
+        'fullname': 'page-new',
+        'title': "New",
+        'rating': 0,
+        'created_at': "2020-01-01",
+        'parent_fullname': None,
+        'tags': ['new'],
+        'created_by': 'Alice',
+    }
+    # Articles aren't searched for until they've been committed
+    db.add_article(article, commit=False)
+    assert db.get_articles(copy.deepcopy(search)) == []
+    db.commit()
+    found = db.get_articles(copy.deepcopy(search))
+    assert len(found) == 1
+    assert db.get_articles_info(found)[0]['url'] == 'page-new'
@@ -1,5 +1,17 @@
 from functools import partial
+
+import pytest
+
+from tars.commands import gib
 from tars.commands.gib import Gib
+from tars.helpers.config import CONFIG
+from tars.helpers.database import SqliteDriver
+from tars.helpers.markov import ModelCache
+
+MESSAGES = [
+    "the quick brown fox jumps over the lazy dog {}".format(index)
+    for index in range(5)
+]
 
 
 def test_bracketify():
@@ -36,3 +48,56 @@ def test_bracketify():
     assert pabr('aaa) bbb') == '(aaa) bbb'
     assert pabr('aaa (bbb') == 'aaa (bbb)'
     assert pabr('aa((((aa') == 'aa((((aa))))'
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A database of its own for gib to read from, and an empty cache."""
+    monkeypatch.setitem(
+        CONFIG['db']['driver.database'], 'path', str(tmp_path / "tars.db")
+    )
+    db = SqliteDriver()
+    db.join_channel('#tars')
+    monkeypatch.setattr(gib, 'DB', db)
+    monkeypatch.setattr(Gib, 'cache', ModelCache(None, 2 ** 30))
+    return db
+
+
+def log(db, message):
+    db.log_message(
+        {
+            'channel': '#tars',
+            'sender': 'alice',
+            'kind': 'PRIVMSG',
+            'message': message,
+            'nick': 'alice',
+            'args': None,
+            'timestamp': 1000 + MESSAGES.index(message),
+        }
+    )
+    db.flush_messages()
+
+
+def test_get_model_race(db, monkeypatch):
+    # Each time gib has found the newest message, another one is logged
+    # before it fetches the messages
+    newest = db.get_newest_message_id
+    racing = list(MESSAGES[1:])
+
+    def get_newest_message_id(channels):
+        result = newest(channels)
+        if len(racing) > 0:
+            log(db, racing.pop(0))
+        return result
+
+    log(db, MESSAGES[0])
+    monkeypatch.setattr(db, 'get_newest_message_id', get_newest_message_id)
+    command = Gib(lambda permission: not permission)
+    command.parse("")
+    command['channel'] = ['#tars']
+    key = command.model_key(command['size'], 100)
+    # The message logged in between is left for the next gib, rather than
+    # being counted twice
+    for sentences in range(1, 6):
+        assert len(command.get_model(key, 100)) == sentences
+        assert Gib.cache.get(key)[1]['sentences'] == sentences
@@ -0,0 +1,182 @@
+from markovify.chain import BEGIN
+import numpy as np
+
+from tars.helpers.markov import (
+    CompactMarkov,
+    MarkovFromList,
+    ModelCache,
+    build_parallel,
+    count_grams,
+)
+
+MESSAGES = [
+    "the quick brown fox jumps over the lazy dog",
+    "the quick red fox runs past the sleepy cat",
+    "a lazy dog sleeps under the old oak tree",
+]
+
+
+def make_model(messages=MESSAGES):
+    return MarkovFromList(messages, well_formed=False, state_size=2)
+
+
+def test_update():
+    model = make_model(MESSAGES[1:])
+    model.update(MESSAGES[:1], 2)
+    expected = make_model(MESSAGES[:2])
+    assert model.parsed_sentences == expected.parsed_sentences
+    assert model.chain.model == expected.chain.model
+    assert model.rejoined_text == expected.rejoined_text
+    assert model.chain.begin_choices == expected.chain.begin_choices
+    model.update([], 2)
+    assert model.chain.model == expected.chain.model
+
+
+def test_model_cache(tmp_path):
+    cache = ModelCache(tmp_path, 10 ** 6, save_interval=0)
+    key = (('#tars',), (), (), 2, 100)
+    assert cache.get(key) == (None, None)
+    metadata = cache.put(key, make_model(MESSAGES[1:]), 1)
+    assert metadata['sentences'] == 2
+    model, metadata = cache.get(key)
+    assert metadata['newest'] == 1
+    model.update(MESSAGES[:1], 100)
+    assert cache.update(key, 2)['sentences'] == 3
+    # Models survive the cache being made again
+    cache = ModelCache(tmp_path, 10 ** 6)
+    model, metadata = cache.get(key)
+    assert model.chain.model == make_model().chain.model
+    assert model.parsed_sentences == make_model().parsed_sentences
+    assert not model.well_formed
+    assert metadata['newest'] == 2
+    assert metadata['sentences'] == 3
+
+
+def test_model_cache_eviction(tmp_path):
+    size = ModelCache(None, 0).put(0, make_model(), 1)['size']
+    cache = ModelCache(tmp_path, size * 2)
+    for key in range(3):
+        cache.put(key, make_model(), 1)
+    # The least recently used model is evicted
+    assert cache.get(0) == (None, None)
+    assert cache.get(1)[0] is not None
+    cache.put(3, make_model(), 1)
+    assert cache.get(2) == (None, None)
+    assert cache.get(1)[0] is not None
+    assert len(list(tmp_path.glob("*.meta.json"))) == 2
+    cache.clear()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_model_cache_update_evicted(tmp_path):
+    size = ModelCache(None, 0).put(0, make_model(), 1)['size']
+    cache = ModelCache(tmp_path, size)
+    cache.put(0, make_model(MESSAGES[1:]), 1)
+    model, _ = cache.get(0)
+    # Another model evicts it while it is being updated
+    cache.put(1, make_model(), 1)
+    model.update(MESSAGES[:1], 100)
+    metadata = cache.update(0, 2, model)
+    assert metadata['newest'] == 2
+    assert metadata['sentences'] == 3
+    assert cache.get(0) == (model, metadata)
+
+
+def test_make_sentences():
+    model = make_model()
+    sentences = model.make_sentences(5, min_chars=10, max_chars=60)
+    assert len(sentences) == len(set(sentences)) <= 5
+    assert all(10 <= len(sentence) <= 60 for sentence in sentences)
+    assert model.make_sentences(5, min_chars=1000) == []
+
+
+def compact_transitions(model):
+    """Reads the transitions of a CompactMarkov back into the same form as a
+    markovify chain's model."""
+    chain = model.chain
+    states = {0: (BEGIN,) * model.state_size}
+    transitions = {}
+    unread = [0]
+    while len(unread) > 0:
+        row = unread.pop()
+        state = states[row]
+        follows = transitions[state] = {}
+        weight = 0
+        for index in range(chain.offsets[row], chain.offsets[row + 1]):
+            word = chain.words[chain.follows[index]]
+            follows[word] = chain.weights[index] - weight
+            weight = chain.weights[index]
+            following = chain.rows[index]
+            if following >= 0 and following not in states:
+                states[following] = state[1:] + (word,)
+                unread.append(following)
+    assert len(states) == len(chain.offsets) - 1
+    return transitions
+
+
+def test_compact_model():
+    model = CompactMarkov(MESSAGES, 2)
+    expected = make_model()
+    assert len(model) == 3
+    assert compact_transitions(model) == expected.chain.model
+    assert model.rejoined_text == expected.rejoined_text
+    for _ in range(20):
+        sentence = model.make_short_sentence(60, test_output=False)
+        assert len(sentence) <= 60
+        assert set(sentence.split()) <= set(" ".join(MESSAGES).split())
+    # Sentences too much like the messages are rejected
+    assert model.make_sentence(max_overlap_total=2, tries=100) is None
+
+
+def test_compact_update():
+    model = CompactMarkov(MESSAGES[1:], 2)
+    model.update(MESSAGES[:1], 2)
+    expected = make_model(MESSAGES[:2])
+    assert compact_transitions(model) == expected.chain.model
+    assert model.rejoined_text == expected.rejoined_text
+    # Words only in the message that was taken out are forgotten
+    assert "oak" not in model.words
+    model = CompactMarkov.from_bytes(model.to_bytes())
+    assert compact_transitions(model) == expected.chain.model
+    assert len(model) == 2
+
+
+def test_compact_chain_grams():
+    model = CompactMarkov(MESSAGES * 2 + ["the end"], 3)
+    grams, counts = model.chain.grams()
+    expected_grams, expected_counts = count_grams(
+        model.corpus, model.starts, 3
+    )
+    assert np.array_equal(grams, expected_grams)
+    assert np.array_equal(counts, expected_counts)
+    grams, counts = CompactMarkov([], 2).chain.grams()
+    assert grams.shape == (0, 3)
+    assert len(counts) == 0
+
+
+def test_compact_smaller_state_size():
+    model = CompactMarkov(MESSAGES, 3)
+    for state_size in [3, 2, 1]:
+        smaller = model.of_state_size(state_size)
+        expected = MarkovFromList(
+            MESSAGES, well_formed=False, state_size=state_size
+        )
+        assert compact_transitions(smaller) == expected.chain.model
+    assert model.state_size == 3
+    assert smaller.make_sentence(test_output=False) is not None
+
+
+def test_build_parallel():
+    messages = MESSAGES * 3 + ["", "the end"]
+    expected = CompactMarkov(messages, 2)
+    for parts in [1, 2, 4]:
+        model = build_parallel(messages, 2, 10, parts=parts)
+        assert model.words == expected.words
+        assert model.corpus == expected.corpus
+        assert model.starts == expected.starts
+        assert model.rejoined_text == expected.rejoined_text
+        assert model.chain.offsets == expected.chain.offsets
+        assert model.chain.follows == expected.chain.follows
+        assert model.chain.weights == expected.chain.weights
+        assert model.chain.rows == expected.chain.rows
+    assert len(build_parallel([], 2, 10)) == 0
@@ -0,0 +1,46 @@
+from tars.helpers.membership import ChannelMembership, parse_modes
+
+
+def test_parse_modes():
+    assert parse_modes("+o", ["alice"]) == [('alice', '@', True)]
+    assert parse_modes("+ov-h", ["a", "b", "c"]) == [
+        ('a', '@', True),
+        ('b', '+', True),
+        ('c', '%', False),
+    ]
+    assert parse_modes("+bv", ["*!*@host", "a"]) == [('a', '+', True)]
+    assert parse_modes("+lv", ["10", "a"]) == [('a', '+', True)]
+    assert parse_modes("-lv", ["a"]) == [('a', '+', False)]
+    assert parse_modes("+nt", []) == []
+
+
+def test_membership():
+    members = ChannelMembership()
+    members.add_names("#tars", [("ignored", None)])
+    assert members.end_names("#tars") == ([], False)
+    assert members.members("#tars") is None
+    members.start("#tars")
+    members.add_names("#tars", [("alice", "@"), ("bob", None)])
+    assert members.end_names("#TARS") == (
+        [("#tars", "alice"), ("#tars", "bob")],
+        True,
+    )
+    assert members.join("#tars", "carol") == [("#tars", "carol")]
+    assert members.join("#tars", "Carol") == []
+    assert members.set_modes("#tars", [("carol", "+", True)]) == [
+        ("#tars", "carol")
+    ]
+    assert members.set_modes("#tars", [("alice", "+", True)]) == []
+    assert members.set_modes("#tars", [("alice", "@", False)]) == [
+        ("#tars", "alice")
+    ]
+    assert members.rename("bob", "rob") == [("#tars", "bob"), ("#tars", "rob")]
+    assert members.part("#tars", "ALICE") == [("#tars", "alice")]
+    assert sorted(members.members("#tars")) == [("carol", "+"), ("rob", None)]
+    assert members.quit("carol") == [("#tars", "carol")]
+    members.add_names("#tars", [("rob", "@"), ("dave", None)])
+    changes, first = members.end_names("#tars")
+    assert not first
+    assert sorted(changes) == [("#tars", "dave"), ("#tars", "rob")]
+    members.forget("#tars")
+    assert members.members("#tars") is None
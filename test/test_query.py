@@ -0,0 +1,73 @@
+from tars.helpers.query import (
+    SearchStatistics,
+    compile_article_search,
+    compile_message_search,
+    fts_query,
+)
+
+STATISTICS = SearchStatistics(
+    ratings=[-5, 0, 10, 50, 100],
+    dates=[1, 2, 3, 4, 5],
+    categories=['_default'] * 4 + ['theme'],
+    parents=[None] * 5,
+    tags=['scp', 'scp', 'scp', 'keter', 'tale'],
+    authors=['Alice', 'bob'],
+)
+
+
+def test_fts_query():
+    assert fts_query(["bear", "ab"]) == '"bear"'
+    assert fts_query(['say "hi"']) == '"say ""hi"""'
+    assert fts_query(["ab"]) is None
+
+
+def test_statistics():
+    assert STATISTICS.between(STATISTICS.ratings, 0, 50) == 3 / 5
+    assert STATISTICS.between(STATISTICS.ratings, None, -10) == 0
+    assert STATISTICS.share(STATISTICS.tags, ['scp', 'keter']) == 4 / 5
+
+
+def test_compile():
+    sql, parameters = compile_article_search(
+        [
+            {'type': 'regex', 'term': "^red door"},
+            {'type': 'rating', 'term': {'min': 0, 'max': None}},
+            {'type': 'url', 'term': "scp-173"},
+            {
+                'type': 'tags',
+                'term': {'include': ['scp', 'keter'], 'exclude': ['tale']},
+            },
+        ],
+        STATISTICS,
+    )
+    # Nothing is written into the SQL
+    assert "scp" not in sql and "red" not in sql
+    # The rarest tag is looked up first, and the regex is run last
+    assert parameters == [
+        'scp-173',
+        'keter',
+        'scp',
+        'tale',
+        0,
+        'red door',
+        "^red door",
+    ]
+    assert sql.endswith("title REGEXP ?")
+    assert compile_article_search([], STATISTICS) == (
+        "SELECT id FROM articles",
+        [],
+    )
+
+
+def test_compile_messages():
+    sql, parameters = compile_message_search([1, 2], minlength=40, limit=10)
+    assert parameters == [1, 2, 40, 10]
+    assert "id>?" not in sql and "id<=?" not in sql
+    sql, parameters = compile_message_search(
+        [1], limit=10, after=100, before=200
+    )
+    assert parameters == [1, 100, 200, 10]
+    assert "id>? AND id<=?" in sql
+    sql, parameters = compile_message_search([1], before=200)
+    assert parameters == [1, 200]
+    assert "id>?" not in sql and "id<=?" in sql
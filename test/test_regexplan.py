@@ -0,0 +1,32 @@
+from tars.helpers.regexplan import plan
+
+
+def test_required():
+    assert plan(r"hello").required == ('hello',)
+    assert plan(r"Hello World").required == ('hello world',)
+    assert plan(r"scp-\d+ (was|were)").required == ('cp-', ' ', 'w')
+    assert plan(r"^the (cat)+ bat").required == (' bat', 'the ', 'cat')
+    assert plan(r"(foo)? bar").required == (' bar',)
+    assert plan(r"foo|bar").required == ()
+    assert plan(r"[abc]def").required == ('def',)
+    assert plan(r"(?=.*apple)").required == ('apple',)
+    assert plan(r"(?!apple)").required == ()
+    assert plan(r"a{2,}b").required == ('a', 'b')
+    assert plan(r"the (red|blue) door").required == (' door', 'the ')
+    # These match letters that SQLite can't lowercase
+    assert plan(r"this").required == ('th',)
+    assert plan(r"über").required == ('ber',)
+
+
+def test_forbidden():
+    assert plan(r"^((?!the).)*$").forbidden == 'the'
+    assert plan(r"^(?:(?!The).)*$").forbidden == 'the'
+    assert plan(r"^((?!the).)*$").required == ()
+    assert plan(r"(?m)^((?!the).)*$").forbidden is None
+    assert plan(r"^((?!the).)+").forbidden is None
+    assert plan(r"^((?!t.e).)*$").forbidden is None
+
+
+def test_compiled():
+    assert plan(r"HELLO").compiled.search("oh hello there")
+    assert plan(r"HELLO") is plan(r"HELLO")
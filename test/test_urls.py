@@ -0,0 +1,20 @@
+from tars.helpers.urls import find_urls, link_kind
+
+
+def test_link_kind():
+    assert link_kind("https://www.youtube.com/watch?v=abc") == 'youtube'
+    assert link_kind("https://youtu.be/abc") == 'youtube'
+    assert link_kind("http://i.imgur.com/abc") == 'image'
+    assert link_kind("https://example.com/cat.png") == 'image'
+    assert link_kind("https://scp-wiki.net/scp-173") == 'other'
+
+
+def test_find_urls():
+    assert find_urls("no links here") == []
+    assert find_urls(
+        "see https://scp-wiki.net/scp-173 and HTTP://i.imgur.com/x.png, "
+        "or https://scp-wiki.net/scp-173 again"
+    ) == [
+        ("https://scp-wiki.net/scp-173", 'other'),
+        ("HTTP://i.imgur.com/x.png", 'image'),
+    ]
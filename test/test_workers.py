@@ -0,0 +1,36 @@
+import os
+import time
+
+import gevent
+import pytest
+
+from tars.helpers.workers import (
+    Workers,
+    WorkersBusyError,
+    WorkerTimeoutError,
+)
+
+
+def fail():
+    raise ValueError("failed")
+
+
+def test_workers():
+    workers = Workers(processes=1, queue=1)
+    # The function runs in another process
+    assert workers.run(10, os.getpid) != os.getpid()
+    assert workers.run(10, sorted, [3, 1, 2], reverse=True) == [3, 2, 1]
+    with pytest.raises(ValueError):
+        workers.run(10, fail)
+    with pytest.raises(WorkerTimeoutError):
+        workers.run(0.1, time.sleep, 10)
+
+
+def test_workers_busy():
+    workers = Workers(processes=1, queue=1)
+    tasks = [gevent.spawn(workers.run, 10, time.sleep, 0.2) for _ in range(2)]
+    gevent.sleep(0)
+    with pytest.raises(WorkersBusyError):
+        workers.run(10, time.sleep, 0)
+    gevent.joinall(tasks, raise_error=True)
+    assert workers.run(10, time.sleep, 0) is None